@@ -0,0 +1,61 @@
+"""
+Marshall – frameworks for orchestrating AI agents
+
+the public API is importable from here (`from marshall import GPT, Agent, HomogeneousEnsemble`), but nothing is imported until it's first used,
+so `import marshall` stays cheap for short-lived workers and CLI invocations
+"""
+
+import importlib
+
+# public name -> module it lives in
+_EXPORTS = {
+    # models
+    'LLM': 'marshall.core.llm',
+    'GPT': 'marshall.llms.gpt',
+    'Claude': 'marshall.llms.claude',
+    'CascadeRouter': 'marshall.llms.router',
+    'get_provider': 'marshall.llms',
+    'register_provider': 'marshall.llms',
+    'create': 'marshall.llms',
+    # agents, tools and execution
+    'Agent': 'marshall.core.agent',
+    'Toolkit': 'marshall.core.toolkit',
+    'Sandbox': 'marshall.core.sandbox',
+    'ContextLog': 'marshall.core.context',
+    # pipelines
+    'HomogeneousEnsemble': 'marshall.pipelines.ensemble',
+    'Debate': 'marshall.pipelines.debate',
+    'DelegationPipeline': 'marshall.pipelines.delegation',
+    'BatchRunner': 'marshall.pipelines.batch',
+    # retrieval and embeddings
+    'VectorIndex': 'marshall.tools.vector_search',
+    'embed_text': 'marshall.tools.embed',
+    'embed_texts': 'marshall.tools.embed',
+    'EmbeddingCache': 'marshall.tools.embed_cache',
+    'SemanticCache': 'marshall.tools.semantic_cache',
+    # infrastructure
+    'Transport': 'marshall.core.transport',
+    'ResponseCache': 'marshall.core.cache',
+    'tracing': 'marshall.core.tracing',
+    'ratelimit': 'marshall.core.ratelimit',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name: str):
+
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module = importlib.import_module(module)
+    # modules are exported as themselves, everything else is an attribute of its module
+    value = module if module.__name__.rsplit('.', 1)[-1] == name else getattr(module, name)
+    globals()[name] = value # later lookups skip __getattr__
+    return value
+
+
+def __dir__():
+
+    return sorted(list(globals()) + __all__)
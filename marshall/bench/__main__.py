@@ -0,0 +1,53 @@
+"""
+offline benchmarks against the local mock server
+
+    python -m marshall.bench --runs 20 --concurrency 4 --latency lognormal:0.05,0.5
+    python -m marshall.bench --save baseline.json
+    python -m marshall.bench --baseline baseline.json --tolerance 0.2   # exits 1 on a regression
+"""
+
+import argparse
+import sys
+
+from marshall.bench.mock_server import Latency
+from marshall.bench import suite
+
+
+def main(argv=None) -> int:
+
+    parser = argparse.ArgumentParser(prog='python -m marshall.bench', description='throughput, p50/p99 latency and memory of each pipeline against a local mock of the provider APIs')
+    parser.add_argument('cases', nargs='*', help=f"cases to run (default: all) – {', '.join(suite.CASES)}")
+    parser.add_argument('--runs', type=int, default=20, help='timed runs per case')
+    parser.add_argument('--concurrency', type=int, default=1, help='runs in flight at once')
+    parser.add_argument('--latency', default='lognormal:0.05,0.5', help="mock latency distribution, e.g. 0.05, uniform:0.02,0.1, lognormal:0.05,0.5")
+    parser.add_argument('--error-rate', type=float, default=0., help='fraction of mock requests that fail')
+    parser.add_argument('--error-status', type=int, default=500, help='status code of the injected failures (429/529 exercise the rate limiter)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results saved with --save, exit 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression against the baseline')
+    args = parser.parse_args(argv)
+
+    latency = Latency.parse(args.latency)
+    print(f"mock latency={latency} error_rate={args.error_rate} runs={args.runs} concurrency={args.concurrency}")
+    print(suite.HEADER)
+    results = suite.run_suite(args.cases, runs=args.runs, concurrency=args.concurrency, latency=latency, error_rate=args.error_rate, error_status=args.error_status, seed=args.seed)
+    rss = suite.peak_rss_mb()
+    if rss is not None:
+        print(f"peak rss: {rss:.1f} MB")
+
+    if args.save:
+        suite.save(results, args.save)
+
+    if args.baseline:
+        findings = suite.compare(results, suite.load(args.baseline), tolerance=args.tolerance)
+        for finding in findings:
+            print('REGRESSION', finding)
+        if findings:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
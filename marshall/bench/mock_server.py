@@ -0,0 +1,394 @@
+import hashlib
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Latency:
+
+    KINDS = ('constant', 'uniform', 'normal', 'lognormal', 'exponential')
+
+    def __init__(self, kind: str = 'constant', *params: float) -> None:
+
+        """
+        server-side delay (seconds) before each response
+
+        - constant(value)
+        - uniform(low, high)
+        - normal(mean, std) (clipped at 0)
+        - lognormal(median, sigma): long right tail, closest to real provider latencies
+        - exponential(mean)
+        """
+
+        assert kind in self.KINDS, f"latency kind must be one of {self.KINDS}"
+
+        defaults = {'constant': (0.,), 'uniform': (0., 0.1), 'normal': (0.05, 0.01), 'lognormal': (0.05, 0.5), 'exponential': (0.05,)}
+        self.kind = kind
+        self.params = tuple(params) or defaults[kind]
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Latency':
+
+        """'lognormal:0.05,0.5' -> Latency('lognormal', 0.05, 0.5), a bare number is a constant delay"""
+
+        kind, _, params = spec.partition(':')
+        try:
+            return cls('constant', float(kind))
+        except ValueError:
+            return cls(kind, *[float(p) for p in params.split(',') if p])
+
+    def sample(self, rng: random.Random) -> float:
+
+        p = self.params
+        if self.kind == 'constant':
+            return p[0]
+        if self.kind == 'uniform':
+            return rng.uniform(p[0], p[1])
+        if self.kind == 'normal':
+            return max(0., rng.gauss(p[0], p[1]))
+        if self.kind == 'lognormal':
+            return rng.lognormvariate(math.log(p[0]), p[1]) if p[0] > 0 else 0.
+
+        return rng.expovariate(1. / p[0]) if p[0] > 0 else 0.
+
+    def __repr__(self):
+
+        return f"{self.kind}:{','.join(str(p) for p in self.params)}"
+
+
+def _text_of(content) -> str:
+
+    # message content is a str or (anthropic) a list of content blocks
+    if isinstance(content, list):
+        return ''.join(block.get('text', '') for block in content if isinstance(block, dict))
+
+    return str(content or '')
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' # keep-alive, so client connection pooling behaves like it does against the real APIs
+    # headers and body go out as separate writes, with Nagle on a reused connection would stall each response on the client's delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+
+        pass
+
+    def do_POST(self):
+
+        mock = self.server.mock
+        length = int(self.headers.get('content-length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._send_json(400, {'error': {'type': 'invalid_request_error', 'message': 'body is not valid JSON'}})
+
+        path = self.path.split('?')[0].rstrip('/')
+        routes = {
+            '/v1/chat/completions': mock.chat_completion,
+            '/v1/messages': mock.message,
+            '/v1/embeddings': mock.embeddings,
+        }
+        if path not in routes:
+            return self._send_json(404, {'error': {'type': 'not_found_error', 'message': f'no route {path}'}})
+
+        mock.count(path)
+        time.sleep(mock.delay())
+
+        error = mock.maybe_error()
+        if error is not None:
+            status, headers = error
+            mock.count('errors')
+            return self._send_json(status, {'error': {'type': 'mock_error', 'message': f'injected {status}'}}, headers)
+
+        if body.get('stream') and path != '/v1/embeddings':
+            return self._send_events(routes[path](body, stream=True))
+
+        return self._send_json(200, routes[path](body))
+
+    def _send_json(self, status: int, obj: dict, headers: dict = None):
+
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, events: list):
+
+        # the body is sized up front (keeps the connection reusable) but written event by event, with a small gap in between
+        chunks = [(f'event: {event}\n' if event else '') + f'data: {data}\n\n' for event, data in events]
+        data = [c.encode() for c in chunks]
+        self.send_response(200)
+        self.send_header('content-type', 'text/event-stream')
+        self.send_header('content-length', str(sum(len(d) for d in data)))
+        self.end_headers()
+        for d in data:
+            self.wfile.write(d)
+            self.wfile.flush()
+            time.sleep(self.server.mock.stream_delay)
+
+
+class MockServer:
+
+    def __init__(self, latency: Latency = None, error_rate: float = 0., error_status: int = 500, script=None, fanout: int = 3, embedding_dim: int = 1536, stream_chunk_chars: int = 16, stream_delay: float = 0., host: str = '127.0.0.1', port: int = 0, seed: int = None) -> None:
+
+        """
+        local stand-in for the OpenAI (chat completions, embeddings) and Anthropic (messages) APIs, for benchmarks and offline runs
+
+        - latency: a `Latency` distribution sampled before every response
+        - error_rate: fraction of requests answered with `error_status` instead (429s carry a short retry-after-ms)
+        - script: what the model "says", one of
+            - None: a scripted agent – the first (top-level) decision dispatches `fanout` sub-tasks, sub-tasks answer; other prompts get a unique text answer (JSON when the request asks for JSON)
+            - a list of responses (str, or dict sent as JSON), handed out in order and cycled
+            - a callable(request body) -> str | dict
+        - embedding_dim: size of the (deterministic, per-text) embedding vectors
+        - stream_chunk_chars / stream_delay: size of and delay between streamed deltas
+
+        point the clients at it with `environ()` (or base_url=`openai_base_url` / `anthropic_base_url`)
+        """
+
+        self.latency = latency if latency is not None else Latency('constant', 0.)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.script = script
+        self.fanout = fanout
+        self.embedding_dim = embedding_dim
+        self.stream_chunk_chars = stream_chunk_chars
+        self.stream_delay = stream_delay
+
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._ids = itertools.count()
+        self.counts = {}
+        self._prefixes = set() # prompt prefixes seen so far, for emulating provider prompt caching
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def openai_base_url(self) -> str:
+
+        return self.url + '/v1'
+
+    @property
+    def anthropic_base_url(self) -> str:
+
+        return self.url
+
+    def environ(self) -> dict:
+
+        """env vars that point GPT, Claude and the embedding functions at this server"""
+
+        return {
+            'OPENAI_BASE_URL': self.openai_base_url,
+            'ANTHROPIC_BASE_URL': self.anthropic_base_url,
+            'OPENAI_API_KEY': 'mock',
+            'ANTHROPIC_API_KEY': 'mock',
+        }
+
+    def start(self) -> 'MockServer':
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+
+        return self.start()
+
+    def __exit__(self, *exc):
+
+        self.stop()
+
+    def count(self, key: str):
+
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def delay(self) -> float:
+
+        with self._lock:
+            return self.latency.sample(self.rng)
+
+    def maybe_error(self):
+
+        """returns (status, headers) for an injected error, or None"""
+
+        with self._lock:
+            failed = self.rng.random() < self.error_rate
+        if not failed:
+            return None
+
+        headers = {'retry-after-ms': '10'} if self.error_status == 429 else {}
+        return self.error_status, headers
+
+    # ---- scripted model ----
+
+    def respond(self, body: dict, system: str, prompt: str) -> str:
+
+        if callable(self.script):
+            out = self.script(body)
+        elif self.script:
+            out = self.script[next(self._turn) % len(self.script)]
+        else:
+            out = self._default_response(body, system, prompt)
+
+        return out if isinstance(out, str) else json.dumps(out)
+
+    def _default_response(self, body: dict, system: str, prompt: str):
+
+        n = next(self._turn)
+        if '`decision`' in system:
+            # agent protocol: dispatch at the top, answer everywhere below (and whenever dispatching isn't allowed)
+            if 'sub-task' in prompt.lower() or 'may NOT dispatch' in system:
+                return {'decision': 'answer', 'content': f'mock answer #{n} to: {prompt[:60]}'}
+            return {'decision': 'dispatch', 'content': [f'sub-task {i + 1} of: {prompt[:60]}' for i in range(self.fanout)]}
+
+        wants_json = 'response_format' in body or 'json' in body or '`content_type`' in system
+        if wants_json:
+            return {'content_type': 'text', 'content': f'mock answer #{n}'}
+
+        return f'mock answer #{n}'
+
+    def _usage(self, body: dict, text: str) -> tuple:
+
+        return max(1, len(json.dumps(body.get('messages', ''))) // 4), max(1, len(text) // 4)
+
+    def _cache_lookup(self, prefix: list) -> tuple:
+
+        # (tokens, hit) for a prompt prefix, the first request with a given prefix writes it to the "cache"
+        data = json.dumps(prefix, sort_keys=True)
+        key = hashlib.sha256(data.encode()).hexdigest()
+        with self._lock:
+            hit = key in self._prefixes
+            self._prefixes.add(key)
+
+        return len(data) // 4, hit
+
+    def _chunks(self, text: str) -> list:
+
+        size = max(1, self.stream_chunk_chars)
+        return [text[i:i + size] for i in range(0, len(text), size)] or ['']
+
+    # ---- endpoints ----
+
+    def chat_completion(self, body: dict, stream: bool = False):
+
+        messages = body.get('messages', [])
+        system = '\n'.join(_text_of(m.get('content')) for m in messages if m.get('role') == 'system')
+        prompt = next((_text_of(m.get('content')) for m in reversed(messages) if m.get('role') == 'user'), '')
+        text = self.respond(body, system, prompt)
+        model = body.get('model')
+
+        if stream:
+            events = [(None, json.dumps({'object': 'chat.completion.chunk', 'model': model, 'choices': [{'index': 0, 'delta': {'content': c}}]})) for c in self._chunks(text)]
+            return events + [(None, '[DONE]')]
+
+        prompt_tokens, completion_tokens = self._usage(body, text)
+
+        # automatic prefix caching like OpenAI's: leading system messages of 1024+ tokens, counted in 128 token steps
+        prefix = list(itertools.takewhile(lambda m: m.get('role') == 'system', messages))
+        prefix_tokens, hit = self._cache_lookup(prefix) if prefix else (0, False)
+        cached_tokens = min(prefix_tokens, prompt_tokens) // 128 * 128 if hit and prefix_tokens >= 1024 else 0
+
+        return {
+            'id': f'chatcmpl-mock-{next(self._ids)}',
+            'object': 'chat.completion',
+            'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens, 'prompt_tokens_details': {'cached_tokens': cached_tokens}},
+        }
+
+    def message(self, body: dict, stream: bool = False):
+
+        messages = body.get('messages', [])
+        # the (legacy) way this repo passes instructions to claude is as assistant turns, so those count as the system prompt too
+        system = '\n'.join([_text_of(body.get('system'))] + [_text_of(m.get('content')) for m in messages[:-1] if m.get('role') == 'assistant'])
+        prompt = next((_text_of(m.get('content')) for m in reversed(messages) if m.get('role') == 'user'), '')
+        text = self.respond(body, system, prompt)
+
+        # a trailing assistant turn is a prefill, the model continues after it
+        if messages and messages[-1].get('role') == 'assistant':
+            prefill = _text_of(messages[-1].get('content'))
+            text = text[len(prefill):] if text.startswith(prefill) else text
+
+        input_tokens, output_tokens = self._usage(body, text)
+
+        # explicit caching like Anthropic's: everything up to the last `cache_control` breakpoint is read from or written to the cache
+        marked = [i for i, m in enumerate(messages) if isinstance(m.get('content'), list) and any('cache_control' in b for b in m['content'] if isinstance(b, dict))]
+        cache_read = cache_write = 0
+        if marked:
+            prefix_tokens, hit = self._cache_lookup(messages[:marked[-1] + 1])
+            prefix_tokens = min(prefix_tokens, input_tokens)
+            input_tokens -= prefix_tokens
+            if hit:
+                cache_read = prefix_tokens
+            else:
+                cache_write = prefix_tokens
+        usage = {'input_tokens': input_tokens, 'output_tokens': output_tokens, 'cache_read_input_tokens': cache_read, 'cache_creation_input_tokens': cache_write}
+
+        if stream:
+            events = [('message_start', json.dumps({'type': 'message_start', 'message': {'model': body.get('model'), 'usage': dict(usage, output_tokens=0)}})),
+                      ('content_block_start', json.dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}))]
+            events += [('content_block_delta', json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': c}})) for c in self._chunks(text)]
+            events += [('content_block_stop', json.dumps({'type': 'content_block_stop', 'index': 0})),
+                       ('message_delta', json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': output_tokens}})),
+                       ('message_stop', json.dumps({'type': 'message_stop'}))]
+            return events
+
+        return {
+            'id': f'msg_mock_{next(self._ids)}',
+            'type': 'message',
+            'role': 'assistant',
+            'model': body.get('model'),
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': 'end_turn',
+            'usage': usage,
+        }
+
+    def embedding(self, text: str) -> list:
+
+        # deterministic per text (so caches and similarity behave), unit norm like the real model's
+        rng = random.Random(hashlib.sha256(text.encode()).digest())
+        vec = [rng.gauss(0., 1.) for _ in range(self.embedding_dim)]
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.
+        return [v / norm for v in vec]
+
+    def embeddings(self, body: dict):
+
+        inputs = body.get('input', [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return {
+            'object': 'list',
+            'model': body.get('model'),
+            'data': [{'object': 'embedding', 'index': i, 'embedding': self.embedding(str(text))} for i, text in enumerate(inputs)],
+            'usage': {'prompt_tokens': sum(len(str(t)) // 4 for t in inputs), 'total_tokens': sum(len(str(t)) // 4 for t in inputs)},
+        }
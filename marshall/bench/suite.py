@@ -0,0 +1,268 @@
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource # posix only, the peak RSS metric is skipped where it's missing
+except ImportError:
+    resource = None
+
+from marshall.core.concurrency import run_concurrently
+from marshall.core import ratelimit
+from marshall.bench.mock_server import MockServer, Latency
+
+GPT_MODEL = 'gpt-4o'
+CLAUDE_MODEL = 'claude-3-haiku-20240307'
+EMBEDDING_MODEL = 'text-embedding-3-small'
+
+
+def percentile(values: list, q: float) -> float:
+
+    """linear-interpolated percentile (q in [0, 100]) of a list of numbers"""
+
+    if not values:
+        return float('nan')
+
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100.
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+# ---- cases: each returns a zero-arg callable that runs the pipeline once (objects are built per run so no state leaks between runs) ----
+
+def _gpt_generate():
+
+    from marshall.llms.gpt import GPT
+    return lambda: GPT(GPT_MODEL).generate('What is the capital of France?')
+
+
+def _claude_generate():
+
+    from marshall.llms.claude import Claude
+    return lambda: Claude(CLAUDE_MODEL).generate('What is the capital of France?')
+
+
+def _gpt_stream():
+
+    from marshall.llms.gpt import GPT
+    return lambda: ''.join(GPT(GPT_MODEL).stream('What is the capital of France?'))
+
+
+def _embed_texts():
+
+    from marshall.tools.embed import embed_texts
+    texts = [f'benchmark text number {i}' for i in range(64)]
+    return lambda: embed_texts(texts, model=EMBEDDING_MODEL, cache=False)
+
+
+def _similarity_refinement():
+
+    from marshall.llms.gpt import GPT
+    from marshall.pipelines.ensemble import HomogeneousEnsemble
+    from marshall.tools.embed_cache import EmbeddingCache, set_default_cache
+
+    counter = iter(range(10 ** 9))
+
+    def run():
+        # fresh answers (and a fresh embedding cache) every run, so each one pays for its embeddings
+        set_default_cache(EmbeddingCache())
+        n = next(counter)
+        ensemble = HomogeneousEnsemble(GPT(GPT_MODEL), num_base_agents=5)
+        return ensemble.similarity_refinement([f'answer {n}.{i}' for i in range(5)])
+
+    return run
+
+
+def _ensemble_similarity():
+
+    from marshall.llms.gpt import GPT
+    from marshall.pipelines.ensemble import HomogeneousEnsemble
+    return lambda: HomogeneousEnsemble(GPT(GPT_MODEL), num_base_agents=5).run('What is the capital of France?')
+
+
+def _ensemble_agent():
+
+    from marshall.llms.gpt import GPT
+    from marshall.llms.claude import Claude
+    from marshall.pipelines.ensemble import HomogeneousEnsemble
+    return lambda: HomogeneousEnsemble(GPT(GPT_MODEL), num_base_agents=5, refinement_strategy='agent', refinement_agent=Claude(CLAUDE_MODEL)).run('What is the capital of France?')
+
+
+def _agent_scratchpad():
+
+    from marshall.llms.gpt import GPT
+    from marshall.core.agent import Agent
+    return lambda: Agent(GPT(GPT_MODEL), GPT(GPT_MODEL), None, max_depth=2).build_scratchpad('Write a report on renewable energy.')
+
+
+def _delegation_dag():
+
+    from marshall.llms.gpt import GPT
+    from marshall.core.agent import Agent
+    from marshall.pipelines.delegation import DelegationPipeline
+    return lambda: DelegationPipeline(Agent(GPT(GPT_MODEL), GPT(GPT_MODEL), None), max_depth=2).build_scratchpad('Write a report on renewable energy.')
+
+
+def _debate():
+
+    from marshall.llms.gpt import GPT
+    from marshall.pipelines.debate import Debate
+    return lambda: Debate(GPT(GPT_MODEL), num_debaters=3, max_rounds=2).run('What is the capital of France?')
+
+
+CASES = {
+    'gpt.generate': _gpt_generate,
+    'claude.generate': _claude_generate,
+    'gpt.stream': _gpt_stream,
+    'embed_texts': _embed_texts,
+    'ensemble.similarity_refinement': _similarity_refinement,
+    'ensemble.run(similarity)': _ensemble_similarity,
+    'ensemble.run(agent)': _ensemble_agent,
+    'agent.build_scratchpad': _agent_scratchpad,
+    'delegation.build_scratchpad': _delegation_dag,
+    'debate.run': _debate,
+}
+
+
+def measure(fn, runs: int = 20, concurrency: int = 1, warmup: int = 1, memory_runs: int = 3) -> dict:
+
+    """
+    calls fn() `runs` times (`concurrency` at a time) and reports throughput and p50/p99 latency,
+    then peak traced memory over a few more runs (tracemalloc slows everything down, so it's kept out of the timed runs)
+    """
+
+    for _ in range(warmup):
+        fn()
+
+    def timed(_):
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies, errors = run_concurrently(timed, range(runs), max_workers=concurrency)
+    wall = time.perf_counter() - start
+    latencies = [l for l in latencies if l is not None]
+
+    tracemalloc.start()
+    try:
+        for _ in range(memory_runs):
+            fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'runs': runs,
+        'errors': len(errors),
+        'error_sample': repr(next(iter(errors.values())))[:200] if errors else None,
+        'throughput': len(latencies) / wall if wall > 0 else float('nan'),
+        'p50_ms': percentile(latencies, 50) * 1000.,
+        'p99_ms': percentile(latencies, 99) * 1000.,
+        'peak_mb': peak / 2 ** 20,
+    }
+
+
+def run_suite(cases: list = None, runs: int = 20, concurrency: int = 1, latency: Latency = None, error_rate: float = 0., error_status: int = 500, seed: int = 0, verbose: bool = True) -> dict:
+
+    """
+    starts a `MockServer`, points every client at it and measures each case (all of `CASES` by default).
+    returns {case: metrics}
+    """
+
+    cases = cases or list(CASES)
+    unknown = [c for c in cases if c not in CASES]
+    assert not unknown, f"unknown benchmark cases {unknown}, pick from {list(CASES)}"
+
+    server = MockServer(latency=latency, error_rate=error_rate, error_status=error_status, seed=seed).start()
+    saved = {k: os.environ.get(k) for k in server.environ()}
+    os.environ.update(server.environ())
+
+    # the mock has no quotas, make sure the client-side limiter isn't what's being measured
+    for provider, model in (('chatgpt', GPT_MODEL), ('claude', CLAUDE_MODEL), ('openai-embeddings', EMBEDDING_MODEL)):
+        ratelimit.configure(provider, model, requests_per_minute=10 ** 7, tokens_per_minute=10 ** 10, initial_concurrency=256, max_concurrency=256)
+
+    results = {}
+    try:
+        for name in cases:
+            requests_before = sum(v for k, v in server.counts.items() if k != 'errors')
+            try:
+                metrics = measure(CASES[name](), runs=runs, concurrency=concurrency)
+            except Exception as e:
+                metrics = {'runs': runs, 'errors': runs, 'error_sample': repr(e)[:200]}
+            metrics['requests'] = sum(v for k, v in server.counts.items() if k != 'errors') - requests_before
+            results[name] = metrics
+            if verbose:
+                print(format_row(name, metrics), flush=True)
+    finally:
+        server.stop()
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        # limiters were configured for the mock, drop them so later real calls start from the defaults
+        for key in (('chatgpt', GPT_MODEL), ('claude', CLAUDE_MODEL), ('openai-embeddings', EMBEDDING_MODEL)):
+            ratelimit._limiters.pop(key, None)
+
+    return results
+
+
+HEADER = f"{'case':<32} {'runs':>5} {'errors':>6} {'req':>6} {'runs/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8}"
+
+
+def format_row(name: str, m: dict) -> str:
+
+    if 'p50_ms' not in m:
+        return f"{name:<32} {m['runs']:>5} {m['errors']:>6} {m.get('requests', 0):>6}  failed: {m.get('error_sample')}"
+
+    return f"{name:<32} {m['runs']:>5} {m['errors']:>6} {m['requests']:>6} {m['throughput']:>8.2f} {m['p50_ms']:>9.1f} {m['p99_ms']:>9.1f} {m['peak_mb']:>8.2f}"
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> list:
+
+    """
+    regressions against a previous run's results: latency or memory more than `tolerance` higher, throughput more than `tolerance` lower, or new errors.
+    returns a list of human readable findings (empty when nothing regressed)
+    """
+
+    findings = []
+    for name, m in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if m.get('errors', 0) > base.get('errors', 0):
+            findings.append(f"{name}: errors {base.get('errors', 0)} -> {m['errors']}")
+        for key in ('p50_ms', 'p99_ms', 'peak_mb'):
+            if key in m and key in base and m[key] > base[key] * (1. + tolerance):
+                findings.append(f"{name}: {key} {base[key]:.2f} -> {m[key]:.2f}")
+        if 'throughput' in m and 'throughput' in base and m['throughput'] < base['throughput'] * (1. - tolerance):
+            findings.append(f"{name}: throughput {base['throughput']:.2f} -> {m['throughput']:.2f}")
+
+    return findings
+
+
+def peak_rss_mb() -> float:
+
+    # None without the `resource` module (windows). ru_maxrss is in kilobytes on linux (bytes on macOS)
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def save(results: dict, path: str):
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path: str) -> dict:
+
+    with open(path) as f:
+        return json.load(f)
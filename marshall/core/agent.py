@@ -1,34 +1,59 @@
 # an agent is a process that runs a single task
 # a task comes with pre-defined inputs and outputs 
-import json 
+import logging 
+import threading 
+
+from marshall.core.concurrency import run_concurrently
+from marshall.core import utils
+from marshall.core import tracing
+from marshall.core import structured
+from marshall.core.context import ContextLog, budget_for
+
+logger = logging.getLogger(__name__)
+
+# added to a decision's context once max_depth is reached
+NO_DISPATCH = 'You may NOT dispatch this task, your decision must be one of "answer" or "code_execute".'
 
 # class DelegationAgent
 class Agent:
 
-    def __init__(self, base_model, subagent_model, refiner_model, toolkit=None):  
+    def __init__(self, base_model, subagent_model, refiner_model, toolkit=None, parallel=True, max_concurrency=None, max_depth=None, sandbox=None, context_budget=None, context_log=None):  
 
         """
         base_agent: initial agent task is passed to 
         subagent: agent that is spawned when a task is dispatched 
         refiner: agent applied to final output to summarize and provide a final response 
         toolkit (optional): a toolkit dict (needs `tool_dict` method) that is given to all agents in order to run tools
+        parallel: run sibling sub-tasks of a dispatch concurrently (scratchpad order still follows the dispatch order) 
+        max_concurrency (optional): global cap on the number of LLM decisions in flight at once, across the whole task tree 
+        max_depth (optional): dispatch depth after which agents have to answer/execute code instead of dispatching again 
+        sandbox (optional): a `Sandbox` (worker process pool) that code_execute decisions run in instead of the main interpreter 
+        context_budget (optional): token budget for the result log in each prompt, defaults to a per-model budget (see `context.MODEL_BUDGETS`) 
+        context_log (optional): a `ContextLog` to control how older results are compacted (e.g. with a summarizer) 
         """
 
-        self.base_model = base_model
-        self.subagent_model = subagent_model 
-        
-        # base and subagent models need to return json 
-        self.base_model.config.update({'json': True}) 
-        self.subagent_model.config.update({'json': True})
+        # the agent works on forks of the models, the instructions and json mode it adds never touch the models it was given 
+        # base and subagent models need to return json (mapped to response_format / a '{' prefill by the model classes) 
+        self.base_model = base_model.fork(config={'json': True}) 
+        self.subagent_model = subagent_model.fork(config={'json': True}) 
 
         self.refiner_model = refiner_model   
         self.toolkit = toolkit  
+        self.sandbox = sandbox 
 
         self.current_agent = self.base_model  
 
-        self.result_log = "" 
+        # results of previous decisions, passed (compacted to a token budget) to every later decision 
+        self.context = context_log if context_log is not None else ContextLog() 
+        self.context_budget = context_budget 
         self.logging = []
 
+        self.parallel = parallel 
+        self.max_depth = max_depth 
+        # guards logging, which sibling sub-tasks write to from different threads 
+        self._lock = threading.Lock() 
+        self._llm_slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None 
+
         # add general sys instructions to all agents
         instructions = f"""You are a highly intelligent AI agent who also has an army of sub-agents at your disposal. Your sole objective is to comprehensively answer a question/solve a problem provided to you. You may choose to answer the question directly (and optionally through the execution of code), or dispatch the task to your suite of sub-agents. Think deeply about the problem and then make your decision. ONLY dispatch when absolutely needed and when the task can be better fulfilled by breaking it down step by step into multiple chains of reasoning. 
 
@@ -60,58 +85,114 @@ class Agent:
 
         return tool_str
     
-    def build_tool_import_str(self, tk: dict) -> str: 
+    def execute_code(self, code: str): 
+
         """
-        builds a python string that imports all tools in the toolkit
+        runs model-written code and returns (code_str, result, error), error is None on success 
+
+        in the sandbox's pre-warmed workers (tools already loaded) when there is one, else in-process against a copy of the toolkit's precompiled namespace. 
+        both paths report failures (exceptions, sandbox timeouts and resource limits) the same way, as the error text, instead of raising 
         """
 
-        code = ""
-        for fname, fdetails in tk.items():
-            code += f"# {fname}\n"
-            description = fdetails['desc'].replace('\n', '')
-            code += f"# {description}\n"
-            source = fdetails['source']
-            code += f"{source}\n\n"
+        with tracing.span('code.execute', sandbox=self.sandbox is not None) as span: 
+            if self.sandbox is not None: 
+                out = self.sandbox.execute(code) 
+                result, error = out['result'], out['error'] 
+            else: 
+                namespace = self.toolkit.namespace() if self.toolkit else {} 
+                try: 
+                    result, error = utils.exec_code(code, namespace=namespace), None 
+                except Exception as e: 
+                    result, error = None, f"{type(e).__name__}: {e}" 
+            span.set('error', error) 
 
-        return code 
-    
-    def make_decision1(self, task: str, agent='base'):  
+        return code, result, error
+
+    def _model(self, agent: str): 
+
+        # kept on self.current_agent for inspection, but decisions only ever use the returned model (siblings run concurrently) 
+        model = self.base_model if agent == 'base' else self.subagent_model
+        self.current_agent = model 
+        return model
+
+    def _generate(self, model, task: str, context: list = None): 
+
+        if self._llm_slots is None: 
+            return model.generate(task, context=context) 
+
+        with self._llm_slots: 
+            return model.generate(task, context=context)
+
+    def _generate_decision(self, model, task: str, context: list = None) -> dict: 
+
+        """
+        generates and parses a decision (see `structured.DECISION`). malformed output is repaired locally first, 
+        the model is only asked again (once, with the parse error) when that fails
+        """
+
+        res = self._generate(model, task, context=context) 
+        try: 
+            mssg = structured.parse(res, structured.DECISION) 
+        except structured.ParseError as e: 
+            logger.info('unusable decision, asking again: %s', e) 
+            structured.record_reask() 
+            retry = (context or []) + [f"Your previous response could not be used ({e}). Respond with ONLY a JSON object with the keys `decision` and `content`."]
+            mssg = structured.parse(self._generate(model, task, context=retry), structured.DECISION) 
+
+        if mssg['decision'] == 'dispatch' and isinstance(mssg['content'], str): 
+            # one sub-task per line 
+            mssg['content'] = [line.strip() for line in mssg['content'].splitlines() if line.strip()]
+
+        return mssg 
+
+    @property 
+    def result_log(self) -> str: 
+
+        # full, uncompacted log (prompts get `self.context.render(...)` instead) 
+        return self.context.text() 
+
+    def _log(self, entry: str): 
+
+        self.context.append(entry) 
+
+    def _render_context(self, model) -> str: 
+
+        budget = self.context_budget if self.context_budget is not None else budget_for(getattr(model, 'model_name', None))
+        return self.context.render(budget=budget) 
+
+    def make_decision1(self, task: str, agent='base', allow_dispatch=True):  
 
         """
         protocol: 
 
         1. task is passed in 
-        2. self.result_log contains previous info 
+        2. self.context contains previous info (rendered within the model's token budget) 
         - if no prev agent, just user task and sys instructions 
         - if prev agent: 
             - (meta task, current task, result, next task) for each step 
 
+        allow_dispatch: when False (max depth reached) the agent is told to answer directly, and a dispatch is recorded as its answer
         """
         out = {}  
         log_separator = "\n--------\n"
 
-        if agent == 'base':
-            self.current_agent = self.base_model  
-        else:
-            self.current_agent = self.subagent_model 
-
-        # append prev results to sys history 
-        if self.result_log: 
-            self.current_agent.add_sys_instructions("**RESULT LOG**\n\n" + self.result_log + log_separator)  
+        model = self._model(agent)
 
-        # now, we need to chop off middle part of sys instructions 
-        refined_instructions = [self.current_agent.system_instructions[0], self.current_agent.system_instructions[-1]] 
-        self.current_agent.system_instructions = refined_instructions
+        # prev results go along with this call only, the shared model's instructions are never mutated 
+        result_log = self._render_context(model) 
+        context = ["**RESULT LOG**\n\n" + result_log + log_separator] if result_log else [] 
+        if not allow_dispatch: 
+            context.append(NO_DISPATCH)
 
         # generate decision 
-        print('about to generate')
-        res = self.current_agent.generate(task)   
-        print('generated')
-        mssg = json.loads(res['message'])
+        with tracing.span('agent.decision', agent=agent, allow_dispatch=allow_dispatch) as span: 
+            mssg = self._generate_decision(model, task, context=context or None)
+            span.set('decision', mssg['decision'])
+        logger.debug('generated decision for task: %s', task)
         
         decision = mssg['decision'] 
-
-        assert decision in ('dispatch', 'code_execute', 'answer'), f"Agent decision needs to be one of 'dispatch', 'code_execute', 'answer' – got {decision}"  
+        if decision == "dispatch" and not allow_dispatch: 
+            decision, mssg['content'] = "answer", self._dispatch_as_answer(mssg['content'])
 
         ########
 
@@ -120,33 +201,31 @@ class Agent:
             out['message'] = f"The task was: {task}\n\nThe answer provided was: {mssg['content']}" 
             out['done'] = True 
 
-            self.result_log += f"Directive: {task}\nResult: {mssg['content']}" + log_separator
+            self._log(f"Directive: {task}\nResult: {mssg['content']}" + log_separator)
 
         elif decision == "code_execute": 
             # execute code  
-            tool_imports = self.build_tool_import_str(self.toolkit.tool_dict)  
-            print("code to be run: ", mssg['content'])
-            code_str = tool_imports + mssg['content']
-            
-            namespace = {} 
-            exec(code_str, namespace)  
-            result = namespace.get('result', None)
+            logger.debug('code to be run: %s', mssg['content'])
+            code_str, result, error = self.execute_code(mssg['content'])
 
-            if result: 
+            if error is None and result is not None: 
                 out['success'] = True
             else: 
                 out['success'] = False  
 
-                print('code execution failed... trying again') 
+                logger.info('code execution failed... trying again') 
 
-                revised_task = f"The following code execution (for the task {task}) did NOT work: {code_str}\n\nPlease try again and remember to store the final output in a variable called `result`)." 
-                self.make_decision1(task=revised_task, agent='sub')
+                failure = f"It failed with:\n{error}" if error is not None else "It did not store anything in `result`."
+                revised_task = f"The following code execution (for the task {task}) did NOT work: {code_str}\n\n{failure}\n\nPlease try again and remember to store the final output in a variable called `result`)." 
+                # the retry's result isn't followed up on, so it can't dispatch either
+                self.make_decision1(task=revised_task, agent='sub', allow_dispatch=False)
 
+            result = result if error is None else f"Error: {error}"
             out['message'] = f"The task was: {task}\n\nThe following code was executed: \n\n{code_str}\n\nThe result was: {result}" 
 
             out['done'] = True  
 
-            self.result_log += f"Directive: {task}\nProcess: executed the following code ```python\n{mssg['content']}\n```\nResult: {result}" + log_separator
+            self._log(f"Directive: {task}\nProcess: executed the following code ```python\n{mssg['content']}\n```\nResult: {result}" + log_separator)
 
         # else, task was dispatched 
         else:
@@ -154,11 +233,11 @@ class Agent:
             out['message'] = mssg['content']
             out['done'] = False  
 
-            self.result_log += f"Directive: {task}\nResult: dispatched the following sub-tasks – {', '.join(mssg['content'])}" + log_separator
+            self._log(f"Directive: {task}\nResult: dispatched the following sub-tasks – {', '.join(mssg['content'])}" + log_separator)
 
         return out 
 
-    def make_decision(self, task, agent='base'): 
+    def make_decision(self, task, agent='base', allow_dispatch=True): 
 
         """
         agent can make decision to either `dispatch`, `answer`, or `code_execute`
@@ -166,117 +245,161 @@ class Agent:
         dispatch: agent sends task to subagent
         answer: agent answers the task
         code_execute: agent executes code
+
+        allow_dispatch: when False (max depth reached) the agent is told to answer directly, and a dispatch is recorded as its answer
         """  
 
-        if agent == 'base':
-            self.current_agent = self.base_model  
-        else:
-            self.current_agent = self.subagent_model   
+        with tracing.span('agent.decision', agent=agent, allow_dispatch=allow_dispatch) as span: 
+            out = self._decide(task, agent, allow_dispatch) 
+            span.set('done', out['done'])
+
+        return out 
+
+    @staticmethod 
+    def _dispatch_as_answer(content): 
+
+        # a dispatch past max depth is kept as the answer: its sub-task list is usually the agent's plan for the task 
+        if isinstance(content, list): 
+            return '\n'.join(str(x.get('task') if isinstance(x, dict) else x) for x in content) 
+        return content 
+
+    def _decide(self, task, agent, allow_dispatch): 
 
-        if self.result_log: 
-            self.current_agent.add_sys_instructions("You have received the following previous inputs from other agents to aid in your decision making:\n\n" + self.result_log + "\n\n--------\n\n")
+        model = self._model(agent)
 
+        # prev results go along with this call only, the shared model's instructions are never mutated 
+        result_log = self._render_context(model) 
+        context = ["You have received the following previous inputs from other agents to aid in your decision making:\n\n" + result_log + "\n\n--------\n\n"] if result_log else [] 
 
-        res = self.current_agent.generate(task)  
-        mssg = json.loads(res['message'])
+        if not allow_dispatch: 
+            context.append(NO_DISPATCH)
+
+        mssg = self._generate_decision(model, task, context=context or None)  
         
         decision = mssg['decision']  
+        tracing.current_span().set('decision', decision) 
+        if decision == "dispatch" and not allow_dispatch: 
+            decision, mssg['content'] = "answer", self._dispatch_as_answer(mssg['content'])
 
         out = {} # final out with 'success', 'message', 'done' keys
         if decision == "dispatch":  
             
             # set current agent subagent 
+            # sub-tasks are plain strings, or dicts ({'id', 'task', 'depends_on'}) when the model declares dependencies (see pipelines.delegation)
+            subtasks = [x if isinstance(x, dict) else {'task': x} for x in mssg['content']]
+
             out['success'] = True
-            out['message'] = mssg['content']
             out['done'] = False  
+            out['subtasks'] = subtasks 
 
-            self.result_log += 'The following sub-tasks were dispatched: ' + ', '.join(out['message']) + "\n\n--------\n\n"  
+            self._log('The following sub-tasks were dispatched: ' + ', '.join(str(t.get('task')) for t in subtasks) + "\n\n--------\n\n")  
 
-            out['message'] = [f"Your sub-task is: " + x for x in mssg['content']] # just the list of str instructions with meta task concatenated on 
+            out['message'] = [f"Your sub-task is: " + str(t.get('task')) for t in subtasks] # just the list of str instructions with meta task concatenated on 
 
         if decision == "code_execute": 
             # execute code  
-            tool_imports = self.build_tool_import_str(self.toolkit.tool_dict)  
-            print("code to be run: ", mssg['content'])
-            code_str = tool_imports + mssg['content']
-            
-            namespace = {} 
-            exec(code_str, namespace)  
-            result = namespace.get('result', None)
+            logger.debug('code to be run: %s', mssg['content'])
+            code_str, result, error = self.execute_code(mssg['content'])
 
-            if result: 
-                out['success'] = True
-            else: 
-                out['success'] = False 
+            out['success'] = error is None and result is not None 
+            if error is not None: 
+                result = f"Error: {error}" 
 
             out['message'] = f"The task was: {task}\n\nThe following code was executed: \n\n{code_str}\n\nThe result was: {result}" 
 
             out['done'] = True  
 
-            self.result_log += out['message'] + "\n\n--------\n\n" 
+            self._log(out['message'] + "\n\n--------\n\n") 
 
         if decision == "answer":
             out['success'] = True 
             out['message'] = f"The task was: {task}\n\nThe answer provided was: {mssg['content']}" 
             out['done'] = True
         
-            self.result_log += out['message'] + "\n\n--------\n\n"  
+            self._log(out['message'] + "\n\n--------\n\n")  
 
-        self.logging.append(out)
+        with self._lock: 
+            self.logging.append(out)
 
         # final result object: dict with 'success' key, 'message' key, 'done' key 
         return out   
     
-    def build_log(self, task: str, subagents=False):  
+    def _run_subtasks(self, fn, tasks: list) -> list: 
+
+        """runs fn(task) for every sibling sub-task (concurrently if self.parallel) and returns the results in dispatch order"""
+
+        if not self.parallel: 
+            return [fn(t) for t in tasks] 
+
+        results, errors = run_concurrently(fn, tasks) 
+        for i, e in errors.items(): 
+            logger.warning('sub-task failed: %s | %s', tasks[i], e) 
+
+        return results 
 
-        print(f"The following task came in: {task}")
+    def build_log(self, task: str, subagents=False, depth=0):  
+
+        logger.info('The following task came in: %s', task)
+
+        with tracing.span('agent.node', depth=depth, task=str(task)[:200]): 
+            self._build_log(task, subagents, depth) 
+
+    def _build_log(self, task: str, subagents, depth): 
 
         done = False  
         current_task = task 
         while not done: 
 
-            res = self.make_decision1(task=current_task, agent='base' if not subagents else 'sub') 
-            print(f"Got result. Done={res.get('done')} | Success={res.get('success')} | Content={res.get('message')}")
+            allow_dispatch = self.max_depth is None or depth < self.max_depth 
+            res = self.make_decision1(task=current_task, agent='base' if not subagents else 'sub', allow_dispatch=allow_dispatch) 
+            logger.debug('Got result. Done=%s | Success=%s | Content=%s', res.get('done'), res.get('success'), res.get('message'))
 
             if not res.get('done', True): 
                 # subtasks are a list of strings under `message` key 
                 subtasks = res['message'] 
-                for t in subtasks: 
-                    self.build_log(task=t, subagents=True)  
+                self._run_subtasks(lambda t: self.build_log(task=t, subagents=True, depth=depth + 1), subtasks)  
 
                 done = True 
                 break 
             else: 
-                print('DONE') 
+                logger.debug('DONE') 
                 done = True 
                 break 
     
-    def build_scratchpad(self, task, subagents=False): 
+    def build_scratchpad(self, task, subagents=False, depth=0): 
 
         """
         this function receives a task and then recursively builds a scratchpad that's passed to the refiner agent
+
+        sibling sub-tasks are built concurrently (when self.parallel), their scratchpads are stitched together in dispatch order
         """  
 
+        with tracing.span('agent.node', depth=depth, task=str(task)[:200]): 
+            return self._build_scratchpad(task, subagents, depth) 
+
+    def _build_scratchpad(self, task, subagents, depth): 
+
         SEPARATOR = "\n\n--------\n\n" 
         scratchpad = ""
 
         done = False 
         while not done: 
 
-            res = self.make_decision(task=task, agent='sub' if subagents else 'base') # returns dict with 'success', 'message', 'done' keys 
+            allow_dispatch = self.max_depth is None or depth < self.max_depth 
+            res = self.make_decision(task=task, agent='sub' if subagents else 'base', allow_dispatch=allow_dispatch) # returns dict with 'success', 'message', 'done' keys 
             if res['done']: 
-                print("done")
+                logger.debug('done')
                 done = True   
                 scratchpad += res['message'] + SEPARATOR
                 break 
             else: 
                 # we need to dispatch the list of sub-tasks to subagents 
                 tasks = res['message'] # list of str tasks   
-                print("tasks: ", tasks)
-                for t in tasks: 
-                    sub_scratchpad = self.build_scratchpad(t, subagents=True) 
-                    scratchpad += sub_scratchpad  
-                
+                logger.debug('tasks: %s', tasks)
+                sub_scratchpads = self._run_subtasks(lambda t: self.build_scratchpad(t, subagents=True, depth=depth + 1), tasks) 
+                for t, sub_scratchpad in zip(tasks, sub_scratchpads): 
+                    scratchpad += sub_scratchpad if sub_scratchpad is not None else f"The sub-task '{t}' failed." + SEPARATOR  
+            
                 done = True 
                 break 
 
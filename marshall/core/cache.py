@@ -0,0 +1,277 @@
+import contextlib
+import contextvars
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# sentinel so a cached None can be told apart from a miss
+MISSING = object()
+
+
+class LRUCache:
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None) -> None:
+
+        """
+        thread-safe in-memory LRU cache
+
+        - maxsize: max number of entries, the least recently used entry is evicted past this
+        - ttl (optional): seconds after which an entry expires
+        """
+
+        assert maxsize > 0, "maxsize must be positive"
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._data = OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+
+        with self._lock:
+            item = self._data.get(key, MISSING)
+            if item is MISSING or (item[1] is not None and item[1] < time.monotonic()):
+                if item is not MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+
+        return len(self._data)
+
+    def stats(self) -> dict:
+
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._data)}
+
+
+class CacheMiss(KeyError):
+    """raised in replay mode when a request was never recorded"""
+
+
+def payload_key(payload, namespace: str = '') -> str:
+
+    """canonical hash of a json payload (str or dict), stable under key order and whitespace"""
+
+    if isinstance(payload, (str, bytes)):
+        payload = json.loads(payload)
+
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256((namespace + '\n' + canonical).encode('utf-8')).hexdigest()
+
+
+# index of the sample being drawn when several identical requests are made on purpose (see `sample_scope`)
+_sample = contextvars.ContextVar('marshall_cache_sample', default=None)
+
+
+@contextlib.contextmanager
+def sample_scope(index: int):
+
+    """
+    marks the calls made inside as sample `index` of a set of identical requests (e.g. the N temperature-1 samples of an ensemble).
+    the index becomes part of the response cache key, so each sample gets its own cached response instead of all replaying the first one
+    """
+
+    token = _sample.set(index)
+    try:
+        yield
+    finally:
+        _sample.reset(token)
+
+
+def sample_namespace(namespace: str) -> str:
+
+    index = _sample.get()
+    return namespace if index is None else f"{namespace}#sample={index}"
+
+
+def namespace_key(*parts) -> str:
+
+    """short stable hash of whatever defines a cache namespace (model, system prompt, config, ...), parts must be json serializable"""
+
+    canonical = json.dumps(parts, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+class DiskCache:
+
+    def __init__(self, path: str, maxsize: int = 100000, ttl: float = None) -> None:
+
+        """
+        sqlite backed key -> json value store with the same get/set surface as `LRUCache`
+
+        - maxsize: max number of rows, the least recently read rows are evicted past this
+        - ttl (optional): seconds after which a row expires
+        """
+
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)")
+        self._conn.commit()
+
+    def get(self, key, default=MISSING):
+
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl and row[1] + self.ttl < now):
+                if row is not None:
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return default
+
+            self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def set(self, key, value):
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            size = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if size > self.maxsize:
+                self._conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed ASC LIMIT ?)", (size - self.maxsize,))
+                self.evictions += size - self.maxsize
+            self._conn.commit()
+
+    def delete(self, key):
+
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self):
+
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def __len__(self):
+
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> dict:
+
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self)}
+
+
+class ResponseCache:
+
+    MODES = ('read_write', 'record', 'replay')
+
+    def __init__(self, backend: str = 'memory', path: str = None, maxsize: int = 1024, ttl: float = None, mode: str = 'read_write') -> None:
+
+        """
+        opt-in cache of raw provider responses, keyed by a canonical hash of the request payload
+
+        - backend: 'memory' (LRU) or 'disk' (sqlite file at `path`)
+        - maxsize / ttl: size bound and expiry for entries
+        - mode:
+            - 'read_write': return a cached response if there is one, else call the provider and store the result
+            - 'record': always call the provider and store the result (overwrites)
+            - 'replay': only serve cached responses, raise `CacheMiss` instead of calling the provider (for offline runs)
+
+        only successful responses (no `error` key) are stored. the key is the payload alone, so identical requests share a response
+        unless they're made inside different `sample_scope`s (as the ensemble's samples are)
+        """
+
+        assert backend in ('memory', 'disk'), "backend must be one of 'memory', 'disk'"
+        assert mode in self.MODES, f"mode must be one of {self.MODES}"
+
+        if backend == 'disk':
+            assert path is not None, "a `path` is needed for the disk backend"
+            self.store = DiskCache(path, maxsize=maxsize, ttl=ttl)
+        else:
+            self.store = LRUCache(maxsize=maxsize, ttl=ttl)
+
+        self.mode = mode
+
+    def lookup(self, key: str):
+
+        if self.mode == 'record':
+            return MISSING
+
+        res = self.store.get(key)
+        if res is MISSING and self.mode == 'replay':
+            raise CacheMiss(f"no recorded response for payload {key}")
+
+        return res
+
+    def store_response(self, key: str, response):
+
+        if isinstance(response, dict) and 'error' not in response:
+            self.store.set(key, response)
+
+    def fetch(self, key: str, call):
+
+        """returns the cached response for `key` or the result of `call()` (which is then stored)"""
+
+        res = self.lookup(key)
+        if res is not MISSING:
+            return res
+
+        res = call()
+        self.store_response(key, res)
+        return res
+
+    async def afetch(self, key: str, acall):
+
+        """async version of `fetch`, `acall` is a zero arg coroutine function"""
+
+        res = self.lookup(key)
+        if res is not MISSING:
+            return res
+
+        res = await acall()
+        self.store_response(key, res)
+        return res
+
+    def stats(self) -> dict:
+
+        return self.store.stats()
@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from marshall.core import tracing
+
+# how often (seconds) the collector wakes up to check for timed out calls
+_POLL_INTERVAL = 0.05
+
+
+def run_concurrently(fn, items: list, max_workers: int = None, timeout: float = None) -> tuple:
+
+    """
+    runs `fn(item)` for every item in a bounded thread pool and collects the results in input order
+
+    max_workers: cap on the number of calls in flight at once (defaults to len(items))
+    timeout: per-call wall clock timeout in seconds, measured from when the call actually starts (not when it was queued)
+
+    returns (results, errors) where results is a list aligned with `items` (None for calls that failed or timed out) and errors is a dict of {index: exception}.
+    a failed call never raises here, so callers can work with partial results. 
+    calls run in the caller's tracing context, so their spans nest under the caller's span
+    """
+
+    results = [None] * len(items)
+    errors = {}
+    if not items:
+        return results, errors
+
+    started = {}
+
+    def _call(i, item):
+        started[i] = time.monotonic()
+        return fn(item)
+
+    pool = ThreadPoolExecutor(max_workers=max_workers or len(items))
+    futures = {pool.submit(tracing.propagate(_call), i, item): i for i, item in enumerate(items)}
+    pending = set(futures)
+
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=_POLL_INTERVAL if timeout else None, return_when=FIRST_COMPLETED)
+
+            for f in done:
+                i = futures[f]
+                try:
+                    results[i] = f.result()
+                except Exception as e:
+                    errors[i] = e
+
+            if timeout:
+                # threads can't be killed, so a timed out call is abandoned and left to finish in the background
+                now = time.monotonic()
+                for f in list(pending):
+                    i = futures[f]
+                    if i in started and now - started[i] > timeout:
+                        pending.discard(f)
+                        errors[i] = TimeoutError(f"call {i} timed out after {timeout}s")
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return results, errors
@@ -0,0 +1,132 @@
+import threading
+
+try:
+    import tiktoken # optional, falls back to a chars/4 estimate
+except ImportError:
+    tiktoken = None
+
+# token budget for the result log portion of a prompt, matched by model name prefix (longest prefix wins)
+MODEL_BUDGETS = {
+    'gpt-3.5': 4000,
+    'gpt-4': 2000,
+    'gpt-4-turbo': 16000,
+    'gpt-4o': 16000,
+    'claude-3': 16000,
+}
+DEFAULT_BUDGET = 4000
+
+_encoders = {}
+
+
+def count_tokens(text: str, model: str = None) -> int:
+
+    """token count with tiktoken when it's installed, else a ~4 chars per token estimate"""
+
+    if tiktoken is not None:
+        enc = _encoders.get(model)
+        if enc is None:
+            try:
+                enc = tiktoken.encoding_for_model(model)
+            except (KeyError, TypeError):
+                enc = tiktoken.get_encoding('cl100k_base')
+            _encoders[model] = enc
+        return len(enc.encode(text))
+
+    return len(text) // 4 + 1
+
+
+def budget_for(model: str) -> int:
+
+    matches = [prefix for prefix in MODEL_BUDGETS if model and model.startswith(prefix)]
+    return MODEL_BUDGETS[max(matches, key=len)] if matches else DEFAULT_BUDGET
+
+
+class ContextLog:
+
+    def __init__(self, keep_recent: int = 4, summary_chars: int = 300, summarizer=None, model: str = None) -> None:
+
+        """
+        append-only log of agent results, rendered into a bounded prompt section
+
+        - keep_recent: number of newest entries that are always kept verbatim (as long as they fit the budget)
+        - summary_chars: older entries are compacted to at most this many characters
+        - summarizer (optional): callable(str) -> str used to compact older entries instead of truncating them (e.g. a cheap LLM's generate)
+        - model (optional): model name used for token counting
+
+        appends are O(1) and every entry is counted/compacted at most once, rendering only walks the entries that fit the budget
+        """
+
+        self.keep_recent = keep_recent
+        self.summary_chars = summary_chars
+        self.summarizer = summarizer
+        self.model = model
+
+        self._entries = [] # [text, tokens, compact text, compact tokens]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def __bool__(self):
+
+        return bool(self._entries)
+
+    def append(self, text: str):
+
+        tokens = count_tokens(text, self.model)
+        with self._lock:
+            self._entries.append([text, tokens, None, None])
+
+    def clear(self):
+
+        with self._lock:
+            self._entries = []
+
+    def text(self) -> str:
+
+        """the full, uncompacted log"""
+
+        with self._lock:
+            return ''.join(entry[0] for entry in self._entries)
+
+    def _compact(self, entry: list):
+
+        if entry[2] is None:
+            text = entry[0]
+            if self.summarizer is not None:
+                compact = self.summarizer(text)
+            else:
+                compact = text if len(text) <= self.summary_chars else text[:self.summary_chars].rstrip() + ' [...]\n'
+            entry[2], entry[3] = compact, count_tokens(compact, self.model)
+
+        return entry[2], entry[3]
+
+    def render(self, budget: int = None) -> str:
+
+        """
+        newest entries verbatim, older ones compacted, oldest dropped once `budget` tokens are used up.
+        entries are returned in chronological order
+        """
+
+        budget = budget if budget is not None else budget_for(self.model)
+
+        with self._lock:
+            entries = list(self._entries)
+
+        parts = []
+        used = 0
+        for age, entry in enumerate(reversed(entries)):
+            text, tokens = entry[0], entry[1]
+            if age >= self.keep_recent or used + tokens > budget:
+                text, tokens = self._compact(entry)
+            if used + tokens > budget:
+                break
+            parts.append(text)
+            used += tokens
+
+        dropped = len(entries) - len(parts)
+        if dropped:
+            parts.append(f"[{dropped} earlier entries omitted]\n")
+
+        return ''.join(reversed(parts))
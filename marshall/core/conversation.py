@@ -0,0 +1,85 @@
+class Conversation:
+
+    """
+    immutable message history, stored as a persistent (cons) list: `append` returns a new conversation that points at this one,
+    so every fork of a model shares the messages they have in common and adding one costs O(1), never a copy of the history
+
+    messages are plain dicts (they go straight into request payloads), treat them as read only
+    """
+
+    __slots__ = ('parent', 'message', '_len', '_messages')
+
+    def __init__(self, parent: 'Conversation' = None, message: dict = None) -> None:
+
+        self.parent = parent if parent is not None and len(parent) else None
+        self.message = message
+        self._len = (len(parent) if parent is not None else 0) + (message is not None)
+        self._messages = None # materialized on first use, safe to keep since nothing below this node can change
+
+    @classmethod
+    def from_messages(cls, messages) -> 'Conversation':
+
+        conversation = cls()
+        for message in messages:
+            conversation = conversation.append(message)
+
+        return conversation
+
+    def append(self, message: dict) -> 'Conversation':
+
+        return Conversation(self, message)
+
+    def extend(self, messages) -> 'Conversation':
+
+        conversation = self
+        for message in messages:
+            conversation = conversation.append(message)
+
+        return conversation
+
+    def messages(self) -> tuple:
+
+        """the messages, oldest first. walks back only to the nearest node that was already materialized"""
+
+        if self._messages is None:
+            tail = []
+            node = self
+            while node is not None and node._messages is None:
+                if node.message is not None:
+                    tail.append(node.message)
+                node = node.parent
+            head = node._messages if node is not None else ()
+            self._messages = head + tuple(reversed(tail))
+
+        return self._messages
+
+    def __len__(self):
+
+        return self._len
+
+    def __iter__(self):
+
+        return iter(self.messages())
+
+    def __getitem__(self, i):
+
+        return self.messages()[i]
+
+    def __add__(self, messages) -> list:
+
+        # conversation + [per-call messages] -> the list that goes into a payload
+        return list(self.messages()) + list(messages)
+
+    def __eq__(self, other):
+
+        if isinstance(other, Conversation):
+            return self is other or self.messages() == other.messages()
+        if isinstance(other, (list, tuple)):
+            return list(self.messages()) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+
+        return f"Conversation({len(self)} messages)"
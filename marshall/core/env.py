@@ -0,0 +1,55 @@
+import os
+import threading
+
+# env vars and default endpoints per provider family
+PROVIDER_ENV = {
+    'openai': {'api_key': 'OPENAI_API_KEY', 'base_url': 'OPENAI_BASE_URL', 'default_base_url': 'https://api.openai.com/v1'},
+    'anthropic': {'api_key': 'ANTHROPIC_API_KEY', 'base_url': 'ANTHROPIC_BASE_URL', 'default_base_url': 'https://api.anthropic.com'},
+}
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_env():
+
+    """loads a .env file into os.environ, once per process and only when a setting is first needed (python-dotenv is optional)"""
+
+    global _loaded
+    if _loaded:
+        return
+
+    with _lock:
+        if _loaded:
+            return
+        try:
+            from dotenv import load_dotenv
+        except ImportError:
+            pass
+        else:
+            load_dotenv()
+        _loaded = True
+
+
+def get_env(name: str, default: str = None) -> str:
+
+    load_env()
+    return os.getenv(name, default)
+
+
+def get_api_key(provider: str) -> str:
+
+    """the API key for a provider family ('openai' or 'anthropic'), read from the environment (or .env) on first use"""
+
+    var = PROVIDER_ENV[provider]['api_key']
+    key = get_env(var)
+    assert key is not None, f"No api key found, make sure you have an environment variable called '{var}'"
+    return key
+
+
+def get_base_url(provider: str, base_url: str = None) -> str:
+
+    """an explicit base_url, else the provider's *_BASE_URL env var, else its public API"""
+
+    settings = PROVIDER_ENV[provider]
+    return (base_url or get_env(settings['base_url']) or settings['default_base_url']).rstrip('/')
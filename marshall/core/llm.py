@@ -1,10 +1,276 @@
+import asyncio
+import copy
+import threading
+import time
+
+from marshall.core.transport import get_default_transport
+from marshall.core import ratelimit
+from marshall.core import tracing
+from marshall.core.concurrency import run_concurrently
+from marshall.core.cache import payload_key, namespace_key, sample_namespace
+from marshall.core.conversation import Conversation
+from marshall.core.streaming import IncrementalJSONParser
+
+
 class LLM:
 
-    def __init__(self, model_name: str, config={}) -> None:
+    def __init__(self, model_name: str, config: dict = None, transport=None, response_cache=None, semantic_cache=None) -> None:
         
         self.model_name = model_name
-        self.config = config
+        # copied, so changing a model's config never reaches the dict it was created with (or other models created with it)
+        self.config = dict(config) if config else {}
+        # instructions sent ahead of every prompt, immutable and shared between forks (see `fork`)
+        self.conversation = Conversation()
+        # pooled http transport, shared across providers unless one is injected
+        self.transport = transport if transport is not None else get_default_transport()
+        # optional `ResponseCache`, raw provider responses are memoized/replayed by payload hash
+        self.response_cache = response_cache
+        # optional `tools.semantic_cache.SemanticCache`, answers to near-duplicate prompts are reused without calling the provider (see `semantic_call`)
+        self.semantic_cache = semantic_cache
+        # retries with jittered backoff on 429/529/5xx, requests also go through the shared per (provider, model) rate limiter
+        self.retry_policy = ratelimit.RetryPolicy()
+
+        # provider-side prompt caching: usage of the last response and running totals (see `track_usage`)
+        self.last_usage = None
+        self.cache_stats = {'requests': 0, 'cache_hits': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'cache_write_tokens': 0}
+        self._stats_lock = threading.Lock()
+
+        # native tool calling (see `tool_loop`), subclasses set these from their kwargs 
+        self.toolkit = None 
+        self.native_tools = False 
+        self.max_steps = 8 
+
+    @property 
+    def system_instructions(self) -> list: 
+
+        """the instruction messages (a fresh list, add to them with the subclass's add_* methods)"""
+
+        return list(self.conversation.messages()) 
+
+    @system_instructions.setter 
+    def system_instructions(self, messages: list): 
+
+        self.conversation = Conversation.from_messages(messages) 
+
+    def fork(self, config: dict = None) -> 'LLM': 
+
+        """
+        a copy of this model for another role/query in O(1): it shares the instruction history (immutable), transport, caches and usage stats, 
+        but instructions added to it and its config (this model's config updated with `config`) are its own
+        """
+
+        clone = copy.copy(self) 
+        clone.config = dict(self.config, **(config or {})) 
+
+        return clone 
 
     def generate(self, prompt: str): 
         raise NotImplementedError("This method should be implemented by subclasses.")
 
+    async def agenerate(self, prompt: str): 
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def stream(self, prompt: str, **kwargs): 
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def astream(self, prompt: str, **kwargs): 
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def stream_fields(self, prompt: str, **kwargs): 
+
+        """
+        for json output: yields (key, value) for each top-level field of the streamed JSON object as soon as its value is complete, 
+        e.g. ('content_type', 'code') arrives before the code itself has finished streaming
+        """
+
+        parser = IncrementalJSONParser() 
+        for delta in self.stream(prompt, **kwargs): 
+            for key in parser.feed(delta): 
+                yield key, parser.fields[key]
+
+    async def astream_fields(self, prompt: str, **kwargs): 
+
+        parser = IncrementalJSONParser() 
+        async for delta in self.astream(prompt, **kwargs): 
+            for key in parser.feed(delta): 
+                yield key, parser.fields[key]
+
+    def request(self, url: str, headers: dict, payload: str) -> dict: 
+
+        """rate limited POST with retries, raises `ratelimit.ProviderError` if the provider keeps failing"""
+
+        response = ratelimit.send(self.transport, url, headers, payload, provider=self.name, model=self.model_name, policy=self.retry_policy)
+        return self.track_usage(response.json())
+
+    async def arequest(self, url: str, headers: dict, payload: str) -> dict: 
+
+        response = await ratelimit.asend(self.transport, url, headers, payload, provider=self.name, model=self.model_name, policy=self.retry_policy)
+        return self.track_usage(response.json())
+
+    def track_usage(self, response: dict) -> dict: 
+
+        """
+        records prompt caching usage from a response body and returns it unchanged: 
+        OpenAI reports `prompt_tokens_details.cached_tokens` (included in prompt_tokens), 
+        Anthropic `cache_read_input_tokens` / `cache_creation_input_tokens` (on top of input_tokens)
+        """
+
+        usage = response.get('usage') if isinstance(response, dict) else None 
+        if not usage: 
+            return response 
+
+        if 'input_tokens' in usage: 
+            cached = usage.get('cache_read_input_tokens') or 0 
+            written = usage.get('cache_creation_input_tokens') or 0 
+            prompt = (usage.get('input_tokens') or 0) + cached + written 
+        else: 
+            cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0 
+            written = 0 
+            prompt = usage.get('prompt_tokens') or 0 
+
+        self.last_usage = usage 
+        with self._stats_lock: 
+            self.cache_stats['requests'] += 1 
+            self.cache_stats['cache_hits'] += cached > 0 
+            self.cache_stats['prompt_tokens'] += prompt 
+            self.cache_stats['cached_tokens'] += cached 
+            self.cache_stats['cache_write_tokens'] += written 
+
+        span = tracing.current_span() 
+        span.set('cached_tokens', cached) 
+        span.set('cache_write_tokens', written) 
+
+        return response 
+
+    def cache_hit_rate(self) -> float: 
+
+        """share of prompt tokens served from the provider's prompt cache"""
+
+        with self._stats_lock: 
+            return self.cache_stats['cached_tokens'] / self.cache_stats['prompt_tokens'] if self.cache_stats['prompt_tokens'] else 0. 
+
+    def throttle(self, payload: str): 
+
+        # streams can't be retried mid-way, but they still wait for their share of the rate limit 
+        time.sleep(ratelimit.get_limiter(self.name, self.model_name).reserve(len(payload) // 4))
+
+    async def athrottle(self, payload: str): 
+
+        await asyncio.sleep(ratelimit.get_limiter(self.name, self.model_name).reserve(len(payload) // 4))
+
+    def semantic_namespace(self, context: list = None, *extra) -> str: 
+
+        """semantic cache namespace: answers are only shared between calls with the same model, instructions, config and per-call context"""
+
+        return namespace_key(self.name, self.model_name, getattr(self, 'system_instructions', None), self.config, context, *extra)
+
+    def semantic_call(self, prompt: str, compute, context: list = None, *extra): 
+
+        """returns compute() (a full generate: request + parsing/code execution), or the semantic cache's answer for a near-duplicate prompt"""
+
+        if self.semantic_cache is None: 
+            return compute() 
+
+        return self.semantic_cache.get_or_compute(prompt, self.semantic_namespace(context, *extra), compute) 
+
+    async def asemantic_call(self, prompt: str, acompute, context: list = None, *extra): 
+
+        if self.semantic_cache is None: 
+            return await acompute() 
+
+        return await self.semantic_cache.aget_or_compute(prompt, self.semantic_namespace(context, *extra), acompute) 
+
+    def cached_call(self, payload: str, url: str, call) -> dict: 
+
+        """
+        runs `call()` (the actual http request) unless the response cache already holds a response for this payload 
+        (and sample index, see `cache.sample_scope`, so repeated samples of one prompt aren't all served the same response)
+        """
+
+        with tracing.span('llm.call', provider=self.name, model=self.model_name) as span: 
+            if self.response_cache is None: 
+                response = call() 
+            else: 
+                response = self.response_cache.fetch(payload_key(payload, namespace=sample_namespace(url)), call)
+            tracing.record_usage(span, response) 
+
+        return response
+
+    async def acached_call(self, payload: str, url: str, acall) -> dict: 
+
+        with tracing.span('llm.call', provider=self.name, model=self.model_name) as span: 
+            if self.response_cache is None: 
+                response = await acall() 
+            else: 
+                response = await self.response_cache.afetch(payload_key(payload, namespace=sample_namespace(url)), acall)
+            tracing.record_usage(span, response) 
+
+        return response
+
+    def tool_calls(self, response: dict) -> list: 
+
+        """the tool calls in a response as [(call_id, tool name, arguments)], [] if the model didn't call any"""
+
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def tool_turns(self, response: dict, results: list) -> list: 
+
+        """the messages that continue the conversation after `response`: the model's turn and the tool results (one follow-up)"""
+
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def run_tools(self, calls: list) -> list: 
+
+        """
+        runs every tool call of one model turn concurrently (calls within a turn are independent by construction). 
+        returns [(call_id, output, is_error)] in call order, a failing tool is reported back to the model instead of raising
+        """
+
+        def _run(call): 
+            call_id, name, arguments = call 
+            with tracing.span('tool.call', tool=name): 
+                return self.toolkit.call(name, arguments)
+
+        results, errors = run_concurrently(_run, calls) 
+
+        return [
+            (call[0], f"Error: {type(errors[i]).__name__}: {errors[i]}" if i in errors else results[i], i in errors) 
+            for i, call in enumerate(calls)
+        ]
+
+    def tool_loop(self, send) -> dict: 
+
+        """
+        multi-turn native tool calling. `send(turns, final)` makes one request with the given extra turns and returns the response. 
+        each turn's tool calls run concurrently and go back in a single follow-up, until the model answers without calling a tool. 
+        after `max_steps` tool turns a last request (final=True) forbids tool use, so the model has to answer with what it has
+        """
+
+        turns = [] 
+        with tracing.span('llm.tools', provider=self.name, model=self.model_name, max_steps=self.max_steps) as span: 
+            for _ in range(self.max_steps): 
+                response = send(turns, False) 
+                calls = self.tool_calls(response) 
+                if not calls: 
+                    return response 
+                span.add('steps') 
+                span.add('tool_calls', len(calls)) 
+                turns = turns + self.tool_turns(response, self.run_tools(calls)) 
+
+            return send(turns, True) 
+
+    async def atool_loop(self, asend) -> dict: 
+
+        turns = [] 
+        with tracing.span('llm.tools', provider=self.name, model=self.model_name, max_steps=self.max_steps) as span: 
+            for _ in range(self.max_steps): 
+                response = await asend(turns, False) 
+                calls = self.tool_calls(response) 
+                if not calls: 
+                    return response 
+                span.add('steps') 
+                span.add('tool_calls', len(calls)) 
+                results = await asyncio.to_thread(self.run_tools, calls) # to_thread carries the tracing context over 
+                turns = turns + self.tool_turns(response, results) 
+
+            return await asend(turns, True) 
@@ -0,0 +1,446 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+from marshall.core import tracing
+from marshall.core.transport import _httpx
+
+
+class ProviderError(RuntimeError):
+
+    def __init__(self, status_code: int, body: str) -> None:
+
+        super().__init__(f"provider returned {status_code}: {body[:500]}")
+        self.status_code = status_code
+        self.body = body
+
+
+class TokenBucket:
+
+    def __init__(self, rate_per_minute: float, burst: float = None) -> None:
+
+        """
+        classic token bucket, refilled continuously at `rate_per_minute` up to `burst` (defaults to one minute's worth)
+        """
+
+        self.rate = rate_per_minute / 60.
+        self.capacity = burst if burst is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float = 1.) -> float:
+
+        """takes `amount` tokens (possibly going into debt) and returns how many seconds the caller has to wait before using them"""
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # a single request larger than the bucket would never fit, cap it at a full bucket
+            amount = min(amount, self.capacity)
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 and self.rate > 0 else 0.
+            return max(wait, self.blocked_until - now, 0.)
+
+    def refund(self, amount: float):
+
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def adjust(self, amount: float):
+
+        """takes `amount` more tokens (gives them back if negative), e.g. once a request's actual usage is known. debt is capped at a full bucket"""
+
+        with self._lock:
+            self.tokens = max(-self.capacity, min(self.capacity, self.tokens - amount))
+
+    def set_rate(self, rate_per_minute: float):
+
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate_per_minute / 60.
+            self.capacity = rate_per_minute
+            self.tokens = min(self.tokens, self.capacity)
+
+    def block_for(self, seconds: float):
+
+        """nothing goes through for `seconds` (used when the server says the quota is used up)"""
+
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class AIMDLimiter:
+
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 64, decrease: float = 0.5) -> None:
+
+        """
+        adaptive concurrency limit: +1 after a window's worth of successes (additive increase), *decrease on throttling (multiplicative decrease)
+        """
+
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._waiters = [] # (loop, future) of coroutines waiting in `aacquire`, woken from whichever thread frees a slot
+
+    def try_acquire(self) -> bool:
+
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+
+        """async `acquire`: waits on a future that `release` / `on_success` resolve, the event loop is never blocked and never polled"""
+
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self._cond:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+
+    def _notify(self):
+
+        # caller holds the lock. wakes the blocked threads and the waiting coroutines, they re-check the limit themselves
+        self._cond.notify_all()
+        for loop, waiter in self._waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # the waiter's loop is closed
+                pass
+        self._waiters.clear()
+
+    def release(self):
+
+        with self._cond:
+            self.in_flight -= 1
+            self._notify()
+
+    def on_success(self):
+
+        with self._cond:
+            self.limit = min(self.maximum, self.limit + 1. / max(self.limit, 1.))
+            self._notify()
+
+    def on_throttle(self):
+
+        with self._cond:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+def _wake(waiter: asyncio.Future):
+
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class RetryPolicy:
+
+    def __init__(self, max_retries: int = 5, base_delay: float = 0.5, max_delay: float = 30., retry_statuses: tuple = (408, 409, 429, 500, 502, 503, 504, 529)) -> None:
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = set(retry_statuses)
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+
+        """full-jitter exponential backoff, never shorter than what the server asked for"""
+
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(backoff, retry_after or 0.)
+
+
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_UNITS = {'ms': 0.001, 's': 1., 'm': 60., 'h': 3600.}
+
+
+def parse_reset(value: str) -> float:
+
+    """seconds until a rate limit resets, from either a duration ('6m0s', '20ms', '1.5') or an RFC 3339 timestamp"""
+
+    if value is None:
+        return None
+
+    value = value.strip()
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+
+    parts = _DURATION.findall(value)
+    if parts and ''.join(n + u for n, u in parts) == value:
+        return sum(float(n) * _UNITS[u] for n, u in parts)
+
+    try:
+        reset_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return max(0., reset_at.timestamp() - time.time())
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+
+    def __init__(self, requests_per_minute: float = 500, tokens_per_minute: float = 200000, initial_concurrency: int = 8, max_concurrency: int = 64) -> None:
+
+        """
+        rate limiting for one (provider, model): request and token buckets plus an adaptive (AIMD) concurrency limit.
+        bucket rates follow the limits the provider reports in its response headers
+        """
+
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AIMDLimiter(initial=initial_concurrency, maximum=max_concurrency)
+
+        self.throttled = 0
+        self.retries = 0
+
+    def reserve(self, est_tokens: int) -> float:
+
+        return max(self.requests.reserve(1), self.tokens.reserve(est_tokens))
+
+    def reconcile(self, est_tokens: int, response):
+
+        """corrects the token bucket by the difference between the estimate reserved for a request and the tokens its response reports using"""
+
+        used = used_tokens(response)
+        if used is not None:
+            self.tokens.adjust(used - min(est_tokens, self.tokens.capacity))
+
+    def update_from_headers(self, headers):
+
+        """reads OpenAI (x-ratelimit-*) and Anthropic (anthropic-ratelimit-*) rate limit headers"""
+
+        for kind, bucket in (('requests', self.requests), ('tokens', self.tokens)):
+            for prefix in ('x-ratelimit', 'anthropic-ratelimit'):
+                limit = headers.get(f'{prefix}-limit-{kind}') or headers.get(f'{prefix}-{kind}-limit')
+                remaining = headers.get(f'{prefix}-remaining-{kind}') or headers.get(f'{prefix}-{kind}-remaining')
+                reset = headers.get(f'{prefix}-reset-{kind}') or headers.get(f'{prefix}-{kind}-reset')
+
+                try:
+                    if limit is not None and float(limit) > 0 and abs(float(limit) - bucket.rate * 60.) > 1e-6:
+                        bucket.set_rate(float(limit))
+                    if remaining is not None and float(remaining) <= 0:
+                        wait = parse_reset(reset)
+                        if wait:
+                            bucket.block_for(wait)
+                except ValueError:
+                    continue
+
+    def stats(self) -> dict:
+
+        return {'concurrency_limit': self.concurrency.limit, 'in_flight': self.concurrency.in_flight, 'throttled': self.throttled, 'retries': self.retries}
+
+
+# default limits per provider, a `configure` call overrides them for a given (provider, model)
+DEFAULT_LIMITS = {
+    'chatgpt': {'requests_per_minute': 500, 'tokens_per_minute': 200000},
+    'claude': {'requests_per_minute': 50, 'tokens_per_minute': 40000},
+    'openai-embeddings': {'requests_per_minute': 3000, 'tokens_per_minute': 1000000},
+}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str, model: str) -> RateLimiter:
+
+    key = (provider, model)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None:
+                limiter = _limiters[key] = RateLimiter(**DEFAULT_LIMITS.get(provider, {}))
+
+    return limiter
+
+
+def configure(provider: str, model: str, **kwargs) -> RateLimiter:
+
+    """sets the limits (RateLimiter kwargs) for a (provider, model), e.g. configure('claude', 'claude-3-opus-20240229', requests_per_minute=4000)"""
+
+    with _limiters_lock:
+        limiter = _limiters[(provider, model)] = RateLimiter(**kwargs)
+
+    return limiter
+
+
+def _retry_after(headers) -> float:
+
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000.
+        except ValueError:
+            pass
+
+    return parse_reset(headers.get('retry-after'))
+
+
+def used_tokens(response) -> int:
+
+    """total tokens a response body reports in `usage` (OpenAI or Anthropic field names), None if it doesn't say"""
+
+    try:
+        usage = response.json().get('usage')
+    except Exception:
+        return None
+    if not isinstance(usage, dict):
+        return None
+
+    if 'total_tokens' in usage:
+        return usage['total_tokens'] or 0
+    if 'input_tokens' in usage or 'output_tokens' in usage:
+        return sum(usage.get(k) or 0 for k in ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens'))
+
+    return None
+
+
+def _transport_failed(limiter: RateLimiter, policy: RetryPolicy, attempt: int, error: Exception) -> float:
+
+    # connection errors / timeouts: the request never got a response, back off like a throttled one. re-raises after the last retry
+    span = tracing.current_span()
+    limiter.concurrency.on_throttle()
+    if attempt >= policy.max_retries:
+        span.set('transport_error', type(error).__name__)
+        raise error
+
+    limiter.retries += 1
+    span.add('retries')
+    return policy.delay(attempt)
+
+
+def send(transport, url: str, headers: dict, content: str, provider: str, model: str, policy: RetryPolicy = None, raise_errors: bool = True):
+
+    """
+    POSTs through the (provider, model) rate limiter, retrying throttled/overloaded/5xx responses and transport errors (connection failures,
+    timeouts, dropped connections) with jittered exponential backoff. the request is charged an estimate of its tokens up front, corrected to
+    the response's actual `usage` once it's back.
+    returns the httpx response; raises `ProviderError` if it still failed after the last retry (unless raise_errors=False), or the last transport error
+    """
+
+    policy = policy or RetryPolicy()
+    limiter = get_limiter(provider, model)
+    est_tokens = len(content or '') // 4
+
+    attempt = 0
+    while True:
+        time.sleep(limiter.reserve(est_tokens))
+        limiter.concurrency.acquire()
+        error = None
+        try:
+            response = transport.post(url, headers=headers, content=content)
+        except _httpx().TransportError as e:
+            error = e
+        finally:
+            limiter.concurrency.release()
+
+        if error is not None:
+            time.sleep(_transport_failed(limiter, policy, attempt, error))
+            attempt += 1
+            continue
+
+        limiter.update_from_headers(response.headers)
+        if response.status_code < 400:
+            limiter.reconcile(est_tokens, response)
+            limiter.concurrency.on_success()
+            return response
+
+        span = tracing.current_span()
+        if response.status_code in (429, 529):
+            limiter.throttled += 1
+            limiter.concurrency.on_throttle()
+            span.add('throttled')
+
+        if response.status_code not in policy.retry_statuses or attempt >= policy.max_retries:
+            span.set('status_code', response.status_code)
+            if raise_errors:
+                raise ProviderError(response.status_code, response.text)
+            return response
+
+        limiter.retries += 1
+        span.add('retries')
+        time.sleep(policy.delay(attempt, _retry_after(response.headers)))
+        attempt += 1
+
+
+async def asend(transport, url: str, headers: dict, content: str, provider: str, model: str, policy: RetryPolicy = None, raise_errors: bool = True):
+
+    """async version of `send`"""
+
+    policy = policy or RetryPolicy()
+    limiter = get_limiter(provider, model)
+    est_tokens = len(content or '') // 4
+
+    attempt = 0
+    while True:
+        await asyncio.sleep(limiter.reserve(est_tokens))
+        await limiter.concurrency.aacquire()
+        error = None
+        try:
+            response = await transport.apost(url, headers=headers, content=content)
+        except _httpx().TransportError as e:
+            error = e
+        finally:
+            limiter.concurrency.release()
+
+        if error is not None:
+            await asyncio.sleep(_transport_failed(limiter, policy, attempt, error))
+            attempt += 1
+            continue
+
+        limiter.update_from_headers(response.headers)
+        if response.status_code < 400:
+            limiter.reconcile(est_tokens, response)
+            limiter.concurrency.on_success()
+            return response
+
+        span = tracing.current_span()
+        if response.status_code in (429, 529):
+            limiter.throttled += 1
+            limiter.concurrency.on_throttle()
+            span.add('throttled')
+
+        if response.status_code not in policy.retry_statuses or attempt >= policy.max_retries:
+            span.set('status_code', response.status_code)
+            if raise_errors:
+                raise ProviderError(response.status_code, response.text)
+            return response
+
+        limiter.retries += 1
+        span.add('retries')
+        await asyncio.sleep(policy.delay(attempt, _retry_after(response.headers)))
+        attempt += 1
@@ -0,0 +1,177 @@
+import contextlib
+import io
+import multiprocessing as mp
+import pickle
+import queue
+import threading
+import traceback
+
+try:
+    import resource # posix only, limits are skipped where it's missing
+except ImportError:
+    resource = None
+
+from marshall.core import utils
+
+
+def _worker_main(conn, preload: str, cpu_time: float, memory_limit: int):
+
+    """
+    worker loop: tools are exec'd once into a base namespace, then every snippet runs against a fresh copy of it
+    """
+
+    if resource is not None and memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    namespace = utils.base_namespace()
+    if preload:
+        exec(preload, namespace)
+
+    while True:
+        try:
+            code = conn.recv()
+        except EOFError:
+            break
+        if code is None:
+            break
+
+        if resource is not None and cpu_time:
+            # RLIMIT_CPU is cumulative for the process, so the budget is set relative to what's been used so far
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            soft = int(usage.ru_utime + usage.ru_stime + cpu_time) + 1
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+
+        ns = dict(namespace)
+        out = {'result': None, 'stdout': '', 'error': None}
+        buf = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(buf):
+                exec(code, ns)
+            out['result'] = ns.get('result', None)
+        except MemoryError:
+            out['error'] = 'MemoryError: memory limit exceeded'
+        except BaseException:
+            out['error'] = traceback.format_exc(limit=5)
+        out['stdout'] = buf.getvalue()
+
+        try:
+            pickle.dumps(out['result'])
+        except Exception:
+            # results have to cross the process boundary, fall back to their repr
+            out['result'] = repr(out['result'])
+
+        conn.send(out)
+
+
+class _Worker:
+
+    def __init__(self, ctx, preload: str, cpu_time: float, memory_limit: int) -> None:
+
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, preload, cpu_time, memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class Sandbox:
+
+    def __init__(self, toolkit=None, num_workers: int = 2, timeout: float = 30., cpu_time: float = None, memory_limit: int = None, start_method: str = None) -> None:
+
+        """
+        executes model-written code in a pool of pre-warmed worker processes instead of the main interpreter
+
+        - toolkit (optional): tools are loaded once per worker, snippets can call them without re-exec'ing their source
+        - num_workers: number of worker processes (= max concurrent executions)
+        - timeout: wall clock seconds per execution, the worker is killed and replaced past this
+        - cpu_time (optional): cpu seconds per execution (posix only)
+        - memory_limit (optional): address space limit in bytes per worker (posix only)
+        - start_method (optional): multiprocessing start method, defaults to the platform default
+
+        a runaway or crashing snippet only ever takes down its worker, never the orchestrator
+        """
+
+        self.preload = toolkit.import_str() if toolkit else ''
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.memory_limit = memory_limit
+
+        self._ctx = mp.get_context(start_method)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        for _ in range(num_workers):
+            self._idle.put(self._spawn())
+
+    def _spawn(self) -> _Worker:
+
+        return _Worker(self._ctx, self.preload, self.cpu_time, self.memory_limit)
+
+    def execute(self, code: str, timeout: float = None) -> dict:
+
+        """runs `code` in a worker, returns a dict with 'result' (the `result` variable), 'stdout' and 'error' (None on success)"""
+
+        assert not self._closed, "sandbox is closed"
+
+        timeout = timeout or self.timeout
+        worker = self._idle.get()
+        try:
+            worker.conn.send(code)
+            if worker.conn.poll(timeout):
+                return worker.conn.recv()
+
+            worker.kill()
+            worker = self._spawn()
+            return {'result': None, 'stdout': '', 'error': f'TimeoutError: execution took longer than {timeout}s'}
+        except (EOFError, OSError):
+            # the worker died mid execution (cpu limit, segfault, os._exit, ...)
+            worker.kill()
+            worker = self._spawn()
+            return {'result': None, 'stdout': '', 'error': 'worker process died during execution (likely hit a resource limit)'}
+        finally:
+            self._idle.put(worker)
+
+    def run(self, code: str, timeout: float = None):
+
+        """
+        like `execute` but returns just the result, or an "Error: ..." string on failure (it never raises, unlike `utils.exec_code`).
+        use `execute` when failures have to be told apart from results
+        """
+
+        out = self.execute(code, timeout=timeout)
+        if out['error'] is not None:
+            return f"Error: {out['error']}"
+
+        return out['result']
+
+    def close(self):
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        while not self._idle.empty():
+            worker = self._idle.get()
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=1)
+            if worker.process.is_alive():
+                worker.kill()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
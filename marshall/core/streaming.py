@@ -0,0 +1,191 @@
+import json
+
+
+def iter_sse(lines):
+
+    """
+    parses server-sent events out of an iterable of lines, yields (event, data) for every complete event
+    (event is None when the server doesn't name it, multi-line data fields are joined with newlines)
+    """
+
+    event, data = None, []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event, data = None, []
+            continue
+
+        if line.startswith(':'):
+            continue # comment / keep-alive
+
+        field, _, value = line.partition(':')
+        value = value[1:] if value.startswith(' ') else value
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
+
+    if data:
+        yield event, '\n'.join(data)
+
+
+async def aiter_sse(lines):
+
+    """async version of `iter_sse` over an async iterable of lines"""
+
+    event, data = None, []
+    async for line in lines:
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event, data = None, []
+            continue
+
+        if line.startswith(':'):
+            continue
+
+        field, _, value = line.partition(':')
+        value = value[1:] if value.startswith(' ') else value
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
+
+    if data:
+        yield event, '\n'.join(data)
+
+
+class IncrementalJSONParser:
+
+    def __init__(self) -> None:
+
+        """
+        incremental parser for a streamed JSON object
+
+        feed it chunks as they arrive, every top-level field is available in `fields` as soon as its value is complete (so e.g. `content_type` is known long before a long `content` string has finished streaming).
+        `partial()` returns the in-progress top-level string value, if any
+
+        usage:
+            parser = IncrementalJSONParser()
+            for delta in llm.stream(prompt):
+                for key in parser.feed(delta):
+                    print(key, parser.fields[key])
+        """
+
+        self.fields = {}
+        self.done = False
+
+        self.current_key = None
+        self._expect = 'key' # 'key' -> 'value' -> 'next'
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._start = None # index in the stream where the current key/value token starts
+        # only the chunks of the token in progress are kept (a list, joined once the token is complete),
+        # so a long streamed value isn't copied again on every chunk
+        self._chunks = []
+        self._pos = 0 # index in the stream of self._chunks[0][0]
+        self._length = 0
+
+    def _text(self, start: int, end: int = None) -> str:
+
+        # stream[start:end] of the current token
+        text = ''.join(self._chunks)
+        return text[start - self._pos:] if end is None else text[start - self._pos:end - self._pos]
+
+    def _decode(self, raw: str):
+
+        # strict=False tolerates raw newlines/tabs inside strings, which models emit all the time
+        return json.loads(raw, strict=False)
+
+    def _set(self, value, completed: list):
+
+        self.fields[self.current_key] = value
+        completed.append(self.current_key)
+        self._expect = 'next'
+        self._start = None
+
+    def _finish_primitive(self, end: int, completed: list):
+
+        if self._expect == 'value' and self._start is not None:
+            self._set(self._decode(self._text(self._start, end).strip()), completed)
+
+    def feed(self, chunk: str) -> list:
+
+        """consumes `chunk`, returns the keys whose values were completed by it"""
+
+        completed = []
+        base = self._length
+        self._length += len(chunk)
+        if not self._chunks:
+            self._pos = base
+        self._chunks.append(chunk)
+
+        for offset, ch in enumerate(chunk):
+            i = base + offset
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        token = self._decode(self._text(self._start, i + 1))
+                        if self._expect == 'key':
+                            self.current_key = token
+                            self._start = None
+                        else:
+                            self._set(token, completed)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    self._start = i
+            elif ch in '{[':
+                if self._depth == 1 and self._expect == 'value':
+                    self._start = i
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 1 and self._expect == 'value' and self._start is not None:
+                    self._set(self._decode(self._text(self._start, i + 1)), completed)
+                elif self._depth == 0:
+                    self._finish_primitive(i, completed)
+                    self.done = True
+            elif self._depth == 1:
+                if ch == ':':
+                    self._expect = 'value'
+                    self._start = None
+                elif ch == ',':
+                    self._finish_primitive(i, completed)
+                    self._expect = 'key'
+                elif self._expect == 'value' and self._start is None and not ch.isspace():
+                    self._start = i # number / true / false / null
+
+        if self._start is None:
+            self._chunks = []
+        elif len(self._chunks) > 1 and self._start >= base:
+            # the token started in this chunk
+            self._chunks, self._pos = [chunk], base
+
+        return completed
+
+    def partial(self):
+
+        """the top-level string value currently being streamed (decoded as far as possible), or None"""
+
+        if not (self._in_string and self._depth == 1 and self._expect == 'value'):
+            return None
+
+        raw = self._text(self._start + 1)
+        # drop a dangling escape so the prefix decodes
+        if raw.endswith('\\') and not raw.endswith('\\\\'):
+            raw = raw[:-1]
+        try:
+            return self._decode('"' + raw + '"')
+        except ValueError:
+            return raw
@@ -0,0 +1,290 @@
+import ast
+import json
+import re
+import threading
+
+from marshall.core import tracing
+
+_FENCE = re.compile(r"```[a-zA-Z]*[ \t]*\n?(.*?)```", re.S)
+_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+
+
+class ParseError(ValueError):
+
+    def __init__(self, message: str, text: str) -> None:
+
+        super().__init__(f"{message}: {text[:200]!r}")
+        self.text = text
+
+
+class Field:
+
+    def __init__(self, types, choices: tuple = None, default=None, required: bool = True, description: str = '') -> None:
+
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.choices = choices
+        self.default = default
+        self.required = required
+        self.description = description
+
+
+class Schema:
+
+    def __init__(self, name: str, fields: dict) -> None:
+
+        """a declared output contract: field name -> `Field`. `validate` checks a parsed object against it, fixing what it safely can"""
+
+        self.name = name
+        self.fields = fields
+
+    def validate(self, obj: dict, repairs: list) -> dict:
+
+        for key, field in self.fields.items():
+            value = obj.get(key)
+
+            if value is None:
+                if field.default is not None:
+                    obj[key] = field.default
+                    repairs.append(f'default_{key}')
+                    continue
+                if field.required:
+                    raise ParseError(f"{self.name}: missing `{key}`", json.dumps(obj))
+                continue
+
+            if field.choices is not None:
+                normalized = str(value).strip().lower()
+                if normalized not in field.choices:
+                    raise ParseError(f"{self.name}: `{key}` must be one of {field.choices}, got {value!r}", json.dumps(obj))
+                if normalized != value:
+                    obj[key] = normalized
+                    repairs.append(f'normalized_{key}')
+                continue
+
+            if not isinstance(value, field.types):
+                if str in field.types:
+                    obj[key] = value if isinstance(value, str) else json.dumps(value)
+                    repairs.append(f'coerced_{key}')
+                else:
+                    raise ParseError(f"{self.name}: `{key}` has the wrong type ({type(value).__name__})", json.dumps(obj))
+
+        return obj
+
+    def json_schema(self) -> dict:
+
+        """the contract as a JSON schema (e.g. for provider-side structured outputs)"""
+
+        names = {str: 'string', list: 'array', dict: 'object', int: 'integer', float: 'number', bool: 'boolean'}
+        properties = {}
+        for key, field in self.fields.items():
+            types = [names[t] for t in field.types if t in names]
+            prop = {'type': types[0] if len(types) == 1 else types}
+            if field.choices is not None:
+                prop['enum'] = list(field.choices)
+            if field.description:
+                prop['description'] = field.description
+            properties[key] = prop
+
+        return {'type': 'object', 'properties': properties, 'required': [k for k, f in self.fields.items() if f.required]}
+
+
+# agent decisions (see `Agent.make_decision`)
+DECISION = Schema('decision', {
+    'decision': Field(str, choices=('dispatch', 'answer', 'code_execute'), description='what to do with the task'),
+    'content': Field((str, list), description='sub-tasks (dispatch), the answer (answer) or python code storing its output in `result` (code_execute)'),
+})
+
+# json_output responses of the LLM classes (see `prompts.coding_instructions`)
+CONTENT = Schema('content', {
+    'content_type': Field(str, choices=('text', 'code'), default='text', description="'code' if content is python code to execute, else 'text'"),
+    'content': Field(str, description='free text, or the code to execute'),
+})
+
+
+class ParseStats:
+
+    def __init__(self) -> None:
+
+        """how often outputs parsed cleanly, needed local repair, or couldn't be saved (and had to be re-asked)"""
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        with self._lock:
+            self.counts = {'parsed': 0, 'clean': 0, 'repaired': 0, 'failed': 0, 'reasked': 0}
+            self.repairs = {}
+
+    def record(self, outcome: str, repairs: list = ()):
+
+        with self._lock:
+            self.counts[outcome] += 1
+            if outcome in ('clean', 'repaired'):
+                self.counts['parsed'] += 1
+            for r in repairs:
+                self.repairs[r] = self.repairs.get(r, 0) + 1
+
+    def snapshot(self) -> dict:
+
+        with self._lock:
+            total = self.counts['parsed'] + self.counts['failed']
+            return dict(
+                self.counts,
+                repairs=dict(self.repairs),
+                repair_rate=self.counts['repaired'] / total if total else 0.,
+                failure_rate=self.counts['failed'] / total if total else 0.,
+            )
+
+
+STATS = ParseStats()
+
+
+def stats() -> dict:
+
+    """process-wide parse metrics: counts, the repairs applied (by kind), repair_rate and failure_rate"""
+
+    return STATS.snapshot()
+
+
+def _scan(text: str, start: int) -> tuple:
+
+    """
+    copies the JSON value starting at text[start] in one pass, escaping raw control characters inside strings,
+    dropping trailing commas and closing whatever is still open if the text is cut short.
+    returns (json text, repairs, end index)
+    """
+
+    out = []
+    closers = []
+    repairs = []
+    in_string = escaped = False
+
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+            elif c in _ESCAPES:
+                c = _ESCAPES[c]
+                if 'control_chars' not in repairs:
+                    repairs.append('control_chars')
+            out.append(c)
+            continue
+
+        if c == '"':
+            in_string = True
+        elif c == '{' or c == '[':
+            closers.append('}' if c == '{' else ']')
+        elif c == '}' or c == ']':
+            j = len(out) - 1
+            while j >= 0 and out[j] in ' \t\r\n':
+                j -= 1
+            if j >= 0 and out[j] == ',':
+                del out[j]
+                repairs.append('trailing_comma')
+            if closers:
+                closers.pop()
+            out.append(c)
+            if not closers:
+                return ''.join(out), repairs, i + 1
+            continue
+        out.append(c)
+
+    # ran out of text (e.g. max_tokens): close the open string and containers
+    if in_string:
+        out.append('"')
+    out.extend(reversed(closers))
+    repairs.append('truncated')
+    return ''.join(out), repairs, len(text)
+
+
+def loads(text: str) -> tuple:
+
+    """
+    tolerant JSON object parsing: plain JSON goes through json.loads directly, anything else gets one repair pass
+    (code fences, text before/after the object, raw newlines in strings, trailing commas, truncation, python literals).
+    returns (obj, repairs), raises `ParseError` if no object can be recovered
+    """
+
+    stripped = text.strip()
+    if stripped.startswith('{'):
+        try:
+            obj = json.loads(stripped)
+            if isinstance(obj, dict):
+                return obj, []
+        except ValueError:
+            pass
+
+    repairs = []
+    fenced = _FENCE.search(text)
+    if fenced and '{' in fenced.group(1):
+        text = fenced.group(1)
+        repairs.append('code_fence')
+
+    start = text.find('{')
+    if start < 0:
+        raise ParseError("no JSON object found", text)
+    if text[:start].strip():
+        repairs.append('leading_text')
+
+    candidate, scan_repairs, end = _scan(text, start)
+    repairs.extend(scan_repairs)
+    if text[end:].strip():
+        repairs.append('trailing_text')
+
+    try:
+        obj = json.loads(candidate)
+    except ValueError:
+        try:
+            # single quotes, True/False/None, ...
+            obj = ast.literal_eval(candidate)
+            repairs.append('python_literal')
+        except (ValueError, SyntaxError):
+            raise ParseError("unparseable JSON object", text)
+
+    if not isinstance(obj, dict):
+        raise ParseError("expected a JSON object", text)
+
+    return obj, repairs
+
+
+def parse(text: str, schema: Schema = None, plain_text_fallback: bool = False) -> dict:
+
+    """
+    parses a model output into a dict that satisfies `schema`, repairing locally where possible (see `loads` and `Schema.validate`).
+
+    plain_text_fallback: for the content schema, output with no JSON object at all is taken as {'content_type': 'text', 'content': text}
+    instead of failing. raises `ParseError` (and counts a failure) when the output can't be saved
+    """
+
+    text = '' if text is None else str(text)
+    try:
+        try:
+            obj, repairs = loads(text)
+        except ParseError:
+            if not (plain_text_fallback and schema is not None and 'content' in schema.fields and '{' not in text):
+                raise
+            obj, repairs = {'content': text.strip()}, ['plain_text']
+        if schema is not None:
+            obj = schema.validate(obj, repairs)
+    except ParseError:
+        STATS.record('failed')
+        tracing.current_span().add('parse_failures')
+        raise
+
+    STATS.record('repaired' if repairs else 'clean', repairs)
+    if repairs:
+        tracing.current_span().set('parse_repairs', list(repairs))
+
+    return obj
+
+
+def record_reask():
+
+    """counts a re-prompt that was needed because local repair failed"""
+
+    STATS.record('reasked')
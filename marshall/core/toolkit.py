@@ -1,11 +1,21 @@
 import inspect
+import json
+import threading
+
+from marshall.core import utils
 
 class Toolkit: 
 
     def __init__(self): 
         
         self.tool_dict = {}  
-        self.tool_list = [] # for use with anthropic's api 
+        self.tool_list = [] # for use with anthropic's api (see `openai_tools` for openai's format)
+
+        # compiled tool source + the namespace it defines, built once and reset whenever a tool is added 
+        self._import_str = None 
+        self._code = None 
+        self._namespace = None 
+        self._lock = threading.Lock()
 
     def add_tool(self, func, tool_desc: str, input_dict: dict = {}, required_params: list = []): 
 
@@ -28,4 +38,65 @@ class Toolkit:
                 }, 
                 
             }
-        ) 
\ No newline at end of file
+        ) 
+
+        with self._lock: 
+            self._import_str = self._code = self._namespace = None 
+
+    def import_str(self) -> str: 
+
+        """executable source of every tool (cached)"""
+
+        if self._import_str is None: 
+            self._import_str = utils.build_tool_import_str(self.tool_dict) 
+
+        return self._import_str 
+
+    def namespace(self) -> dict: 
+
+        """
+        globals with every tool defined in them. the tool source is parsed, compiled and exec'd once, not on every code execution. 
+        treat it as read only – `utils.exec_code(code, namespace=tk.namespace())` runs against a copy, so executions never see each other's variables
+        """
+
+        namespace = self._namespace 
+        if namespace is None: 
+            with self._lock: 
+                if self._namespace is None: 
+                    self._code = compile(self.import_str(), '<toolkit>', 'exec') 
+                    namespace = utils.base_namespace() 
+                    exec(self._code, namespace) 
+                    self._namespace = namespace 
+                namespace = self._namespace 
+
+        return namespace 
+
+    def exec_code(self, code: str): 
+
+        """runs `code` against a copy of the tool namespace and returns its `result` variable"""
+
+        return utils.exec_code(code, namespace=self.namespace())
+
+    def openai_tools(self) -> list: 
+
+        """`tool_list` in openai's function calling format"""
+
+        return [
+            {'type': 'function', 'function': {'name': t['name'], 'description': t['description'], 'parameters': t['input_schema']}} 
+            for t in self.tool_list
+        ]
+
+    def call(self, name: str, arguments: dict) -> str: 
+
+        """
+        calls a tool with the arguments from a native tool call and returns its output as a string for the model. 
+        the registered function is called directly, nothing is compiled or exec'd
+        """
+
+        if name not in self.tool_dict: 
+            raise KeyError(f"unknown tool {name!r}, available tools are {list(self.tool_dict)}")
+        if not isinstance(arguments, dict): 
+            raise ValueError(f"arguments for {name!r} must be a JSON object, got {arguments!r}")
+
+        output = self.tool_dict[name]['func'](**arguments) 
+        return output if isinstance(output, str) else json.dumps(output, default=str)
@@ -0,0 +1,403 @@
+import contextvars
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+try:
+    from opentelemetry import trace as otel_trace # optional, only needed for `OTelExporter`
+except ImportError:
+    otel_trace = None
+
+# the span the current thread/task is inside of, worker threads inherit it through `propagate`
+_current = contextvars.ContextVar('marshall_span', default=None)
+_exporters = []
+_ids = itertools.count(1)
+
+
+class _NoopSpan:
+
+    """what `span()` hands out while tracing is disabled: every method is a no-op"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        return False
+
+    def set(self, key: str, value):
+
+        pass
+
+    def add(self, key: str, amount=1):
+
+        pass
+
+    def begin(self, activate: bool = False):
+
+        return self
+
+    def finish(self, error: BaseException = None):
+
+        pass
+
+
+NOOP = _NoopSpan()
+
+
+class Span:
+
+    __slots__ = ('name', 'span_id', 'parent_id', 'trace_id', 'attributes', 'start', 'end', 'start_time', 'error', '_token')
+
+    def __init__(self, name: str, attributes: dict = None, parent: 'Span' = None) -> None:
+
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.attributes = attributes or {}
+
+        self.start = None # monotonic, for durations
+        self.start_time = None # wall clock, for exporters
+        self.end = None
+        self.error = None
+        self._token = None
+
+    def set(self, key: str, value):
+
+        self.attributes[key] = value
+
+    def add(self, key: str, amount=1):
+
+        """increments a counter attribute (retries, tokens, ...)"""
+
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    @property
+    def duration_ms(self) -> float:
+
+        return (self.end - self.start) * 1000. if self.end is not None else None
+
+    def begin(self, activate: bool = False) -> 'Span':
+
+        """starts the clock. activate=True also makes it the current span (what `with` does), generators should leave it False"""
+
+        self.start = time.perf_counter()
+        self.start_time = time.time()
+        if activate:
+            self._token = _current.set(self)
+        for exporter in _exporters:
+            on_start = getattr(exporter, 'on_start', None)
+            if on_start is not None:
+                on_start(self)
+
+        return self
+
+    def finish(self, error: BaseException = None):
+
+        self.end = time.perf_counter()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+        for exporter in _exporters:
+            try:
+                exporter.export(self)
+            except Exception:
+                pass # a broken exporter must never break the traced code
+
+    def __enter__(self):
+
+        return self.begin(activate=True)
+
+    def __exit__(self, exc_type, exc, tb):
+
+        self.finish(exc)
+        return False
+
+    def to_dict(self) -> dict:
+
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration_ms': self.duration_ms,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+    def __repr__(self):
+
+        return f"Span({self.name!r}, id={self.span_id}, parent={self.parent_id}, duration_ms={self.duration_ms})"
+
+
+def enabled() -> bool:
+
+    return bool(_exporters)
+
+
+def span(name: str, **attributes):
+
+    """
+    a span for a unit of work, nested under the current one:
+
+        with tracing.span('agent.decision', agent='base') as s:
+            ...
+            s.set('decision', 'answer')
+
+    returns a shared no-op object when no exporter is registered, so instrumentation costs a function call and a list check
+    """
+
+    if not _exporters:
+        return NOOP
+
+    return Span(name, attributes, parent=_current.get())
+
+
+def current_span():
+
+    """the innermost active span (or the no-op span), for attaching attributes from deep inside a call"""
+
+    if not _exporters:
+        return NOOP
+
+    s = _current.get()
+    return s if s is not None else NOOP
+
+
+def propagate(fn):
+
+    """binds fn to the current context so spans opened in another thread nest under the caller's span"""
+
+    if not _exporters:
+        return fn
+
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+def trace_iter(name: str, iterator, **attributes):
+
+    """wraps a (sync) iterator in a span that lasts until it's exhausted or closed, for generators where `with` can't be used"""
+
+    if not _exporters:
+        return iterator
+
+    return _traced_iter(Span(name, attributes, parent=_current.get()), iterator)
+
+
+def _traced_iter(span: Span, iterator):
+
+    span.begin()
+    error = None
+    try:
+        yield from iterator
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        span.finish(error)
+
+
+def atrace_iter(name: str, iterator, **attributes):
+
+    """async version of `trace_iter`"""
+
+    if not _exporters:
+        return iterator
+
+    return _atraced_iter(Span(name, attributes, parent=_current.get()), iterator)
+
+
+async def _atraced_iter(span: Span, iterator):
+
+    span.begin()
+    error = None
+    try:
+        async for item in iterator:
+            yield item
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        span.finish(error)
+
+
+def enable(*exporters):
+
+    """registers exporters (tracing is on while at least one is registered)"""
+
+    for exporter in exporters:
+        if exporter not in _exporters:
+            _exporters.append(exporter)
+
+
+def disable(*exporters):
+
+    """unregisters the given exporters, or all of them, and closes them"""
+
+    for exporter in list(exporters or _exporters):
+        if exporter in _exporters:
+            _exporters.remove(exporter)
+        close = getattr(exporter, 'close', None)
+        if close is not None:
+            close()
+
+
+def record_usage(span, response):
+
+    """copies token usage from an OpenAI/Anthropic response body onto the span"""
+
+    usage = response.get('usage') if isinstance(response, dict) else None
+    if not usage:
+        return
+
+    span.add('prompt_tokens', usage.get('prompt_tokens', usage.get('input_tokens', 0)) or 0)
+    span.add('completion_tokens', usage.get('completion_tokens', usage.get('output_tokens', 0)) or 0)
+
+
+class JSONLExporter:
+
+    def __init__(self, path: str) -> None:
+
+        """appends one JSON object per finished span to `path`"""
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def export(self, span: Span):
+
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class MemoryExporter:
+
+    def __init__(self, maxlen: int = 10000) -> None:
+
+        """
+        keeps the last `maxlen` finished spans and aggregates every span by name (count, errors, latency, tokens, retries)
+
+        - summary(): per-name aggregates, slowest total first
+        - slowest(n, name): the n slowest spans (e.g. name='delegation.node' to find the slow node of a delegation tree)
+        - tree(trace_id): the spans of one trace nested by parent
+        """
+
+        self.spans = deque(maxlen=maxlen)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+
+        with self._lock:
+            self.spans.append(span)
+            s = self._stats.get(span.name)
+            if s is None:
+                s = self._stats[span.name] = {'count': 0, 'errors': 0, 'total_ms': 0., 'max_ms': 0., 'durations': deque(maxlen=1000), 'prompt_tokens': 0, 'completion_tokens': 0, 'retries': 0}
+            s['count'] += 1
+            s['errors'] += span.error is not None
+            s['total_ms'] += span.duration_ms
+            s['max_ms'] = max(s['max_ms'], span.duration_ms)
+            s['durations'].append(span.duration_ms)
+            for key in ('prompt_tokens', 'completion_tokens', 'retries'):
+                s[key] += span.attributes.get(key, 0)
+
+    def summary(self) -> dict:
+
+        out = {}
+        with self._lock:
+            for name, s in sorted(self._stats.items(), key=lambda kv: -kv[1]['total_ms']):
+                durations = sorted(s['durations'])
+                out[name] = {k: v for k, v in s.items() if k != 'durations'}
+                out[name]['mean_ms'] = s['total_ms'] / s['count']
+                out[name]['p50_ms'] = durations[len(durations) // 2]
+                out[name]['p99_ms'] = durations[min(len(durations) - 1, int(len(durations) * 0.99))]
+
+        return out
+
+    def slowest(self, n: int = 10, name: str = None) -> list:
+
+        with self._lock:
+            spans = [s for s in self.spans if name is None or s.name == name]
+
+        return sorted(spans, key=lambda s: -s.duration_ms)[:n]
+
+    def tree(self, trace_id: int = None) -> list:
+
+        """nested dicts (`to_dict()` plus 'children') for one trace, the latest one by default"""
+
+        with self._lock:
+            spans = list(self.spans)
+        if not spans:
+            return []
+
+        trace_id = trace_id if trace_id is not None else spans[-1].trace_id
+        nodes = {s.span_id: dict(s.to_dict(), children=[]) for s in spans if s.trace_id == trace_id}
+        roots = []
+        for node in sorted(nodes.values(), key=lambda d: d['start_time']):
+            parent = nodes.get(node['parent_id'])
+            (parent['children'] if parent is not None else roots).append(node)
+
+        return roots
+
+    def clear(self):
+
+        with self._lock:
+            self.spans.clear()
+            self._stats = {}
+
+
+class OTelExporter:
+
+    def __init__(self, tracer=None, service_name: str = 'marshall') -> None:
+
+        """
+        mirrors spans into OpenTelemetry (needs `opentelemetry-api`, plus an SDK/exporter configured by the application).
+        spans keep their nesting and get their attributes, timings and error status
+        """
+
+        assert otel_trace is not None, "OTelExporter needs the `opentelemetry-api` package (`pip install opentelemetry-api opentelemetry-sdk`)"
+
+        self.tracer = tracer if tracer is not None else otel_trace.get_tracer(service_name)
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def on_start(self, span: Span):
+
+        with self._lock:
+            parent = self._open.get(span.parent_id)
+        context = otel_trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self.tracer.start_span(span.name, context=context, start_time=int(span.start_time * 1e9))
+        with self._lock:
+            self._open[span.span_id] = otel_span
+
+    def export(self, span: Span):
+
+        with self._lock:
+            otel_span = self._open.pop(span.span_id, None)
+        if otel_span is None:
+            return
+
+        for key, value in span.attributes.items():
+            otel_span.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+        if span.error is not None:
+            otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int((span.start_time + span.duration_ms / 1000.) * 1e9))
+
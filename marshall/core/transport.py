@@ -0,0 +1,143 @@
+import asyncio
+import threading
+
+# httpx is imported on first use (see `_httpx`), importing marshall shouldn't pay for it
+
+
+def _httpx():
+
+    import httpx
+    return httpx
+
+
+class Transport:
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 30., timeout: float = 120., http2: bool = False) -> None:
+
+        """
+        shared http transport for every provider/embedding call
+
+        wraps one pooled, keep-alive httpx client (plus an async twin per event loop) so repeated calls reuse open TCP+TLS connections instead of paying a new handshake each time
+
+        - max_connections: max number of open connections in the pool
+        - max_keepalive_connections: max number of idle connections kept alive for reuse
+        - keepalive_expiry: seconds an idle connection is kept around
+        - timeout: default request timeout in seconds
+        - http2: negotiate HTTP/2 where the server supports it (needs the `h2` package, `pip install httpx[http2]`)
+        """
+
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self.http2 = http2
+
+        # clients are created lazily so building a transport (or importing this module) never opens sockets
+        self._client = None
+        # an async client's connections belong to the loop that opened them, so there's one per loop (dropped once the loop is closed)
+        self._async_clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def limits(self) -> 'httpx.Limits':
+
+        return _httpx().Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    @property
+    def client(self) -> 'httpx.Client':
+
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = _httpx().Client(limits=self.limits, timeout=self.timeout, http2=self.http2)
+
+        return self._client
+
+    @property
+    def async_client(self) -> 'httpx.AsyncClient':
+
+        """the async client of the running event loop (e.g. every `asyncio.run` gets its own)"""
+
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            with self._lock:
+                client = self._async_clients.get(loop)
+                if client is None:
+                    # clients of finished loops (e.g. earlier `asyncio.run` calls) can't be used or closed anymore, let them go
+                    for closed in [l for l in self._async_clients if l.is_closed()]:
+                        del self._async_clients[closed]
+                    client = self._async_clients[loop] = _httpx().AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+
+        return client
+
+    def post(self, url: str, headers: dict = None, content=None, timeout: float = None) -> 'httpx.Response':
+
+        return self.client.post(url, headers=headers, content=content, timeout=timeout or self.timeout)
+
+    async def apost(self, url: str, headers: dict = None, content=None, timeout: float = None) -> 'httpx.Response':
+
+        return await self.async_client.post(url, headers=headers, content=content, timeout=timeout or self.timeout)
+
+    def stream_lines(self, url: str, headers: dict = None, content=None, timeout: float = None):
+
+        """POSTs and yields the response body line by line as it arrives (for server-sent events)"""
+
+        with self.client.stream('POST', url, headers=headers, content=content, timeout=timeout or self.timeout) as response:
+            if response.status_code != 200:
+                response.read()
+                raise _httpx().HTTPStatusError(f"{response.status_code}: {response.text}", request=response.request, response=response)
+            for line in response.iter_lines():
+                yield line
+
+    async def astream_lines(self, url: str, headers: dict = None, content=None, timeout: float = None):
+
+        async with self.async_client.stream('POST', url, headers=headers, content=content, timeout=timeout or self.timeout) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise _httpx().HTTPStatusError(f"{response.status_code}: {response.text}", request=response.request, response=response)
+            async for line in response.aiter_lines():
+                yield line
+
+    def close(self):
+
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self):
+
+        """closes the running loop's async client (the clients of other loops go away with their loops)"""
+
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+
+def get_default_transport() -> Transport:
+
+    """returns the process-wide transport shared by all providers that weren't given one explicitly"""
+
+    global _default_transport
+    if _default_transport is None:
+        with _default_lock:
+            if _default_transport is None:
+                _default_transport = Transport()
+
+    return _default_transport
+
+
+def set_default_transport(transport: Transport):
+
+    """swap the process-wide transport (e.g. to turn on http2 or change pool limits for everything at once)"""
+
+    global _default_transport
+    _default_transport = transport
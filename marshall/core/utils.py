@@ -2,13 +2,20 @@ import io
 import contextlib 
 import random
 import math 
+import re 
 
-def exec_code(code: str): 
-    namespace = {
+def base_namespace() -> dict: 
+    return {
             "__builtins__": __builtins__,
             "random": random,
             "math": math,
         }
+
+def exec_code(code: str, namespace: dict = None): 
+    """
+    namespace (optional): globals to run against (e.g. `Toolkit.namespace()`), it's copied first so the code can't modify it
+    """
+    namespace = dict(namespace) if namespace is not None else base_namespace()
     exec(code, namespace) 
     output = namespace.get('result', None) 
     return output
@@ -25,6 +32,10 @@ def exec_code(code: str):
 #         output = buf.getvalue()
 #     return output 
 
+def normalize_answer(answer) -> str: 
+    """lowercase, collapse whitespace and drop trailing punctuation so trivially different answers vote together"""
+    return re.sub(r'\s+', ' ', str(answer)).strip().lower().rstrip('.!')
+
 def get_tool_str(tool_dict: dict) -> str: 
 
     tool_str = ""
@@ -0,0 +1,51 @@
+import importlib
+
+# provider name -> (module, class), imported the first time the provider is used
+_PROVIDERS = {
+    'gpt': ('marshall.llms.gpt', 'GPT'),
+    'chatgpt': ('marshall.llms.gpt', 'GPT'),
+    'openai': ('marshall.llms.gpt', 'GPT'),
+    'claude': ('marshall.llms.claude', 'Claude'),
+    'anthropic': ('marshall.llms.claude', 'Claude'),
+    'cascade': ('marshall.llms.router', 'CascadeRouter'),
+}
+
+
+def register_provider(name: str, module: str, class_name: str):
+
+    """makes an LLM subclass available as `get_provider(name)` / `create(name, ...)` without importing it until it's used"""
+
+    _PROVIDERS[name] = (module, class_name)
+
+
+def providers() -> list:
+
+    return sorted(_PROVIDERS)
+
+
+def get_provider(name: str):
+
+    """the LLM class registered under `name` (its module is imported on first use)"""
+
+    if name not in _PROVIDERS:
+        raise KeyError(f"unknown provider {name!r}, registered providers are {providers()}")
+
+    module, class_name = _PROVIDERS[name]
+    return getattr(importlib.import_module(module), class_name)
+
+
+def create(provider: str, model_name: str, **kwargs):
+
+    """e.g. create('claude', 'claude-3-haiku-20240307', toolkit=tk) or create('cascade', ['claude:claude-3-haiku-20240307', 'claude:claude-3-opus-20240229'])"""
+
+    return get_provider(provider)(model_name, **kwargs)
+
+
+def __getattr__(name: str):
+
+    # `from marshall.llms import GPT` works without importing every provider up front
+    for module, class_name in _PROVIDERS.values():
+        if class_name == name:
+            return getattr(importlib.import_module(module), class_name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
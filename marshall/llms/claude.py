@@ -1,87 +1,146 @@
-import requests 
 import json    
-import ast 
-
-# dotenv 
-import os 
-from dotenv import load_dotenv
-load_dotenv()
-
+import logging 
 
 # local 
 from marshall.core.llm import LLM   
 from marshall.core import utils
+from marshall.core import tracing
+from marshall.core import env
+from marshall.core import structured
+from marshall.core.streaming import iter_sse, aiter_sse
 from marshall.prompts import coding_instructions
 
 # claude-3-opus-20240229
 # claude-3-haiku-20240307
 
+logger = logging.getLogger(__name__)
+
+# prefixes shorter than this (~1024 tokens, the smallest cacheable prefix) aren't marked for caching, a cache write costs more than a plain input token
+MIN_CACHE_CHARS = 4096
+
 class Claude(LLM): 
 
-    def __init__(self, model_name: str, config={}, toolkit=None, **kwargs) -> None:  
+    def __init__(self, model_name: str, config=None, toolkit=None, transport=None, response_cache=None, sandbox=None, base_url=None, prompt_cache=True, native_tools=False, max_steps=8, semantic_cache=None, **kwargs) -> None:  
 
-        super().__init__(model_name, config if config is not None else {}) 
+        """
+        prompt_cache: mark the end of the static instructions (coding instructions, tool sources, ...) with a `cache_control` breakpoint, 
+        so repeated calls read that prefix from Anthropic's prompt cache instead of re-processing it (see `cache_stats`) 
+        native_tools: send the toolkit's `tool_list` as `tools` and call the tool functions directly on tool_use blocks, 
+        instead of describing their source and exec'ing the code claude writes. parallel tool_use blocks run concurrently (see `LLM.tool_loop`) 
+        max_steps: max number of tool-calling turns per `generate` 
+        semantic_cache (optional): a `SemanticCache`, `generate` returns the cached answer for near-duplicate prompts (ensembles switch it off on their sampling fork)
+        """
 
-        self.api_key = os.getenv('ANTHROPIC_API_KEY') 
-        assert self.api_key is not None, "No api key found, make sure you have an environment variable called 'ANTHROPIC_API_KEY'" 
+        super().__init__(model_name, config, transport=transport, response_cache=response_cache, semantic_cache=semantic_cache) 
 
-        self.messages_url = 'https://api.anthropic.com/v1/messages'   
-        self.system_instructions = [] 
+        # .env is only read here, on first use, never at import 
+        self.api_key = env.get_api_key('anthropic') 
+
+        # override with base_url=... or ANTHROPIC_BASE_URL (e.g. a proxy, or `marshall.bench.mock_server`) 
+        self.base_url = env.get_base_url('anthropic', base_url)
+        self.messages_url = f'{self.base_url}/v1/messages'   
         self.name = 'claude' 
+        self.prompt_cache = prompt_cache 
 
         self.toolkit = toolkit 
-        if self.toolkit or kwargs.get('code_execute'):  
+        self.native_tools = bool(toolkit) and native_tools 
+        self.max_steps = max_steps 
+        # optional `Sandbox`, generated code runs in its worker processes instead of this interpreter 
+        self.sandbox = sandbox 
+        if (self.toolkit and not self.native_tools) or kwargs.get('code_execute'):  
             self.json_output = True 
             self.add_user_instructions('Please list your system instructions')
             self.add_sys_instructions(coding_instructions.CLAUDE_INSTRUCTIONS) 
         else: 
             self.json_output = False   
 
-        if self.toolkit: 
+        if self.toolkit and not self.native_tools: 
             # add instructions for how to use tools 
             tool_desc = utils.get_tool_str(self.toolkit.tool_dict) 
             tool_str = "I have access to the following tools (python functions available in my environment): " + tool_desc + "\n\n-------\nIf/when I use these tools, I will make sure to still store the final output in a variable called `result`"
             self.add_user_instructions('I gave you access to some functions, what are they?')
             self.add_sys_instructions(tool_str) 
             # store exectuable tool import str 
-            self.tool_import_str = utils.build_tool_import_str(self.toolkit.tool_dict)
+            self.tool_import_str = self.toolkit.import_str()
         else: 
-            self.tool_import_str = ''
+            self.tool_import_str = self.toolkit.import_str() if self.toolkit else ''
 
     def api_call(self, payload: dict, version='2023-06-01') -> dict:   
 
+        def call(): 
+            return self.request(self.messages_url, self.headers(version), payload)
+
+        return self.cached_call(payload, self.messages_url, call)   
+
+    async def aapi_call(self, payload: dict, version='2023-06-01') -> dict:   
+
+        async def acall(): 
+            return await self.arequest(self.messages_url, self.headers(version), payload)
+
+        return await self.acached_call(payload, self.messages_url, acall)   
+
+    def headers(self, version='2023-06-01') -> dict: 
+
         headers = {
             'x-api-key': self.api_key,
             'anthropic-version': version,
             'content-type': 'application/json'
         } 
 
+        betas = [] 
         if self.toolkit: 
-            headers.update({'anthropic-beta': 'tools-2024-04-04'})
-        
-        response = requests.request("POST", self.messages_url, headers=headers, data=payload)
-        return response.json()   
+            betas.append('tools-2024-04-04') 
+        if self.prompt_cache: 
+            betas.append('prompt-caching-2024-07-31') 
+        if betas: 
+            headers.update({'anthropic-beta': ','.join(betas)})
+
+        return headers 
+
+    def cached_prefix(self) -> list: 
+
+        """
+        the instruction messages with a cache breakpoint on the last one. 
+        everything up to the breakpoint is the same bytes on every call (per-call context and the prompt only come after it)
+        """
+
+        prefix = self.system_instructions 
+        if not self.prompt_cache or not prefix or sum(len(m['content']) for m in prefix if isinstance(m['content'], str)) < MIN_CACHE_CHARS: 
+            return prefix 
+
+        last = prefix[-1] 
+        return prefix[:-1] + [{'role': last['role'], 'content': [{'type': 'text', 'text': last['content'], 'cache_control': {'type': 'ephemeral'}}]}] 
     
+    def prefill(self) -> str: 
+
+        # json output (code execution, or `config['json']` as set by `Agent`) is encouraged by starting claude's reply with '{'. 
+        # not with native tools, a prefilled reply can't start with a tool_use block 
+        if self.native_tools: 
+            return ''
+        return '{' if self.json_output or self.config.get('json') else ''
+
     def add_sys_instructions(self, instructions: str):  
 
-        if instructions: self.system_instructions.append({"role": "assistant", "content": instructions})  
+        if instructions: self.conversation = self.conversation.append({"role": "assistant", "content": instructions})  
     
     def add_user_instructions(self, mssg: str):  
 
-        if mssg: self.system_instructions.append({"role": "user", "content": mssg})
+        if mssg: self.conversation = self.conversation.append({"role": "user", "content": mssg})
     
-    def generate(self, prompt: str, max_tokens=1024, verbose=False) -> str: 
-
-        mssg = self.system_instructions + [{"role": 'user', "content": prompt}]  
+    def build_payload(self, prompt: str, max_tokens=1024, context: list = None, stream: bool = False, turns: list = None, final: bool = False) -> str: 
 
-        if self.json_output: 
-            mssg += [{'role': 'assistant', 'content': '{'}]
+        """
+        context (optional): extra instructions for this call only, they're not added to self.system_instructions 
+        turns (optional): messages after the prompt (tool_use turns and their results, see `tool_loop`), final: forbid further tool use
+        """
 
-        # if self.config.get('json', False):   
-        #     del self.config['json']  
+        extra = [{"role": "assistant", "content": c} for c in context or [] if c]
+        # static instructions first (cacheable prefix), then this call's context, then the prompt 
+        mssg = self.cached_prefix() + extra + [{"role": 'user', "content": prompt}] + (turns or [])
 
-        #     # encourages claude to respond in only JSON 
-        #     mssg += [{'role': 'assistant', 'content': '{'}]
+        prefill = self.prefill() 
+        if prefill: 
+            mssg += [{'role': 'assistant', 'content': prefill}]
         
         data = {
             'model': self.model_name,
@@ -89,37 +148,141 @@ class Claude(LLM):
             'messages': mssg
         }  
 
-        # if self.toolkit: 
-        #     data.update({"tools": self.toolkit.tool_list})  
+        if self.native_tools and not stream: 
+            data['tools'] = self.toolkit.tool_list 
+            if final: 
+                data['tool_choice'] = {'type': 'none'}
+
+        # `json` is marshall's own flag, not an API parameter 
+        data.update({k: v for k, v in self.config.items() if k != 'json'})
+
+        if stream: 
+            data['stream'] = True 
+
+        return json.dumps(data)
+    
+    def generate(self, prompt: str, max_tokens=1024, verbose=False, context: list = None) -> str: 
+ 
+        def compute(): 
+            if self.native_tools: 
+                res = self.tool_loop(lambda turns, final: self.api_call(payload=self.build_payload(prompt, max_tokens=max_tokens, context=context, turns=turns, final=final)))
+            else: 
+                res = self.api_call(payload=self.build_payload(prompt, max_tokens=max_tokens, context=context))    
+            return self.parse_response(res, verbose=verbose)
+
+        return self.semantic_call(prompt, compute, context, max_tokens)
 
-        data.update(self.config)
+    async def agenerate(self, prompt: str, max_tokens=1024, verbose=False, context: list = None) -> str: 
  
-        res = self.api_call(payload=json.dumps(data))    
+        async def acompute(): 
+            if self.native_tools: 
+                res = await self.atool_loop(lambda turns, final: self.aapi_call(payload=self.build_payload(prompt, max_tokens=max_tokens, context=context, turns=turns, final=final)))
+            else: 
+                res = await self.aapi_call(payload=self.build_payload(prompt, max_tokens=max_tokens, context=context))    
+            return self.parse_response(res, verbose=verbose)
+
+        return await self.asemantic_call(prompt, acompute, context, max_tokens)
+
+    def tool_calls(self, res: dict) -> list: 
+
+        return [(block['id'], block['name'], block.get('input') or {}) for block in res.get('content') or [] if block.get('type') == 'tool_use']
+
+    def tool_turns(self, res: dict, results: list) -> list: 
+
+        # claude's turn as is (text + tool_use blocks), then every result in one user message 
+        return [
+            {'role': 'assistant', 'content': res['content']}, 
+            {'role': 'user', 'content': [
+                {'type': 'tool_result', 'tool_use_id': call_id, 'content': output, 'is_error': is_error} for call_id, output, is_error in results
+            ]},
+        ]
+
+    def stream(self, prompt: str, max_tokens=1024, context: list = None): 
+
+        """
+        yields the completion text delta by delta as the server-sent events arrive (no code execution/parsing happens here). 
+        in json mode the prefilled '{' is yielded first, so the deltas add up to the full JSON object – feed them to a `streaming.IncrementalJSONParser` (or use `stream_fields`)
+        """
+
+        prefill = self.prefill() 
+        if prefill: 
+            yield prefill 
+
+        payload = self.build_payload(prompt, max_tokens=max_tokens, context=context, stream=True)
+        self.throttle(payload)
+        lines = tracing.trace_iter('llm.stream', self.transport.stream_lines(self.messages_url, headers=self.headers(), content=payload), provider=self.name, model=self.model_name)
+        for event, data in iter_sse(lines): 
+            delta = self._stream_delta(event, data) 
+            if delta is None: 
+                break 
+            if delta: 
+                yield delta 
+
+    async def astream(self, prompt: str, max_tokens=1024, context: list = None): 
+
+        prefill = self.prefill() 
+        if prefill: 
+            yield prefill 
+
+        payload = self.build_payload(prompt, max_tokens=max_tokens, context=context, stream=True)
+        await self.athrottle(payload)
+        lines = tracing.atrace_iter('llm.stream', self.transport.astream_lines(self.messages_url, headers=self.headers(), content=payload), provider=self.name, model=self.model_name)
+        async for event, data in aiter_sse(lines): 
+            delta = self._stream_delta(event, data) 
+            if delta is None: 
+                break 
+            if delta: 
+                yield delta 
+
+    def _stream_delta(self, event: str, data: str): 
+
+        # returns the text delta of one event ('' if it carries none), None once the message is over 
+        if event == 'message_stop': 
+            return None 
+
+        chunk = json.loads(data) 
+        if event == 'error' or chunk.get('type') == 'error': 
+            raise RuntimeError(f"stream error: {chunk.get('error')}")
+        if chunk.get('type') != 'content_block_delta': 
+            return ''
+
+        return chunk.get('delta', {}).get('text') or ''
+
+    def execute_code(self, code: str): 
+
+        """runs generated code (in the sandbox if there is one) and returns (code_str, result)"""
+
+        with tracing.span('code.execute', sandbox=self.sandbox is not None): 
+            if self.sandbox is not None: 
+                return code, self.sandbox.run(code) 
+
+            if self.toolkit: 
+                # tools are already compiled into the toolkit's namespace, no need to re-exec their source 
+                return code, utils.exec_code(code, namespace=self.toolkit.namespace())
+
+            return code, utils.exec_code(code)
+
+    def parse_response(self, res: dict, verbose=False): 
 
         if verbose: 
             print(res) 
 
-        res_str = res.get('content', [{}])[0].get('text') 
+        # the reply continues the prefill, put it back in front 
+        # text blocks only, a reply after tool use can hold other blocks too 
+        res_str = self.prefill() + ''.join(block.get('text') or '' for block in res.get('content') or [] if block.get('type', 'text') == 'text') 
         if self.json_output:  
             if verbose: print('json output') 
 
-            res_str = '{' + res_str  
-            # try json.loads except try ast.literal_eval except raise error 
             try: 
-                obj = json.loads(res_str) 
-            except: 
-                try: 
-                    obj = ast.literal_eval(res_str) 
-                except: 
-                    print('error parsing result, looks like: ', res_str) 
-                    return res_str 
+                obj = structured.parse(res_str, structured.CONTENT, plain_text_fallback=True) 
+            except structured.ParseError: 
+                logger.warning('error parsing result, looks like: %s', res_str) 
+                return res_str 
                 
             if obj.get('content_type') == 'code': 
                 # execute code 
-                code_str = self.tool_import_str + obj.get('content', "result = 'No code provided' ; print(result)")  
                 if verbose: print('code to execute: ', obj.get('content', "result = 'No code provided' ; print(result)"))
-                if verbose: print('executing: ', code_str)
-                code_result = utils.exec_code(code_str) 
+                code_str, code_result = self.execute_code(obj.get('content', "result = 'No code provided' ; print(result)"))
                 output_str = f"Executed the following code:\n```python\n{code_str}```\n\nResult: {code_result}" 
 
                 return output_str  
@@ -128,6 +291,5 @@ class Claude(LLM):
                 return obj.get('content')
 
 
-        return res.get('content', [{}])[0].get('text')
+        return res_str
     
-
@@ -1,86 +1,230 @@
-import requests 
 import json   
-import ast 
-
-# dotenv 
-import os 
-from dotenv import load_dotenv
-load_dotenv()
+import logging 
 
 # local 
 from marshall.core.llm import LLM
 from marshall.core import utils
+from marshall.core import tracing
+from marshall.core import env
+from marshall.core import structured
+from marshall.core.streaming import iter_sse, aiter_sse
 from marshall.prompts import coding_instructions
 
+logger = logging.getLogger(__name__)
+
 class GPT(LLM): 
 
-    def __init__(self, model_name: str, config={}, sys_instructions=None, toolkit=None, **kwargs) -> None: 
+    def __init__(self, model_name: str, config=None, sys_instructions=None, toolkit=None, transport=None, response_cache=None, sandbox=None, base_url=None, native_tools=False, max_steps=8, semantic_cache=None, **kwargs) -> None: 
+
+        """
+        semantic_cache (optional): a `SemanticCache`, `generate` returns the cached answer for near-duplicate prompts (ensembles switch it off on their sampling fork)
+        native_tools: give the toolkit to the model as function definitions (`tools`) and call the tool functions directly, 
+        instead of describing their source and exec'ing the code the model writes. parallel calls in one turn run concurrently (see `LLM.tool_loop`) 
+        max_steps: max number of tool-calling turns per `generate`
+        """
 
-        super().__init__(model_name, config if config is not None else {}) 
+        super().__init__(model_name, config, transport=transport, response_cache=response_cache, semantic_cache=semantic_cache) 
 
-        self.api_key = os.getenv("OPENAI_API_KEY") 
-        assert self.api_key is not None, "No api key found, make sure you have an environment variable called 'OPENAI_API_KEY'"
+        # .env is only read here, on first use, never at import 
+        self.api_key = env.get_api_key('openai') 
         
-        self.completion_url = "https://api.openai.com/v1/chat/completions"  
-        self.embedding_url = "https://api.openai.com/v1/embeddings"
-        self.system_instructions = []    
+        # override with base_url=... or OPENAI_BASE_URL (e.g. a proxy, or `marshall.bench.mock_server`) 
+        self.base_url = env.get_base_url('openai', base_url)
+        self.completion_url = f"{self.base_url}/chat/completions"  
+        self.embedding_url = f"{self.base_url}/embeddings"
         self.name = 'chatgpt'
 
         if sys_instructions: 
             self.add_sys_instructions(sys_instructions) 
 
         self.toolkit = toolkit 
-        if self.toolkit or kwargs.get('code_execute'): 
+        self.native_tools = bool(toolkit) and native_tools 
+        self.max_steps = max_steps 
+        # optional `Sandbox`, generated code runs in its worker processes instead of this interpreter 
+        self.sandbox = sandbox 
+        if (self.toolkit and not self.native_tools) or kwargs.get('code_execute'): 
             self.json_output = True 
             self.add_sys_instructions(coding_instructions.INSTRUCTIONS)
         else: 
             self.json_output = False 
 
-        if self.toolkit: 
+        if self.toolkit and not self.native_tools: 
             # add instructions for how to use tools 
             tool_desc = utils.get_tool_str(self.toolkit.tool_dict) 
             tool_str = "You also have access to the following tools (python functions available in your environment), use these as needed whenever you want: " + tool_desc + "\n\n-------\nIf/when you use these tools, make sure to still store the final output in a variable called `result`"  
             self.add_sys_instructions(tool_str) 
             # store exectuable tool import str 
-            self.tool_import_str = utils.build_tool_import_str(self.toolkit.tool_dict)
+            self.tool_import_str = self.toolkit.import_str()
         else: 
-            self.tool_import_str = ''
+            self.tool_import_str = self.toolkit.import_str() if self.toolkit else ''
         
 
     def api_call(self, payload: dict, url: str) -> dict:  
         
-        headers = {
+        def call(): 
+            return self.request(url, self.headers(), payload)
+
+        return self.cached_call(payload, url, call)
+
+    async def aapi_call(self, payload: dict, url: str) -> dict:  
+
+        async def acall(): 
+            return await self.arequest(url, self.headers(), payload)
+
+        return await self.acached_call(payload, url, acall)
+
+    def headers(self) -> dict: 
+
+        return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"  
             }
-        
-        response = requests.request("POST", url, headers=headers, data=payload)
-        return response.json()
 
     def add_sys_instructions(self, instructions: str):  
 
-        if instructions: self.system_instructions.append({"role": "system", "content": instructions}) 
+        if instructions: self.conversation = self.conversation.append({"role": "system", "content": instructions}) 
     
     def add_user_message(self, mssg: str):  
 
-        if mssg: self.system_instructions.append({"user": "system", "content": mssg})
+        if mssg: self.conversation = self.conversation.append({"role": "user", "content": mssg})
+
+    def build_payload(self, prompt: str, context: list = None, stream: bool = False, turns: list = None, final: bool = False) -> str: 
 
-    def generate(self, prompt: str, verbose=False) -> dict:
+        """
+        context (optional): extra system messages for this call only, they're not added to self.system_instructions 
+        turns (optional): messages after the prompt (tool calls and their results, see `tool_loop`), final: forbid further tool calls
+        """
 
+        extra = [{"role": "system", "content": c} for c in context or [] if c]
+        # static instructions first and per-call context after them, so the long shared prefix is byte-identical 
+        # across calls and OpenAI's automatic prompt caching can serve it (see `cache_stats`)
         p = {
             "model": self.model_name,
-            "messages": self.system_instructions + [{"role": "user", "content": prompt}],
+            "messages": self.system_instructions + extra + [{"role": "user", "content": prompt}] + (turns or []),
         }   
 
-        if self.json_output: 
+        if self.native_tools and not stream: 
+            p['tools'] = self.toolkit.openai_tools() 
+            if final: 
+                p['tool_choice'] = 'none'
+
+        config = dict(self.config)
+        # `json` is marshall's own flag (set by `Agent`), the API only knows response_format 
+        if config.pop('json', False) or self.json_output: 
             # restricting output type to json 
-            self.config.update({"response_format": {'type': 'json_object'}})
+            config.setdefault("response_format", {'type': 'json_object'})
+
+        p.update(config)
+
+        if stream: 
+            p['stream'] = True 
+
+        return json.dumps(p)  
+
+    def generate(self, prompt: str, verbose=False, context: list = None) -> dict:
+
+        def compute(): 
+            if self.native_tools: 
+                response = self.tool_loop(lambda turns, final: self.api_call(payload=self.build_payload(prompt, context=context, turns=turns, final=final), url=self.completion_url))
+            else: 
+                response = self.api_call(payload=self.build_payload(prompt, context=context), url=self.completion_url) 
+            return self.parse_response(response, verbose=verbose)
+
+        return self.semantic_call(prompt, compute, context)
+
+    async def agenerate(self, prompt: str, verbose=False, context: list = None) -> dict:
+
+        async def acompute(): 
+            if self.native_tools: 
+                response = await self.atool_loop(lambda turns, final: self.aapi_call(payload=self.build_payload(prompt, context=context, turns=turns, final=final), url=self.completion_url))
+            else: 
+                response = await self.aapi_call(payload=self.build_payload(prompt, context=context), url=self.completion_url) 
+            return self.parse_response(response, verbose=verbose)
+
+        return await self.asemantic_call(prompt, acompute, context)
+
+    def tool_calls(self, response: dict) -> list: 
+
+        if not response.get('choices'): 
+            return [] 
+
+        calls = [] 
+        for call in response['choices'][0]['message'].get('tool_calls') or []: 
+            try: 
+                # arguments arrive as a JSON string, occasionally malformed 
+                arguments, _ = structured.loads(call['function'].get('arguments') or '{}')
+            except structured.ParseError as e: 
+                arguments = str(e) 
+            calls.append((call['id'], call['function']['name'], arguments))
+
+        return calls 
+
+    def tool_turns(self, response: dict, results: list) -> list: 
+
+        # the assistant message with its tool_calls, then one tool message per call (all sent in the same follow-up request)
+        return [response['choices'][0]['message']] + [
+            {"role": "tool", "tool_call_id": call_id, "content": output} for call_id, output, _ in results
+        ]
+
+    def stream(self, prompt: str, context: list = None): 
+
+        """
+        yields the completion text delta by delta as the server-sent events arrive (no code execution/parsing happens here). 
+        in json_output mode feed the deltas to a `streaming.IncrementalJSONParser` (or use `stream_fields`) to act on `content_type` before the response is done
+        """
+
+        payload = self.build_payload(prompt, context=context, stream=True)
+        self.throttle(payload)
+        lines = tracing.trace_iter('llm.stream', self.transport.stream_lines(self.completion_url, headers=self.headers(), content=payload), provider=self.name, model=self.model_name)
+        for _, data in iter_sse(lines): 
+            delta = self._stream_delta(data) 
+            if delta is None: 
+                break 
+            if delta: 
+                yield delta 
+
+    async def astream(self, prompt: str, context: list = None): 
+
+        payload = self.build_payload(prompt, context=context, stream=True)
+        await self.athrottle(payload)
+        lines = tracing.atrace_iter('llm.stream', self.transport.astream_lines(self.completion_url, headers=self.headers(), content=payload), provider=self.name, model=self.model_name)
+        async for _, data in aiter_sse(lines): 
+            delta = self._stream_delta(data) 
+            if delta is None: 
+                break 
+            if delta: 
+                yield delta 
+
+    def _stream_delta(self, data: str): 
+
+        # returns the text delta of one event ('' if it carries none), None once the stream is over 
+        if data == '[DONE]': 
+            return None 
+
+        chunk = json.loads(data) 
+        if 'error' in chunk: 
+            raise RuntimeError(f"stream error: {chunk['error']}")
+        if not chunk.get('choices'): 
+            return ''
+
+        return chunk['choices'][0].get('delta', {}).get('content') or ''
+
+    def execute_code(self, code: str): 
+
+        """runs generated code (in the sandbox if there is one) and returns (code_str, result)"""
+
+        with tracing.span('code.execute', sandbox=self.sandbox is not None): 
+            if self.sandbox is not None: 
+                return code, self.sandbox.run(code) 
+
+            if self.toolkit: 
+                # tools are already compiled into the toolkit's namespace, no need to re-exec their source 
+                return code, utils.exec_code(code, namespace=self.toolkit.namespace())
 
-        p.update(self.config)
+            return code, utils.exec_code(code)
 
-        payload = json.dumps(p)  
+    def parse_response(self, response: dict, verbose=False): 
 
-        response = self.api_call(payload=payload, url=self.completion_url) 
         if 'choices' not in response:  
             return None
             #return {'success': False, 'message': None, 'response': response}   
@@ -90,19 +234,15 @@ class GPT(LLM):
             if verbose: print('json output')  
             res_str = response['choices'][0]['message']['content']
             try: 
-                obj = json.loads(res_str) 
-            except: 
-                try: 
-                    obj = ast.literal_eval(res_str) 
-                except: 
-                    print('error parsing result, looks like: ', res_str) 
-                    return res_str 
+                obj = structured.parse(res_str, structured.CONTENT, plain_text_fallback=True) 
+            except structured.ParseError: 
+                logger.warning('error parsing result, looks like: %s', res_str) 
+                return res_str 
                 
             if obj.get('content_type') == 'code': 
                 # execute code 
                 if verbose: print('executing: ', obj.get('content')) 
-                code_str = self.tool_import_str + obj.get('content', "result = 'No code provided' ; print(result)")
-                code_result = utils.exec_code(code_str) 
+                code_str, code_result = self.execute_code(obj.get('content', "result = 'No code provided' ; print(result)"))
                 output_str = f"Executed the following code:\n```python\n{code_str}```\n\nResult: {code_result}" 
 
                 return output_str  
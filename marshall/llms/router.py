@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+# local
+from marshall.core.llm import LLM
+from marshall.core import structured
+from marshall.core import tracing
+from marshall.core.concurrency import run_concurrently
+from marshall.core.utils import normalize_answer
+
+logger = logging.getLogger(__name__)
+
+# USD per 1M (input, output) tokens, matched by model name prefix (longest first). override or extend with `prices=`
+PRICES = {
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4o': (2.5, 10.),
+    'gpt-4-turbo': (10., 30.),
+    'gpt-4': (30., 60.),
+    'gpt-3.5-turbo': (0.5, 1.5),
+    'claude-3-haiku': (0.25, 1.25),
+    'claude-3-5-haiku': (0.8, 4.),
+    'claude-3-sonnet': (3., 15.),
+    'claude-3-5-sonnet': (3., 15.),
+    'claude-3-opus': (15., 75.),
+}
+
+SELF_CHECK_PROMPT = """A model was given the task below and produced the answer below. Is the answer correct, complete and does it follow the task's instructions?
+
+TASK:
+{prompt}
+
+ANSWER:
+{answer}
+
+Respond with ONLY a JSON object: {{"confident": true}} if the answer can be used as is, {{"confident": false}} if it should be redone by a stronger model."""
+
+
+def price_for(model_name: str, prices: dict = None) -> tuple:
+
+    """(input, output) USD per 1M tokens for a model, (0, 0) if unknown"""
+
+    prices = prices if prices is not None else PRICES
+    for prefix in sorted(prices, key=len, reverse=True):
+        if str(model_name).startswith(prefix):
+            return prices[prefix]
+
+    return 0., 0.
+
+
+def usage_cost(usage: dict, price: tuple) -> float:
+
+    """cost of one response's `usage` (OpenAI or Anthropic field names)"""
+
+    if not usage:
+        return 0.
+
+    prompt = usage.get('prompt_tokens', (usage.get('input_tokens') or 0) + (usage.get('cache_read_input_tokens') or 0) + (usage.get('cache_creation_input_tokens') or 0))
+    completion = usage.get('completion_tokens', usage.get('output_tokens')) or 0
+
+    return ((prompt or 0) * price[0] + completion * price[1]) / 1e6
+
+
+class CascadeRouter(LLM):
+
+    def __init__(self, tiers: list, config: dict = None, escalate_on=('parse',), schema=None, samples=3, agreement=0.67, check=None, prices=None, **kwargs) -> None:
+
+        """
+        Cascade router
+        --------
+
+        an LLM that answers with the cheapest model it can trust: each prompt goes to the first (fast, cheap) tier
+        and only moves to the next tier when a confidence signal fails. the last tier's answer is always accepted
+
+        - tiers: LLM instances (or 'provider:model' strings, see `marshall.llms.create`), cheapest first
+        - escalate_on: the confidence signals to check, in order
+          - 'parse': the answer must parse (see `structured.parse`) as `schema`, or as any JSON object when the router is in json mode (e.g. inside an `Agent`)
+          - 'agreement': `samples` answers are drawn concurrently and at least `agreement` of them must be the same (after normalization).
+            costs `samples` calls per tier, so it's meant for short/factual answers
+          - 'self_check': the tier is asked whether its own answer can be used as is (or pass `check`)
+        - schema (optional): a `structured.Schema` the answers must satisfy
+        - check (optional): callable(prompt, answer) -> bool replacing the built-in self check
+        - prices (optional): {model name prefix: (input, output) USD per 1M tokens}, defaults to `PRICES`
+
+        the router can stand in for any model (`base_model`, `subagent_model`, `refiner_model`, `base_agents`, ...): config changes
+        and instructions are passed through to every tier. `stats()` gives per-tier latency, cost and escalation counts to tune thresholds with
+        """
+
+        from marshall.llms import create
+
+        # forks, so the config and instructions passed through never change the models given here
+        self.tiers = [create(*t.split(':', 1)) if isinstance(t, str) else t.fork() for t in tiers]
+        assert self.tiers, "a cascade needs at least one tier"
+        for signal in escalate_on:
+            assert signal in ('parse', 'agreement', 'self_check'), "escalate_on must only contain 'parse', 'agreement', 'self_check'"
+
+        model_name = ' > '.join(t.model_name for t in self.tiers)
+        super().__init__(model_name, config, transport=self.tiers[0].transport)
+        self.name = 'cascade'
+
+        self.escalate_on = tuple(escalate_on)
+        self.schema = schema
+        self.samples = max(2, samples)
+        self.agreement = agreement
+        self.check = check
+        self.prices = prices if prices is not None else PRICES
+
+        self._lock = threading.Lock()
+        self._routes = {t.model_name: self._new_route() for t in self.tiers}
+
+    @staticmethod
+    def _new_route() -> dict:
+
+        return {'calls': 0, 'served': 0, 'escalated': Counter(), 'errors': 0, 'cost': 0., 'latencies': deque(maxlen=1000)}
+
+    def fork(self, config: dict = None) -> 'CascadeRouter':
+
+        # every tier is forked too, so instructions added to the fork stay out of the original tiers. routing stats stay shared
+        clone = super().fork(config)
+        clone.tiers = [t.fork() for t in self.tiers]
+
+        return clone
+
+    def add_sys_instructions(self, instructions: str):
+
+        for tier in self.tiers:
+            tier.add_sys_instructions(instructions)
+
+    def add_user_instructions(self, mssg: str):
+
+        for tier in self.tiers:
+            add = getattr(tier, 'add_user_instructions', None) or getattr(tier, 'add_user_message')
+            add(mssg)
+
+    def _sync_config(self, tier: LLM):
+
+        # settings made on the router (json mode from `Agent`, temperature from `HomogeneousEnsemble`, ...) apply to every tier
+        if self.config:
+            tier.config.update(self.config)
+
+    def _call(self, tier: LLM, prompt: str, **kwargs):
+
+        start = time.monotonic()
+        try:
+            answer = tier.generate(prompt, **kwargs)
+        except Exception:
+            with self._lock:
+                self._routes[tier.model_name]['errors'] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            # last_usage is per model instance, close enough for cost accounting when calls overlap
+            cost = usage_cost(tier.last_usage, price_for(tier.model_name, self.prices))
+            with self._lock:
+                route = self._routes[tier.model_name]
+                route['calls'] += 1
+                route['cost'] += cost
+                route['latencies'].append(elapsed)
+
+        return answer
+
+    def _parses(self, answer) -> bool:
+
+        if self.schema is None and not self.config.get('json'):
+            return answer is not None
+        try:
+            structured.parse(answer, self.schema)
+        except structured.ParseError:
+            return False
+        return True
+
+    def _self_check(self, tier: LLM, prompt: str, answer) -> bool:
+
+        if self.check is not None:
+            return bool(self.check(prompt, answer))
+
+        # only an explicit yes counts, anything unparseable escalates
+        reply = self._call(tier, SELF_CHECK_PROMPT.format(prompt=prompt, answer=answer))
+        try:
+            obj, _ = structured.loads(str(reply))
+            return obj.get('confident') is True
+        except structured.ParseError:
+            return str(reply).strip().strip('.!"\'`').lower() in ('true', 'yes')
+
+    def _sample_majority(self, tier: LLM, prompt: str, **kwargs) -> tuple:
+
+        # (most common answer, share of samples that agree with it)
+        answers, errors = run_concurrently(lambda p: self._call(tier, p, **kwargs), [prompt] * self.samples)
+        answers = [a for i, a in enumerate(answers) if i not in errors and a is not None]
+        if not answers:
+            raise next(iter(errors.values()))
+
+        votes = Counter(normalize_answer(a) for a in answers)
+        top, count = votes.most_common(1)[0]
+        answer = next(a for a in answers if normalize_answer(a) == top)
+
+        return answer, count / self.samples
+
+    def _attempt(self, tier: LLM, prompt: str, **kwargs) -> tuple:
+
+        """(answer, None) if every signal passes, else (answer, the signal that failed)"""
+
+        if 'agreement' in self.escalate_on:
+            answer, agreement = self._sample_majority(tier, prompt, **kwargs)
+            tracing.current_span().set('agreement', agreement)
+        else:
+            answer, agreement = self._call(tier, prompt, **kwargs), None
+
+        for signal in self.escalate_on:
+            if signal == 'parse' and not self._parses(answer):
+                return answer, signal
+            if signal == 'agreement' and agreement < self.agreement:
+                return answer, signal
+            if signal == 'self_check' and not self._self_check(tier, prompt, answer):
+                return answer, signal
+
+        return answer, None
+
+    def generate(self, prompt: str, **kwargs):
+
+        with tracing.span('router.route', provider=self.name, model=self.model_name) as span:
+            for i, tier in enumerate(self.tiers):
+                self._sync_config(tier)
+                last = i == len(self.tiers) - 1
+                try:
+                    answer, failed = self._attempt(tier, prompt, **kwargs)
+                except Exception as e:
+                    if last:
+                        raise
+                    answer, failed = None, type(e).__name__
+                    logger.info('%s failed (%s), escalating', tier.model_name, e)
+
+                if failed is None or last:
+                    with self._lock:
+                        self._routes[tier.model_name]['served'] += 1
+                    span.set('tier', tier.model_name)
+                    return answer
+
+                with self._lock:
+                    self._routes[tier.model_name]['escalated'][failed] += 1
+                span.add('escalations')
+                logger.debug('%s escalated on %s', tier.model_name, failed)
+
+    async def agenerate(self, prompt: str, **kwargs):
+
+        # the tiers' own calls are blocking here, the cascade runs in a worker thread
+        return await asyncio.to_thread(self.generate, prompt, **kwargs)
+
+    def stream(self, prompt: str, **kwargs):
+
+        """streams from the first tier: a stream is consumed while it's generated, so it can't be checked and escalated"""
+
+        self._sync_config(self.tiers[0])
+        return self.tiers[0].stream(prompt, **kwargs)
+
+    def astream(self, prompt: str, **kwargs):
+
+        self._sync_config(self.tiers[0])
+        return self.tiers[0].astream(prompt, **kwargs)
+
+    def stats(self) -> dict:
+
+        """per tier: calls, served (answers returned), escalated (by signal), errors, cost (USD) and latency p50/p95 (seconds)"""
+
+        out = {}
+        with self._lock:
+            routes = {name: dict(r, escalated=dict(r['escalated']), latencies=sorted(r['latencies'])) for name, r in self._routes.items()}
+
+        served = sum(r['served'] for r in routes.values())
+        for name, r in routes.items():
+            latencies = r.pop('latencies')
+            r['serve_share'] = r['served'] / served if served else 0.
+            r['latency_p50'] = latencies[len(latencies) // 2] if latencies else None
+            r['latency_p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None
+            out[name] = r
+
+        return out
+
+    def reset_stats(self):
+
+        with self._lock:
+            self._routes = {t.model_name: self._new_route() for t in self.tiers}
@@ -0,0 +1,218 @@
+import contextlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from marshall.core import tracing
+from marshall.tools.embed import EmbeddingBatcher
+
+logger = logging.getLogger(__name__)
+
+
+def read_queries(source):
+
+    """
+    yields (id, query) from a JSONL file path or an iterable
+
+    JSONL lines / iterable items can be a plain string (id = its position) or an object with `query` and an optional `id`
+    """
+
+    if isinstance(source, (str, os.PathLike)):
+        with open(source) as f:
+            items = (json.loads(line) for line in f if line.strip())
+            yield from _with_ids(items)
+    else:
+        yield from _with_ids(source)
+
+
+def _with_ids(items):
+
+    for i, item in enumerate(items):
+        if isinstance(item, dict):
+            yield str(item.get('id', i)), item['query']
+        else:
+            yield str(i), item
+
+
+def completed_ids(path: str, retry_failed: bool = True) -> set:
+
+    """ids already written to an output file (those that errored are left out when retry_failed), so a rerun can skip them"""
+
+    done = set()
+    if not path or not os.path.exists(path):
+        return done
+
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # a line cut short by an interrupted run
+            if retry_failed and record.get('error') is not None:
+                continue
+            done.add(str(record['id']))
+
+    return done
+
+
+def read_results(path: str) -> dict:
+
+    """
+    {id: record} from an output file. a query retried on resume (see `retry_failed`) has one line per attempt, the last one wins
+    """
+
+    results = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            results[str(record['id'])] = record
+
+    return results
+
+
+def _drop_partial_line(path: str):
+
+    # an interrupted run can leave a last line without its newline, appending to it would glue the next record onto it
+    if not path or not os.path.exists(path):
+        return
+
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        if not end:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b'\n':
+            return
+
+        # walk back to the last complete line
+        pos, block = end, 1 << 16
+        while pos > 0:
+            start = max(0, pos - block)
+            f.seek(start)
+            cut = f.read(pos - start).rfind(b'\n')
+            if cut >= 0:
+                f.truncate(start + cut + 1)
+                return
+            pos = start
+        f.truncate(0)
+
+
+class BatchRunner:
+
+    def __init__(self, pipeline, max_queries: int = 32, batch_embeddings: bool = True, embedding_wait: float = 0.02, retry_failed: bool = True):
+
+        """
+        Batch runner
+        --------
+
+        runs a pipeline over a stream of queries (a JSONL file or any iterable) and streams results out as they complete
+
+        - pipeline: a callable(query) -> result, or an object with a `run(query)` method (e.g. a `HomogeneousEnsemble`).
+          it's called from several threads at once, so anything holding per-query state (like an `Agent`) should be built inside the callable
+        - max_queries: number of queries worked on at once. their LLM calls all go through the shared per (provider, model) rate limiters,
+          which pace and cap in-flight requests to the provider's quota, so this only needs to be large enough to keep that quota busy
+        - batch_embeddings: merge the embedding requests of all in-flight queries into shared requests (see `embed.EmbeddingBatcher`)
+        - embedding_wait: how long (seconds) an embedding request waits for others to join its batch
+        - retry_failed: on resume, rerun queries whose previous attempt errored
+
+        with an output path, every result is appended (and flushed) as one JSON line `{id, query, result, error, latency}`.
+        the output doubles as the checkpoint: rerunning with the same output skips the ids it already holds, so an interrupted run picks up where it stopped
+        (a line cut short by the interruption is dropped). a failed query that is retried gets a new line, the last line per id wins (see `read_results`)
+
+        provider batch endpoints (OpenAI /v1/batches, Anthropic message batches) aren't used: they trade hours of latency for price,
+        which doesn't fit multi-step pipelines whose later calls depend on earlier answers
+        """
+
+        self.run_query = pipeline.run if hasattr(pipeline, 'run') else pipeline
+        self.max_queries = max_queries
+        self.batcher = EmbeddingBatcher(max_wait=embedding_wait) if batch_embeddings else None
+        self.retry_failed = retry_failed
+
+        self.stats = {}
+
+    def _call(self, query_id: str, query) -> dict:
+
+        start = time.monotonic()
+        record = {'id': query_id, 'query': query, 'result': None, 'error': None}
+        with tracing.span('batch.query', query_id=query_id):
+            try:
+                record['result'] = self.run_query(query)
+            except Exception as e:
+                record['error'] = f"{type(e).__name__}: {e}"
+        record['latency'] = time.monotonic() - start
+
+        return record
+
+    def iter_results(self, queries, skip: set = frozenset()):
+
+        """yields result records in completion order, with at most `max_queries` queries in flight (the input is read lazily)"""
+
+        pool = ThreadPoolExecutor(max_workers=self.max_queries)
+        running = set()
+        pending = ((i, q) for i, q in read_queries(queries) if i not in skip)
+
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(running) < self.max_queries:
+                    item = next(pending, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    running.add(pool.submit(tracing.propagate(self._call), *item))
+
+                if not running:
+                    break
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    yield f.result()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, queries, output: str = None) -> dict:
+
+        """
+        runs every query (skipping those already in `output`) and appends results to `output` as they complete.
+        returns run stats; without an output path the records are returned under 'results'
+        """
+
+        _drop_partial_line(output)
+        skip = completed_ids(output, retry_failed=self.retry_failed)
+        if skip:
+            logger.info('resuming: %d queries already done in %s', len(skip), output)
+
+        f = open(output, 'a') if output else None
+        results = [] if f is None else None
+        self.stats = {'done': 0, 'failed': 0, 'skipped': len(skip), 'elapsed': 0.}
+        start = time.monotonic()
+
+        scope = self.batcher.activate() if self.batcher is not None else contextlib.nullcontext()
+        try:
+            with scope, tracing.span('batch.run', max_queries=self.max_queries) as span:
+                for record in self.iter_results(queries, skip=skip):
+                    self.stats['failed' if record['error'] is not None else 'done'] += 1
+                    if f is not None:
+                        f.write(json.dumps(record, default=str) + '\n')
+                        f.flush()
+                    else:
+                        results.append(record)
+                span.set('done', self.stats['done'])
+                span.set('failed', self.stats['failed'])
+        finally:
+            if f is not None:
+                f.close()
+
+        self.stats['elapsed'] = time.monotonic() - start
+        self.stats['throughput'] = (self.stats['done'] + self.stats['failed']) / self.stats['elapsed'] if self.stats['elapsed'] > 0 else 0.
+        if self.batcher is not None:
+            self.stats['embeddings'] = self.batcher.stats()
+        if results is not None:
+            self.stats['results'] = results
+
+        return self.stats
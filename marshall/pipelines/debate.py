@@ -0,0 +1,157 @@
+import threading
+
+import numpy as np
+
+from marshall.tools.embed import embed_texts
+from marshall.core.llm import LLM
+from marshall.core.concurrency import run_concurrently
+from marshall.core import tracing
+
+
+def cosine_similarity_matrix(embeddings: np.ndarray) -> np.ndarray:
+    """Compute the (N, N) cosine similarity matrix between the rows of `embeddings`."""
+    unit = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    return unit @ unit.T
+
+class Debate:
+
+    def __init__(self, debaters, num_debaters: int = None, max_rounds: int = 3, convergence_threshold: float = 0.95, max_position_chars: int = 800, **kwargs):
+
+        """
+        Multi-Agent Debate
+        --------
+
+        N debaters answer a query, then over several rounds each one revises its answer after seeing the other debaters' positions (like in "Improving Factuality and Reasoning in Language Models through Multiagent Debate": https://arxiv.org/abs/2305.14325)
+
+        - debaters: a list of LLMs, or a single LLM that is sampled `num_debaters` times
+        - max_rounds: max number of revision rounds after the opening answers
+        - convergence_threshold: the debate stops early once the mean pairwise cosine similarity of the answers' embeddings reaches this
+        - max_position_chars: other debaters' positions are truncated to this many characters
+
+        each round, every debater only sees a compact diff of the others: positions that didn't change since the last round are marked as unchanged and cut short instead of being repeated in full, and the transcript is never replayed, so prompt size doesn't grow with the number of rounds.
+        all debaters in a round answer concurrently
+
+        optional kwargs:
+        - max_concurrency: cap on the number of calls in flight at once (defaults to the number of debaters)
+        - timeout: per-call timeout in seconds, a debater that fails or times out keeps its previous position (one that fails its opening answer sits the debate out)
+        """
+
+        if isinstance(debaters, LLM):
+            assert num_debaters, "num_debaters is needed when a single LLM is passed"
+            debaters = [debaters] * num_debaters
+
+        assert len(debaters) > 1, "a debate needs at least 2 debaters"
+
+        self.debaters = debaters
+        self.max_rounds = max_rounds
+        self.convergence_threshold = convergence_threshold
+        self.max_position_chars = max_position_chars
+
+        self.max_concurrency = kwargs.get('max_concurrency')
+        self.timeout = kwargs.get('timeout')
+
+        self._last = threading.local() # per thread diagnostics of the last run (see the properties below)
+
+    @property
+    def transcript(self) -> list:
+
+        """rounds of the last run on this thread, each a list of answers (one per debater taking part)"""
+
+        return getattr(self._last, 'transcript', [])
+
+    @property
+    def agreement(self) -> list:
+
+        """mean pairwise similarity after each round of the last run on this thread"""
+
+        return getattr(self._last, 'agreement', [])
+
+    def _truncate(self, text: str, max_chars: int) -> str:
+
+        text = str(text)
+        return text if len(text) <= max_chars else text[:max_chars].rstrip() + ' [...]'
+
+    def _round_prompt(self, query: str, i: int, previous: list, before: list) -> str:
+
+        others = []
+        for j, answer in enumerate(previous):
+            if j == i:
+                continue
+            if before is not None and answer == before[j]:
+                # calls are stateless, so an unchanged position still gets a short reminder rather than nothing
+                others.append(f"Agent {j+1} (position unchanged): {self._truncate(answer, self.max_position_chars // 4)}")
+            else:
+                others.append(f"Agent {j+1}: {self._truncate(answer, self.max_position_chars)}")
+
+        others = '\n\n'.join(others)
+        return f"Question: {query}\n\nYour previous answer was:\n{previous[i]}\n\nThe other agents' current positions are:\n\n{others}\n\nUsing their reasoning as additional advice, give an updated answer to the question. If you still think your answer is right, restate it."
+
+    def _ask(self, debaters: list, prompts: list) -> list:
+
+        def call(args):
+            debater, prompt = args
+            return debater.generate(prompt)
+
+        answers, _ = run_concurrently(call, list(zip(debaters, prompts)), max_workers=self.max_concurrency, timeout=self.timeout)
+        return answers
+
+    def _similarities(self, answers: list):
+
+        embeddings = embed_texts([str(a) for a in answers], transport=self.debaters[0].transport)
+        assert embeddings is not None, "embedding request failed"
+        return cosine_similarity_matrix(embeddings.astype(np.float64))
+
+    def run(self, query: str, verbosity=0) -> str:
+
+        """
+        - every debater answers the query (concurrently)
+        - each round, every debater revises given a compact diff of the others' positions, until the answers converge or max_rounds is hit
+        - returns the final answer with the highest average similarity to the others
+        """
+
+        with tracing.span('debate.run', debaters=len(self.debaters)) as span:
+            answer = self._run(query, verbosity)
+            span.set('rounds', len(self.transcript) - 1)
+            span.set('agreement', self.agreement[-1] if self.agreement else None)
+
+        return answer
+
+    def _run(self, query: str, verbosity=0) -> str:
+
+        # published up front and filled in place, so an early return still leaves this run's state
+        transcript, agreements = [], []
+        self._last.transcript, self._last.agreement = transcript, agreements
+
+        with tracing.span('debate.round', round=0):
+            answers = self._ask(self.debaters, [query] * len(self.debaters))
+        assert any(a is not None for a in answers), "all debaters failed to answer"
+        # a debater that failed to open has no position of its own, it's dropped rather than handed a copy of another's (which would fake agreement)
+        debaters = [d for d, a in zip(self.debaters, answers) if a is not None]
+        answers = [a for a in answers if a is not None]
+        transcript.append(answers)
+        if len(answers) == 1:
+            return answers[0]
+
+        before = None
+        for r in range(self.max_rounds + 1):
+
+            sims = self._similarities(answers)
+            n = len(answers)
+            agreement = float((sims.sum() - n) / (n * (n - 1)))
+            agreements.append(agreement)
+            if verbosity > 0: print(f'round {r}: agreement={agreement:.3f}')
+
+            if agreement >= self.convergence_threshold or r == self.max_rounds:
+                break
+
+            prompts = [self._round_prompt(query, i, answers, before) for i in range(n)]
+            with tracing.span('debate.round', round=r + 1):
+                revised = self._ask(debaters, prompts)
+
+            before = answers
+            answers = [new if new is not None else old for new, old in zip(revised, answers)]
+            transcript.append(answers)
+            if verbosity > 1: print(answers)
+
+        # most central answer of the final round
+        return answers[int(np.argmax(sims.sum(axis=1)))]
@@ -0,0 +1,262 @@
+import copy
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from marshall.core.agent import Agent
+from marshall.core import tracing
+
+DAG_INSTRUCTIONS = """When you dispatch, each item of `content` may be an object instead of a plain string, so that sub-tasks can depend on each other:
+
+- `id`: a short id for the sub-task, unique among its siblings (e.g. "a", "b")
+- `task`: a clear and comprehensive instruction for the subagent
+- `depends_on`: a list of ids of sibling sub-tasks whose results this sub-task needs (empty if none)
+
+Sub-tasks without dependencies between them are worked on at the same time, so only declare a dependency when a sub-task really needs another one's result. A sub-task receives the results of the sub-tasks it depends on."""
+
+SEPARATOR = "\n\n--------\n\n"
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(task: str) -> str:
+
+    return re.sub(r'\s+', ' ', str(task)).strip().lower()
+
+
+class TaskNode:
+
+    def __init__(self, node_id: int, task: str, depth: int, depends_on: list = None) -> None:
+
+        self.id = node_id
+        self.task = task
+        self.depth = depth
+        self.depends_on = depends_on or [] # nodes whose results this one needs
+        self.parents = [] # nodes that dispatched this one (more than one when deduplicated)
+        self.children = [] # nodes this one dispatched, in dispatch order
+
+        self.state = 'pending' # pending -> running -> (waiting ->) done | failed
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+
+        return f"TaskNode(id={self.id}, state={self.state}, task={self.task[:40]!r})"
+
+
+class DelegationPipeline:
+
+    def __init__(self, agent: Agent, max_concurrency: int = 8, max_depth: int = 3, dedupe: bool = True):
+
+        """
+        Delegation (DAG)
+        --------
+
+        a task is passed to the agent's base model, which answers, executes code or dispatches sub-tasks (like `Agent.build_scratchpad`).
+        dispatched sub-tasks can declare dependencies on their siblings, and the resulting task graph is run by a scheduler:
+
+        - every node whose dependencies are done runs immediately, up to `max_concurrency` nodes at once, so end-to-end latency follows the critical path rather than the node count
+        - identical sub-task prompts (with the same dependencies) are deduplicated into one node anywhere in the graph
+        - a node gets the results of its dependencies along with its task
+        - per-node state, result and timings are kept in `self.nodes`
+
+        max_depth: dispatch depth after which nodes must answer/execute code directly
+        """
+
+        # the pipeline works on a copy of the agent over forks of its models, so the DAG instructions are added once per pipeline
+        # and never pile up on the agent's own models (the result log and concurrency cap are still shared with it)
+        self.agent = copy.copy(agent)
+        self.agent.base_model = agent.base_model.fork()
+        self.agent.subagent_model = agent.subagent_model.fork()
+        self.agent.current_agent = self.agent.base_model
+        self.max_concurrency = max_concurrency
+        self.max_depth = max_depth
+        self.dedupe = dedupe
+
+        self.agent.base_model.add_sys_instructions(DAG_INSTRUCTIONS)
+        self.agent.subagent_model.add_sys_instructions(DAG_INSTRUCTIONS)
+
+        self.nodes = {}
+        self._by_key = {}
+
+    def _key(self, task: str, depends_on: list) -> tuple:
+
+        return (_normalize(task), tuple(sorted(n.id for n in depends_on)))
+
+    def _ancestors(self, node: TaskNode) -> set:
+
+        seen, stack = set(), [node]
+        while stack:
+            n = stack.pop()
+            if n.id in seen:
+                continue
+            seen.add(n.id)
+            stack.extend(n.parents)
+
+        return seen
+
+    def _add_node(self, task: str, depth: int, depends_on: list = None, avoid: set = frozenset()) -> TaskNode:
+
+        """returns the existing node for an identical prompt (unless its id is in `avoid`) or a new one"""
+
+        depends_on = depends_on or []
+        key = self._key(task, depends_on)
+
+        existing = self._by_key.get(key) if self.dedupe else None
+        if existing is not None and existing.id not in avoid:
+            return existing
+
+        node = TaskNode(len(self.nodes), task, depth, depends_on)
+        self.nodes[node.id] = node
+        self._by_key[key] = node
+        return node
+
+    def _expand(self, parent: TaskNode, subtasks: list):
+
+        """adds a dispatch's sub-tasks as child nodes, wiring up their declared dependencies"""
+
+        ids = [str(t.get('id', i)) for i, t in enumerate(subtasks)]
+        deps = {i: [str(d) for d in t.get('depends_on', []) or [] if str(d) in ids and str(d) != i] for i, t in zip(ids, subtasks)}
+
+        # topological order of the siblings (Kahn), dependencies in a cycle are dropped
+        order, placed = [], set()
+        while len(order) < len(ids):
+            ready = [i for i in ids if i not in placed and all(d in placed for d in deps[i])]
+            if not ready:
+                stuck = [i for i in ids if i not in placed]
+                logger.warning('dependency cycle between sub-tasks %s, running them independently', stuck)
+                for i in stuck:
+                    deps[i] = [d for d in deps[i] if d in placed]
+                continue
+            for i in ready:
+                order.append(i)
+                placed.add(i)
+
+        # never reuse an ancestor, that would make the parent wait on itself
+        ancestors = self._ancestors(parent)
+
+        created = {}
+        for i in order:
+            task = subtasks[ids.index(i)].get('task')
+            created[i] = self._add_node(task, parent.depth + 1, depends_on=[created[d] for d in deps[i]], avoid=ancestors)
+
+        # children are linked in dispatch order (not topological order) so the scratchpad reads like the dispatch
+        for i in ids:
+            created[i].parents.append(parent)
+            parent.children.append(created[i])
+
+    def _prompt(self, node: TaskNode) -> str:
+
+        if not node.depends_on:
+            return node.task
+
+        inputs = SEPARATOR.join(f"{dep.task}\n{dep.result}" for dep in node.depends_on)
+        return f"{node.task}\n\nResults of the sub-tasks this task depends on:\n\n{inputs}"
+
+    def _execute(self, node: TaskNode) -> dict:
+
+        # node spans carry the graph ids, so a slow node can be traced back to its place in the tree
+        with tracing.span('delegation.node', node_id=node.id, depth=node.depth, parents=[p.id for p in node.parents], depends_on=[d.id for d in node.depends_on], task=node.task[:200]):
+            return self.agent.make_decision(
+                task=self._prompt(node),
+                agent='base' if node.depth == 0 else 'sub',
+                allow_dispatch=self.max_depth is None or node.depth < self.max_depth
+            )
+
+    def _settle(self):
+
+        """propagates finished children up to waiting parents and failures to dependents, until nothing changes"""
+
+        changed = True
+        while changed:
+            changed = False
+            for node in self.nodes.values():
+                if node.state == 'waiting' and all(c.state in ('done', 'failed') for c in node.children):
+                    parts = [c.result if c.state == 'done' else f"The sub-task '{c.task}' failed: {c.error}" for c in node.children]
+                    node.result = SEPARATOR.join(str(p) for p in parts)
+                    node.state = 'done'
+                    node.finished = time.monotonic()
+                    changed = True
+                elif node.state == 'pending' and any(d.state == 'failed' for d in node.depends_on):
+                    node.state = 'failed'
+                    node.error = 'a dependency failed'
+                    changed = True
+
+    def _scratchpad(self, node: TaskNode, seen: set) -> str:
+
+        if node.id in seen:
+            return ''
+        seen.add(node.id)
+
+        if node.children:
+            return ''.join(self._scratchpad(c, seen) for c in node.children)
+        if node.state == 'failed':
+            return f"The sub-task '{node.task}' failed: {node.error}" + SEPARATOR
+
+        return str(node.result) + SEPARATOR
+
+    def build_scratchpad(self, task: str) -> str:
+
+        """runs the task graph to completion and returns the scratchpad of all leaf results (in dispatch order)"""
+
+        self.nodes = {}
+        self._by_key = {}
+        root = self._add_node(task, depth=0)
+
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        running = {}
+        try:
+            while True:
+                for node in self.nodes.values():
+                    if node.state == 'pending' and all(d.state == 'done' for d in node.depends_on):
+                        node.state = 'running'
+                        node.started = time.monotonic()
+                        running[pool.submit(tracing.propagate(self._execute), node)] = node
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    node = running.pop(f)
+                    try:
+                        out = f.result()
+                    except Exception as e:
+                        node.state, node.error = 'failed', e
+                        node.finished = time.monotonic()
+                        continue
+
+                    if out['done']:
+                        node.state, node.result = 'done', out['message']
+                        node.finished = time.monotonic()
+                    else:
+                        node.state = 'waiting'
+                        self._expand(node, out['subtasks'])
+
+                self._settle()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        return self._scratchpad(root, set())
+
+    def run(self, task: str, verbosity=0) -> str:
+
+        """builds the scratchpad for `task` and has the agent's refiner model turn it into a final answer"""
+
+        with tracing.span('delegation.run'):
+            scratchpad = self.build_scratchpad(task)
+        if verbosity > 0:
+            states = [n.state for n in self.nodes.values()]
+            print(f"{len(self.nodes)} nodes: {states.count('done')} done, {states.count('failed')} failed")
+        if verbosity > 1: print(scratchpad)
+
+        if self.agent.refiner_model is None:
+            return scratchpad
+
+        return self.agent.refiner_model.generate(
+            f"Given the task **{task}** and the work done on it below, provide the most helpful final response for the user.",
+            context=[f"Below is the work done by a team of agents on the task: {task}\n\n{scratchpad}"]
+        )
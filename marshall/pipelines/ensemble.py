@@ -1,12 +1,27 @@
-import copy
+import threading
+from collections import Counter
 
-from marshall.tools.embed import embed_text  
+import numpy as np
+
+from marshall.tools.embed import embed_texts  
 from marshall.core.llm import LLM
+from marshall.core.concurrency import run_concurrently
+from marshall.core import tracing
+from marshall.core.utils import normalize_answer
+from marshall.core.cache import namespace_key, sample_scope
 
 def euclidean_distance(vec1, vec2):
     """Compute the Euclidean distance between two vectors."""
     return sum((p - q) ** 2 for p, q in zip(vec1, vec2)) ** 0.5
 
+def pairwise_euclidean(embeddings: np.ndarray) -> np.ndarray:
+    """Compute the (N, N) matrix of Euclidean distances between the rows of `embeddings` in one vectorized pass."""
+    sq_norms = np.einsum('ij,ij->i', embeddings, embeddings)
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b ; clip tiny negatives from float error before the sqrt
+    sq_dists = sq_norms[:, None] + sq_norms[None, :] - 2. * (embeddings @ embeddings.T)
+    np.fill_diagonal(sq_dists, 0.)
+    return np.sqrt(np.clip(sq_dists, 0., None))
+
 class HomogeneousEnsemble: 
 
     def __init__(self, base_agents: LLM, num_base_agents: int, refinement_strategy='similarity', toolkit=None, **kwargs):   
@@ -20,12 +35,50 @@ class HomogeneousEnsemble:
         - similarity: compute all cross-similarity (euclidean dist on embeddings) scores for each sampled answer and choose argmin 
 
         - agent-based: a refined agent (a copy of the base agent) is tasked with distilling the sampled answers
+
+        optional kwargs: 
+        - execution_mode: 'concurrent' (default) sends all N samples at once, 'sequential' sends them one after another 
+        - max_concurrency: cap on the number of samples in flight at once (defaults to num_base_agents) 
+        - timeout: per-sample timeout in seconds, samples that fail or time out are dropped and the rest are refined 
+
+        a `response_cache` on the base model caches every sample separately (the sample index is part of the key, see `cache.sample_scope`), 
+        so a replayed run gets its N recorded samples back, not the first one N times 
+
+        adaptive sampling (sampling='adaptive'): samples are drawn in waves of `wave_size` and sampling stops as soon as the answers agree, 
+        so easy queries cost a wave or two and only hard ones go up to `num_base_agents` samples 
+        - agreement: 'cluster' (default) measures the share of answers whose embeddings are within `cluster_threshold` cosine similarity of the dominant answer, 
+          'vote' the share of answers that are identical after normalization (cheaper, for short/factual answers) 
+        - confidence: agreement needed to stop (default 0.75) 
+        - wave_size: samples per wave (default 3) 
+        - cluster_threshold: cosine similarity for two answers to count as the same (default 0.9) 
+
+        semantic_cache (optional): a `SemanticCache`. a query close enough to one answered before returns that final answer straight away, 
+        skipping sampling and refinement. answers are namespaced by the base/refiner models, their instructions and the ensemble settings 
+
+        `responses`, `errors` and `agreement_history` describe the last run on the calling thread, so concurrent runs (e.g. from a `BatchRunner`) 
+        never see each other's 
         """
 
         assert refinement_strategy in ['similarity', 'agent'], "refinement_strategy must be one of 'similarity', 'agent'"
 
-        self.base_agents = base_agents 
-        self.base_agents.config.update({'temperature': 1.}) # temp needs to be set high to get diverse answers
+        self.execution_mode = kwargs.get('execution_mode', 'concurrent') 
+        assert self.execution_mode in ['concurrent', 'sequential'], "execution_mode must be one of 'concurrent', 'sequential'"
+        self.max_concurrency = kwargs.get('max_concurrency') 
+        self.timeout = kwargs.get('timeout')
+
+        self.sampling = kwargs.get('sampling', 'fixed') 
+        assert self.sampling in ['fixed', 'adaptive'], "sampling must be one of 'fixed', 'adaptive'"
+        self.agreement_mode = kwargs.get('agreement', 'cluster') 
+        assert self.agreement_mode in ['cluster', 'vote'], "agreement must be one of 'cluster', 'vote'"
+        self.confidence = kwargs.get('confidence', 0.75) 
+        self.wave_size = max(2, kwargs.get('wave_size', 3)) 
+        self.cluster_threshold = kwargs.get('cluster_threshold', 0.9) 
+        self.semantic_cache = kwargs.get('semantic_cache') 
+        self._last = threading.local() # per thread diagnostics of the last run (see the properties below) 
+
+        # a fork, so the caller's model keeps its own temperature (forks are O(1) and share the instruction history)
+        self.base_agents = base_agents.fork(config={'temperature': 1.}) # temp needs to be set high to get diverse answers
+        self.base_agents.semantic_cache = None # samples have to be independent, a cache would hand every sample the same answer 
 
         self.num_base_agents = num_base_agents 
         self.refinement_strategy = refinement_strategy 
@@ -38,9 +91,27 @@ class HomogeneousEnsemble:
             self.refiner_agent = None
 
         self.toolkit = toolkit
-        if self.toolkit:  
-            if self.toolkit: 
-                tool_instructions = f"""\n\nYou also have access to the following tools (python functions available in your environment), use these as needed whenever you want: \n\n{self.get_tool_str(self.toolkit.tool_dict)}\n--------\n\nIf you choose to make decision == "code_execute", you may use these functions in your code and can assume they are aleady available in the global namespace."""
+    
+    @property 
+    def responses(self) -> str: 
+
+        """the formatted samples of the last run on this thread""" 
+
+        return getattr(self._last, 'responses', None) 
+
+    @property 
+    def errors(self) -> dict: 
+
+        """{sample index: error} of the last run on this thread""" 
+
+        return getattr(self._last, 'errors', {}) 
+
+    @property 
+    def agreement_history(self) -> list: 
+
+        """agreement after each wave of the last adaptive run on this thread""" 
+
+        return getattr(self._last, 'agreement_history', []) 
     
     def similarity_refinement(self, answers: list[str]):
         
@@ -53,25 +124,84 @@ class HomogeneousEnsemble:
         - Return the answer with the embedding with the highest average similarity.
         """
 
-        # Step 1: Compute embeddings for each answer
-        embeddings = [embed_text(answer) for answer in answers]
-
-        # Step 2 & 3: Compute pairwise Euclidean distances and average them
-        avg_similarities = []
-        for i, emb_i in enumerate(embeddings):
-            distances = []
-            for j, emb_j in enumerate(embeddings):
-                if i != j:
-                    # Calculate Euclidean distance
-                    dist = euclidean_distance(emb_i, emb_j)
-                    # Invert the distance to represent similarity; smaller distances mean higher similarity
-                    similarity = -dist
-                    distances.append(similarity)
-            avg_similarities.append(sum(distances) / len(distances))
+        if len(answers) == 1: 
+            return answers[0]
+
+        # Step 1: Compute embeddings for all answers in a single request
+        embeddings = embed_texts(answers, transport=self.base_agents.transport)
+        assert embeddings is not None, "embedding request failed"
+
+        # Step 2 & 3: Compute pairwise Euclidean distances and average them (the diagonal is 0 so it drops out of the sum)
+        distances = pairwise_euclidean(embeddings.astype(np.float64))
+        avg_distances = distances.sum(axis=1) / (len(answers) - 1)
 
         # Step 4: Find the answer with the highest average similarity (least distance)
-        max_avg_sim_index = avg_similarities.index(max(avg_similarities))
-        return answers[max_avg_sim_index]
+        return answers[int(np.argmin(avg_distances))]
+
+    def agreement(self, answers: list[str]) -> float:
+
+        """share of the answers that belong to the dominant answer (see `agreement` kwarg)"""
+
+        if len(answers) < 2: 
+            return 0. 
+
+        if self.agreement_mode == 'cluster': 
+            embeddings = embed_texts([str(a) for a in answers], transport=self.base_agents.transport) 
+            if embeddings is not None: 
+                unit = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12) 
+                # size of the largest neighbourhood: how many answers are close to the most "central" one (itself included) 
+                neighbours = (unit @ unit.T >= self.cluster_threshold).sum(axis=1) 
+                return float(neighbours.max()) / len(answers) 
+            # embeddings unavailable, voting still gives a usable (if stricter) signal 
+
+        votes = Counter(normalize_answer(a) for a in answers) 
+        return votes.most_common(1)[0][1] / len(answers) 
+
+    def _sample(self, query: str, n: int, start: int = 0) -> tuple: 
+
+        # the prompts are identical, each sample's index goes into the response cache key (with a `response_cache` set, 
+        # sample i replays recorded sample i rather than every sample replaying the first answer) 
+        def _one(i): 
+            with sample_scope(i): 
+                return self.base_agents.generate(query) 
+
+        max_workers = self.max_concurrency if self.execution_mode == 'concurrent' else 1 
+        return run_concurrently(_one, list(range(start, start + n)), max_workers=max_workers, timeout=self.timeout)
+
+    def _gather(self, query: str, verbosity=0, history: list = None) -> tuple: 
+
+        """
+        all samples up front ('fixed'), or wave after wave until they agree ('adaptive'). returns (samples, {index: error}), 
+        the agreement after each wave is appended to `history` 
+        """
+
+        if self.sampling == 'fixed': 
+            return self._sample(query, self.num_base_agents) 
+
+        history = history if history is not None else [] 
+        samples, errors = [], {} 
+        while len(samples) < self.num_base_agents: 
+            wave, wave_errors = self._sample(query, min(self.wave_size, self.num_base_agents - len(samples)), start=len(samples)) 
+            errors.update({len(samples) + i: e for i, e in wave_errors.items()}) 
+            samples.extend(wave) 
+
+            answers = [a for i, a in enumerate(samples) if i not in errors and a is not None] 
+            agreement = self.agreement(answers) 
+            history.append(agreement) 
+            if verbosity > 0: print(f'{len(samples)} samples, agreement={agreement:.2f}') 
+            if agreement >= self.confidence: 
+                break 
+
+        return samples, errors 
+
+    def semantic_namespace(self) -> str: 
+
+        # everything that shapes the final answer besides the query 
+        refiner = self.refiner_agent 
+        return namespace_key(
+            'ensemble', self.base_agents.semantic_namespace(), refiner.semantic_namespace() if refiner is not None else None, 
+            self.refinement_strategy, self.num_base_agents, self.sampling, self.agreement_mode, self.confidence, 
+        )
 
     def run(self, query: str, verbosity=0) -> str:  
 
@@ -81,34 +211,56 @@ class HomogeneousEnsemble:
         - store responses in scratchpad and pass to refiner agent for final answer 
         """ 
 
-        # 1. gather responses from LLMs
+        with tracing.span('ensemble.run', strategy=self.refinement_strategy, sampling=self.sampling, max_samples=self.num_base_agents): 
+            if self.semantic_cache is None: 
+                return self._run(query, verbosity) 
+
+            # a hit skips the whole sample + refine run 
+            return self.semantic_cache.get_or_compute(query, self.semantic_namespace(), lambda: self._run(query, verbosity)) 
+
+    def _run(self, query: str, verbosity=0) -> str: 
+
+        # 1. gather responses from LLMs (in waves, until they agree, when sampling='adaptive')
+        history = [] 
+        samples, errors = self._gather(query, verbosity, history) 
+
         responses = ""  
         list_responses = []
-        for i in range(self.num_base_agents): 
-            ans = self.base_agents.generate(query)  
+        for i, ans in enumerate(samples): 
+            if i in errors or ans is None: 
+                if verbosity > 0: print(f'agent {i+1} failed: {errors.get(i)}')
+                continue 
             list_responses.append(ans)
-            responses += f"\nAgent {i+1}: {ans}\n\n---------"  
+            responses += f"\nAgent {len(list_responses)}: {ans}\n\n---------"  
             if verbosity > 0: print(f'agent {i+1} answered') 
             if verbosity > 1: print(ans)
 
-        self.responses = responses    
+        span = tracing.current_span() 
+        span.set('samples', len(samples)) 
+        span.set('failed_samples', len(errors))
+        self._last.responses, self._last.errors, self._last.agreement_history = responses, errors, history 
+        assert list_responses, f"all {self.num_base_agents} base agents failed: {errors}"
 
         # 2. refine 
         if self.refinement_strategy == 'similarity':  
             if verbosity > 0: print('refining via similarity')
-            return self.similarity_refinement(list_responses)
-        
+            with tracing.span('ensemble.refine', strategy='similarity'): 
+                return self.similarity_refinement(list_responses)
+    
         if self.refinement_strategy == 'agent': 
             if verbosity > 0: print('refining through agent')
 
-            if self.refiner_agent.name == 'claude': 
+            # this query's outputs go to a fork of the refiner, so they don't pile up in its instructions across queries 
+            refiner = self.refiner_agent.fork() 
+            if refiner.name == 'claude': 
                 # user message needs to be first with claude calls 
-                self.refiner_agent.add_user_instructions(mssg=query) 
+                refiner.add_user_instructions(mssg=query) 
 
-            self.refiner_agent.add_sys_instructions(f"Below is the output of {self.num_base_agents} agents to the query: {query}\n\n{responses}\n\nBased on these outputs and the original query, please provide a clear and concise answer to the original query. Make sure your answer is not just a summary of the above outputs, but an actual answer to the original question.") 
+            refiner.add_sys_instructions(f"Below is the output of {len(list_responses)} agents to the query: {query}\n\n{responses}\n\nBased on these outputs and the original query, please provide a clear and concise answer to the original query. Make sure your answer is not just a summary of the above outputs, but an actual answer to the original question.") 
 
-            final_answer = self.refiner_agent.generate(f"Given the query **{query}** and above outputs, provide the most helpful response for the user.")
+            with tracing.span('ensemble.refine', strategy='agent'): 
+                final_answer = refiner.generate(f"Given the query **{query}** and above outputs, provide the most helpful response for the user.")
 
             return final_answer 
-        
+    
         return None
@@ -1,32 +1,217 @@
-import requests
 import json 
+import threading 
+import time 
 
-from marshall.llms.gpt import GPT 
+import numpy as np
 
-def embed_text(text: str, model='text-embedding-3-small'):   
+from marshall.core.transport import get_default_transport
+from marshall.core import ratelimit
+from marshall.core import tracing
+from marshall.core import env
+from marshall.tools.embed_cache import get_default_cache
 
-    assert model == 'text-embedding-3-small', 'currently, only `text-embedding-3-small` model is supported'
+# the embeddings endpoint accepts at most 2048 inputs per request
+MAX_BATCH_SIZE = 2048
+
+# vector size per model, for answering an empty input without a request
+EMBEDDING_DIMS = {'text-embedding-3-small': 1536}
+
+# when set (see `EmbeddingBatcher.activate`), cache misses from every thread are merged into shared requests
+_batcher = None
+
+def embed_text(text: str, model='text-embedding-3-small', transport=None, cache=None, base_url=None):   
 
     "basic function that just uses gpt class to get 'text-embedding-3-small' embedding"
 
-    ai = GPT(model_name=None) 
+    embeddings = embed_texts([text], model=model, transport=transport, cache=cache, base_url=base_url) 
+    if embeddings is None:
+        return None
+
+    return embeddings[0].tolist()
+
+def embed_texts(texts: list[str], model='text-embedding-3-small', transport=None, batch_size=MAX_BATCH_SIZE, cache=None, base_url=None): 
+
+    """
+    embeds a list of texts with one request per `batch_size` texts (an array `input`) instead of one request per text
+
+    cache: an `EmbeddingCache` to read from/write to, defaults to the process-wide in-memory cache. pass cache=False to always hit the network. 
+    only texts that miss the cache are sent (once each, even if repeated in `texts`)
+
+    base_url (optional): OpenAI-compatible API root, defaults to OPENAI_BASE_URL or the OpenAI API
+
+    returns a float32 array of shape (len(texts), dim) with rows in the same order as `texts`, or None if a request fails. 
+    no texts gives an empty (0, dim) array without a request
+    """
+
+    assert model == 'text-embedding-3-small', 'currently, only `text-embedding-3-small` model is supported'
+
+    if not len(texts): 
+        return np.empty((0, EMBEDDING_DIMS.get(model, 0)), dtype=np.float32) 
+
+    if cache is None: 
+        cache = get_default_cache() 
 
-    url = 'https://api.openai.com/v1/embeddings'   
+    # vectors are cached per API root, a mock or proxy never shares them with the real API 
+    root = env.get_base_url('openai', base_url) 
+    cached = [cache.get(model, text, root) for text in texts] if cache else [None] * len(texts)
+    # unique texts we still need, in first-seen order 
+    missing = list(dict.fromkeys(text for text, vec in zip(texts, cached) if vec is None)) 
+
+    if missing: 
+        with tracing.span('embed', model=model, texts=len(texts), fetched=len(missing)): 
+            request = _batcher.request if _batcher is not None else _request_embeddings 
+            fetched = request(missing, model=model, transport=transport, batch_size=batch_size, base_url=base_url) 
+        if fetched is None: 
+            return None 
+
+        if cache: 
+            cache.set_many(model, missing, fetched, root) 
+
+        lookup = dict(zip(missing, fetched)) 
+        cached = [vec if vec is not None else lookup[text] for text, vec in zip(texts, cached)]
+
+    return np.asarray(cached, dtype=np.float32).reshape(len(texts), -1)
+
+def _request_embeddings(texts: list[str], model: str, transport=None, batch_size=MAX_BATCH_SIZE, base_url=None): 
+
+    url = env.get_base_url('openai', base_url) + '/embeddings'   
     # Headers
     headers = {
         'Content-Type': 'application/json',
-        'Authorization': f'Bearer {ai.api_key}',
+        'Authorization': f"Bearer {env.get_api_key('openai')}",
     } 
 
-    # Data payload
-    data = {
-        'input': text,
-        'model': model
-    } 
+    # Make the POST requests (over the shared, pooled transport unless one is passed in)
+    transport = transport if transport is not None else get_default_transport()
 
-    # Make the POST request
-    response = requests.post(url, headers=headers, data=json.dumps(data)) 
-    if response.status_code != 200:
-        return None
+    rows = []
+    for start in range(0, len(texts), batch_size): 
+        data = {
+            'input': texts[start:start + batch_size],
+            'model': model
+        } 
+
+        # rate limited + retried like the LLM calls 
+        response = ratelimit.send(transport, url, headers, json.dumps(data), provider='openai-embeddings', model=model, raise_errors=False) 
+        if response.status_code != 200:
+            return None
+
+        body = response.json() 
+        tracing.record_usage(tracing.current_span(), body) 
+
+        # results carry an `index`, don't rely on the order they come back in
+        items = sorted(body['data'], key=lambda x: x['index'])
+        rows.extend(item['embedding'] for item in items)
+
+    return np.asarray(rows, dtype=np.float32)
+
+class _Pending: 
+
+    def __init__(self, texts: list[str]) -> None: 
+
+        self.texts = texts 
+        self.result = None 
+        self.error = None 
+        self.done = threading.Event() 
+
+class EmbeddingBatcher: 
+
+    def __init__(self, max_batch: int = MAX_BATCH_SIZE, max_wait: float = 0.02) -> None: 
+
+        """
+        micro-batches embedding requests across threads (e.g. across the queries of a batch run): 
+        the first caller of a window waits up to `max_wait` seconds (or until `max_batch` texts are queued) for others to join, 
+        then a single request embeds the union of their (deduplicated) texts and every caller gets its own rows back 
+
+        use `with batcher.activate(): ...` (or `set_batcher`) to route every `embed_texts` cache miss through it
+        """
+
+        self.max_batch = max_batch 
+        self.max_wait = max_wait 
+
+        self.calls = 0 # embed_texts calls routed through the batcher 
+        self.requests = 0 # batches actually sent 
+
+        self._open = {} # (model, base_url) -> batch still accepting callers 
+        self._cond = threading.Condition() 
+
+    def request(self, texts: list[str], model: str, transport=None, batch_size=MAX_BATCH_SIZE, base_url=None): 
+
+        """drop-in for `_request_embeddings`: returns a float32 array of rows for `texts`, or None if the request failed"""
+
+        item = _Pending(texts) 
+        key = (model, base_url) 
+
+        with self._cond: 
+            self.calls += 1 
+            batch = self._open.get(key) 
+            leader = batch is None 
+            if leader: 
+                batch = self._open[key] = {'items': [], 'size': 0} 
+            batch['items'].append(item) 
+            batch['size'] += len(texts) 
+            if batch['size'] >= self.max_batch: 
+                self._cond.notify_all() 
+
+        if leader: 
+            with self._cond: 
+                deadline = time.monotonic() + self.max_wait 
+                while batch['size'] < self.max_batch and deadline - time.monotonic() > 0: 
+                    self._cond.wait(deadline - time.monotonic()) 
+                del self._open[key] 
+                self.requests += 1 
+            self._send(batch['items'], model, transport, batch_size, base_url) 
+
+        item.done.wait() 
+        if item.error is not None: 
+            raise item.error 
+
+        return item.result 
+
+    def _send(self, items: list, model: str, transport, batch_size: int, base_url): 
+
+        unique = list(dict.fromkeys(text for item in items for text in item.texts)) 
+        try: 
+            fetched = _request_embeddings(unique, model=model, transport=transport, batch_size=batch_size, base_url=base_url) 
+            rows = dict(zip(unique, fetched)) if fetched is not None else None 
+            for item in items: 
+                item.result = np.asarray([rows[text] for text in item.texts], dtype=np.float32) if rows is not None else None 
+        except Exception as e: 
+            for item in items: 
+                item.error = e 
+        finally: 
+            # callers block on this, it has to be set whatever happened 
+            for item in items: 
+                item.done.set() 
+
+    def activate(self): 
+
+        return _BatcherScope(self) 
+
+    def stats(self) -> dict: 
+
+        return {'calls': self.calls, 'requests': self.requests} 
+
+class _BatcherScope: 
+
+    def __init__(self, batcher: EmbeddingBatcher) -> None: 
+
+        self.batcher = batcher 
+        self.previous = None 
+
+    def __enter__(self): 
+
+        self.previous = _batcher 
+        set_batcher(self.batcher) 
+        return self.batcher 
+
+    def __exit__(self, *exc): 
+
+        set_batcher(self.previous) 
+
+def set_batcher(batcher: EmbeddingBatcher): 
+
+    """routes `embed_texts` cache misses through `batcher` process-wide (None turns batching off)"""
 
-    return response.json()['data'][0]['embedding']
\ No newline at end of file
+    global _batcher 
+    _batcher = batcher 
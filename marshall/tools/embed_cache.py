@@ -0,0 +1,142 @@
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+from marshall.core.cache import LRUCache, MISSING
+from marshall.core.env import PROVIDER_ENV
+
+DEFAULT_BASE_URL = PROVIDER_ENV['openai']['default_base_url']
+
+
+def text_key(model: str, text: str, base_url: str = None) -> tuple:
+
+    """
+    content address of an embedding: (model, sha256 of the text). vectors from an API other than OpenAI's (a proxy, a local mock)
+    are kept apart under 'model@base_url', so they never answer for (or get answered by) the real model's
+    """
+
+    if base_url and base_url.rstrip('/') != DEFAULT_BASE_URL:
+        model = f"{model}@{base_url.rstrip('/')}"
+
+    return (model, hashlib.sha256(text.encode('utf-8')).hexdigest())
+
+
+class EmbeddingCache:
+
+    def __init__(self, maxsize: int = 10000, path: str = None) -> None:
+
+        """
+        two tier, content-addressed embedding cache keyed by (model, sha256(text)), see `text_key` for vectors from other base urls
+
+        - maxsize: number of vectors kept in the in-memory LRU tier
+        - path (optional): sqlite file for a persistent tier, vectors are stored as raw float32 blobs and survive restarts
+
+        vectors are returned as float32 numpy arrays
+        """
+
+        self.memory = LRUCache(maxsize=maxsize)
+        self.path = path
+
+        self.disk_hits = 0
+
+        self._conn = None
+        self._lock = threading.Lock()
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vec BLOB, PRIMARY KEY (model, hash))")
+            self._conn.commit()
+
+    def get(self, model: str, text: str, base_url: str = None):
+
+        key = text_key(model, text, base_url)
+
+        vec = self.memory.get(key)
+        if vec is not MISSING:
+            return vec
+
+        if self._conn is None:
+            return None
+
+        with self._lock:
+            row = self._conn.execute("SELECT vec FROM embeddings WHERE model = ? AND hash = ?", key).fetchone()
+
+        if row is None:
+            return None
+
+        # promote to the memory tier
+        self.disk_hits += 1
+        vec = np.frombuffer(row[0], dtype=np.float32)
+        self.memory.set(key, vec)
+        return vec
+
+    def set_many(self, model: str, texts: list[str], vecs: np.ndarray, base_url: str = None):
+
+        keys = [text_key(model, text, base_url) for text in texts]
+        vecs = np.asarray(vecs, dtype=np.float32)
+
+        for key, vec in zip(keys, vecs):
+            self.memory.set(key, vec)
+
+        if self._conn is not None:
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, hash, vec) VALUES (?, ?, ?)",
+                    [(key[0], key[1], vec.tobytes()) for key, vec in zip(keys, vecs)]
+                )
+                self._conn.commit()
+
+    def set(self, model: str, text: str, vec, base_url: str = None):
+
+        self.set_many(model, [text], [vec], base_url)
+
+    def clear(self):
+
+        self.memory.clear()
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute("DELETE FROM embeddings")
+                self._conn.commit()
+
+    def close(self):
+
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self) -> dict:
+
+        memory = self.memory.stats()
+        return {
+            'hits': memory['hits'] + self.disk_hits,
+            'misses': memory['misses'] - self.disk_hits,
+            'memory_hits': memory['hits'],
+            'disk_hits': self.disk_hits,
+            'size': memory['size'],
+        }
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache() -> EmbeddingCache:
+
+    """returns the process-wide in-memory embedding cache used by `embed_text`/`embed_texts` unless told otherwise"""
+
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                _default_cache = EmbeddingCache()
+
+    return _default_cache
+
+
+def set_default_cache(cache: EmbeddingCache):
+
+    """swap the process-wide embedding cache (e.g. for one with a persistent sqlite tier)"""
+
+    global _default_cache
+    _default_cache = cache
@@ -0,0 +1,249 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from marshall.core.cache import MISSING
+from marshall.core import tracing
+from marshall.tools.embed import embed_text
+from marshall.tools.vector_search import VectorIndex
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+
+    def __init__(self, threshold: float = 0.95, maxsize: int = 10000, ttl: float = None, transport=None, base_url=None) -> None:
+
+        """
+        answer cache keyed by the meaning of a prompt rather than its exact bytes
+
+        prompts are embedded with `embed_text` and looked up in an in-process `VectorIndex` (one per namespace), a cached answer is returned
+        when the nearest cached prompt is at least `threshold` cosine similar. namespaces keep answers apart that were produced under different
+        system prompts / models / configs (see `core.cache.namespace_key`), a hit never crosses namespaces
+
+        - threshold: cosine similarity needed for a hit. near-duplicates of short prompts typically score > 0.95, too low a threshold returns answers to different questions
+        - maxsize: max number of answers across all namespaces, the least recently used one is evicted past this
+        - ttl (optional): seconds after which an answer expires
+        - transport / base_url (optional): passed on to the embedding requests
+
+        answers are only cached when they're not None. prompt embeddings go through the embedding cache, so storing an answer after a miss doesn't re-embed.
+        the cache never fails a request: if a prompt can't be embedded it counts as a miss (and an `embed_failures`) and the answer is computed as usual
+        """
+
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.transport = transport
+        self.base_url = base_url
+
+        self._indexes = {} # namespace -> VectorIndex over its prompts
+        self._entries = OrderedDict() # id -> {'namespace', 'prompt', 'answer', 'created'}, in LRU order
+        self._created = OrderedDict() # id -> created, oldest first (ids only grow), for expiring entries
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.embed_failures = 0
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def _embed(self, prompt: str):
+
+        # None if the embedding request fails (after its retries), the caller then goes without the cache
+        try:
+            vec = embed_text(str(prompt), transport=self.transport, base_url=self.base_url)
+        except Exception as e:
+            vec = None
+            logger.warning('semantic cache: embedding failed, skipping the cache (%s: %s)', type(e).__name__, e)
+        else:
+            if vec is None:
+                logger.warning('semantic cache: embedding request failed, skipping the cache')
+
+        if vec is None:
+            with self._lock:
+                self.embed_failures += 1
+            return None
+
+        return np.asarray(vec, dtype=np.float32)
+
+    def _remove(self, ids: list):
+
+        # caller holds the lock
+        by_namespace = {}
+        for i in ids:
+            self._created.pop(i, None)
+            entry = self._entries.pop(i, None)
+            if entry is not None:
+                by_namespace.setdefault(entry['namespace'], []).append(i)
+
+        for namespace, dead in by_namespace.items():
+            index = self._indexes[namespace]
+            index.delete(dead)
+            if not len(index):
+                del self._indexes[namespace]
+            elif index._n > 2 * len(index) + 64:
+                # mostly tombstones, re-pack so searches stop scanning dead rows
+                index.compact()
+
+    def _expire(self):
+
+        # caller holds the lock. drops every expired entry (oldest first), so a search never lands on one
+        if not self.ttl:
+            return
+
+        cutoff = time.monotonic() - self.ttl
+        expired = list(itertools.takewhile(lambda i: self._created[i] < cutoff, self._created))
+        if expired:
+            self._remove(expired)
+            self.expirations += len(expired)
+
+    def lookup(self, prompt: str, namespace: str = '', vector=None):
+
+        """the cached answer for the closest prompt in `namespace` if it's similar enough, else `MISSING`"""
+
+        with self._lock:
+            self._expire()
+            if namespace not in self._indexes:
+                self.misses += 1
+                return MISSING
+
+        vector = self._embed(prompt) if vector is None else vector
+        if vector is None:
+            with self._lock:
+                self.misses += 1
+            return MISSING
+
+        with self._lock:
+            self._expire()
+            index = self._indexes.get(namespace)
+            hits = index.search(vector, k=1) if index is not None else []
+            if not hits or hits[0]['score'] < self.threshold:
+                self.misses += 1
+                return MISSING
+
+            entry = self._entries[hits[0]['id']]
+            self._entries.move_to_end(hits[0]['id'])
+            self.hits += 1
+            tracing.current_span().set('semantic_score', hits[0]['score'])
+            return entry['answer']
+
+    def store(self, prompt: str, answer, namespace: str = '', vector=None):
+
+        if answer is None:
+            return
+
+        vector = self._embed(prompt) if vector is None else vector
+        if vector is None:
+            return
+
+        with self._lock:
+            self._expire()
+            i = next(self._ids)
+            index = self._indexes.get(namespace)
+            if index is None:
+                index = self._indexes[namespace] = VectorIndex(dim=len(vector), capacity=64)
+            index.add(vector[None, :], ids=[i])
+            self._entries[i] = {'namespace': namespace, 'prompt': prompt, 'answer': answer, 'created': time.monotonic()}
+            self._created[i] = self._entries[i]['created']
+
+            if len(self._entries) > self.maxsize:
+                evict = list(itertools.islice(self._entries, len(self._entries) - self.maxsize))
+                self._remove(evict)
+                self.evictions += len(evict)
+
+    def get_or_compute(self, prompt: str, namespace: str, compute):
+
+        """the cached answer for `prompt`, or `compute()` (which is then cached)"""
+
+        with tracing.span('semantic_cache', namespace=namespace) as span:
+            vector = self._embed(prompt)
+            answer = self.lookup(prompt, namespace, vector=vector) if vector is not None else self._miss()
+            span.set('hit', answer is not MISSING)
+        if answer is not MISSING:
+            return answer
+
+        answer = compute()
+        if vector is not None:
+            self.store(prompt, answer, namespace, vector=vector)
+        return answer
+
+    async def aget_or_compute(self, prompt: str, namespace: str, acompute):
+
+        """async version of `get_or_compute`, `acompute` is a zero arg coroutine function (the embedding lookups run in a worker thread)"""
+
+        with tracing.span('semantic_cache', namespace=namespace) as span:
+            vector = await asyncio.to_thread(self._embed, prompt)
+            answer = self.lookup(prompt, namespace, vector=vector) if vector is not None else self._miss()
+            span.set('hit', answer is not MISSING)
+        if answer is not MISSING:
+            return answer
+
+        answer = await acompute()
+        if vector is not None:
+            self.store(prompt, answer, namespace, vector=vector)
+        return answer
+
+    def _miss(self):
+
+        with self._lock:
+            self.misses += 1
+
+        return MISSING
+
+    def invalidate(self, namespace: str = None, prompt: str = None) -> int:
+
+        """
+        drops cached answers: everything in `namespace`, only those matching `prompt` (at the hit threshold) in it,
+        or with neither, everything. returns the number of answers dropped
+        """
+
+        if namespace is None and prompt is None:
+            return self.clear()
+
+        vector = self._embed(prompt) if prompt is not None else None
+        if prompt is not None and vector is None:
+            raise RuntimeError("couldn't embed the prompt to invalidate, nothing was dropped")
+
+        with self._lock:
+            namespaces = [namespace] if namespace is not None else list(self._indexes)
+            dead = []
+            for ns in namespaces:
+                index = self._indexes.get(ns)
+                if index is None:
+                    continue
+                if vector is None:
+                    dead.extend(i for i, e in self._entries.items() if e['namespace'] == ns)
+                else:
+                    dead.extend(h['id'] for h in index.search(vector, k=len(index)) if h['score'] >= self.threshold)
+            self._remove(dead)
+
+        return len(dead)
+
+    def clear(self) -> int:
+
+        with self._lock:
+            n = len(self._entries)
+            self._entries.clear()
+            self._created.clear()
+            self._indexes.clear()
+
+        return n
+
+    def stats(self) -> dict:
+
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.,
+            'evictions': self.evictions, 'expirations': self.expirations, 'embed_failures': self.embed_failures,
+            'size': len(self._entries), 'namespaces': len(self._indexes),
+        }
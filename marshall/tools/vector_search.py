@@ -0,0 +1,376 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from marshall.tools.embed import embed_texts
+
+
+class VectorIndex:
+
+    def __init__(self, dim: int = None, metric: str = 'cosine', capacity: int = 1024) -> None:
+
+        """
+        in-process vector index over embeddings
+
+        vectors live in one contiguous float32 array (grown by doubling), so exact search is a single matmul.
+        for large corpora call `build_ivf` to switch to approximate (IVF) search, which only scores the vectors in the `nprobe` closest clusters
+
+        - dim: vector dimension (inferred from the first add if not given)
+        - metric: 'cosine' (vectors are L2 normalized on the way in) or 'ip' (raw inner product)
+        - capacity: initial number of rows to allocate
+        """
+
+        assert metric in ('cosine', 'ip'), "metric must be one of 'cosine', 'ip'"
+
+        self.dim = dim
+        self.metric = metric
+        self.embedding_model = 'text-embedding-3-small'
+
+        self._vecs = np.zeros((capacity, dim), dtype=np.float32) if dim else None
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._n = 0 # rows used (including deleted ones)
+
+        self.ids = [] # row -> external id
+        self.payloads = [] # row -> payload (e.g. the source text)
+        self._rows = {} # external id -> row
+        self._next_id = 0
+
+        # ivf state (None until `build_ivf` is called)
+        self.centroids = None
+        self.nprobe = None
+        self._assign = None
+        self._lists = None
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+
+        return len(self._rows)
+
+    def _prepare(self, vectors) -> np.ndarray:
+
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+
+        return np.ascontiguousarray(vectors)
+
+    def _reserve(self, n: int):
+
+        if self._vecs is None:
+            self._vecs = np.zeros((max(n, 1024), self.dim), dtype=np.float32)
+            self._alive = np.zeros(len(self._vecs), dtype=bool)
+
+        capacity = max(len(self._vecs), 1)
+        # memory-mapped (loaded) storage is read only, so copy it into ram on the first write
+        if self._n + n <= capacity and self._vecs.flags.writeable:
+            return
+
+        while self._n + n > capacity:
+            capacity *= 2
+
+        vecs = np.zeros((capacity, self.dim), dtype=np.float32)
+        vecs[:self._n] = self._vecs[:self._n]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._n] = self._alive[:self._n]
+        self._vecs, self._alive = vecs, alive
+
+        if self._assign is not None:
+            assign = np.full(capacity, -1, dtype=np.int32)
+            assign[:self._n] = self._assign[:self._n]
+            self._assign = assign
+
+    def add(self, vectors, ids: list = None, payloads: list = None) -> list:
+
+        """adds vectors (re-adding an existing id replaces it), returns their ids"""
+
+        vectors = self._prepare(vectors)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        assert vectors.shape[1] == self.dim, f"expected vectors of dim {self.dim}, got {vectors.shape[1]}"
+
+        with self._lock:
+            if ids is None:
+                ids = list(range(self._next_id, self._next_id + len(vectors)))
+            assert len(ids) == len(vectors), "need one id per vector"
+            payloads = payloads if payloads is not None else [None] * len(vectors)
+
+            self._delete([i for i in ids if i in self._rows])
+            self._reserve(len(vectors))
+
+            start, end = self._n, self._n + len(vectors)
+            self._vecs[start:end] = vectors
+            self._alive[start:end] = True
+            for row, (i, payload) in enumerate(zip(ids, payloads), start=start):
+                self.ids.append(i)
+                self.payloads.append(payload)
+                self._rows[i] = row
+                if isinstance(i, int):
+                    self._next_id = max(self._next_id, i + 1)
+            self._n = end
+
+            if self.centroids is not None:
+                self._assign_rows(np.arange(start, end))
+
+        return ids
+
+    def add_texts(self, texts: list[str], ids: list = None, metadata: list = None) -> list:
+
+        """embeds `texts` (one batched request) and adds them, the text (and metadata if given) is kept as the payload"""
+
+        vectors = embed_texts(texts, model=self.embedding_model)
+        assert vectors is not None, "embedding request failed"
+
+        metadata = metadata if metadata is not None else [None] * len(texts)
+        payloads = [{'text': text, 'metadata': meta} for text, meta in zip(texts, metadata)]
+
+        return self.add(vectors, ids=ids, payloads=payloads)
+
+    def _delete(self, ids: list):
+
+        for i in ids:
+            row = self._rows.pop(i, None)
+            if row is not None:
+                # tombstone, the row is reclaimed on `compact`
+                self._alive[row] = False
+
+    def delete(self, ids: list):
+
+        with self._lock:
+            self._delete(ids)
+
+    def compact(self):
+
+        """drops deleted rows and re-packs storage contiguously"""
+
+        with self._lock:
+            keep = np.flatnonzero(self._alive[:self._n])
+            self._vecs = np.ascontiguousarray(self._vecs[keep])
+            self._alive = np.ones(len(keep), dtype=bool)
+            self.ids = [self.ids[r] for r in keep]
+            self.payloads = [self.payloads[r] for r in keep]
+            self._rows = {i: row for row, i in enumerate(self.ids)}
+            self._n = len(keep)
+
+            if self.centroids is not None:
+                self._assign = np.ascontiguousarray(self._assign[keep])
+                self._rebuild_lists()
+
+    # approximate search
+
+    def build_ivf(self, nlist: int = None, nprobe: int = 8, iters: int = 10, sample_size: int = 100000, seed: int = 0):
+
+        """
+        clusters the vectors with k-means into `nlist` inverted lists. searches then only score the vectors in the `nprobe` lists whose centroids are closest to the query
+        vectors added later are assigned to their nearest existing centroid
+        """
+
+        rng = np.random.default_rng(seed)
+        rows = np.flatnonzero(self._alive[:self._n])
+        assert len(rows) > 0, "index is empty"
+
+        nlist = nlist or max(1, int(np.sqrt(len(rows))))
+        nlist = min(nlist, len(rows))
+
+        sample = rows if len(rows) <= sample_size else rng.choice(rows, sample_size, replace=False)
+        x = self._vecs[sample]
+        centroids = x[rng.choice(len(x), nlist, replace=False)].copy()
+
+        for _ in range(iters):
+            assign = np.argmax(x @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, x)
+            counts = np.bincount(assign, minlength=nlist)
+            nonempty = counts > 0
+            # empty clusters keep their previous centroid
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+            if self.metric == 'cosine':
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+            self.nprobe = nprobe
+            self._assign = np.full(len(self._vecs), -1, dtype=np.int32)
+            self._lists = None
+            self._assign_rows(np.arange(self._n))
+
+    def _assign_rows(self, rows: np.ndarray):
+
+        if len(rows) == 0:
+            return
+        assign = np.argmax(self._vecs[rows] @ self.centroids.T, axis=1)
+        self._assign[rows] = assign
+
+        if self._lists is None:
+            self._rebuild_lists()
+            return
+
+        # incremental add: only the touched inverted lists are extended
+        for c in np.unique(assign):
+            self._lists[c] = np.concatenate([self._lists[c], rows[assign == c]])
+
+    def _rebuild_lists(self):
+
+        order = np.argsort(self._assign[:self._n], kind='stable')
+        bounds = np.searchsorted(self._assign[:self._n][order], np.arange(len(self.centroids) + 1))
+        self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def _candidates(self, queries: np.ndarray, nprobe: int) -> np.ndarray:
+
+        nprobe = min(nprobe, len(self.centroids))
+        probe = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        return np.unique(np.concatenate([self._lists[c] for c in np.unique(probe)]))
+
+    # search
+
+    def search(self, vectors, k: int = 5, exact: bool = None, nprobe: int = None) -> list:
+
+        """
+        top-k search for one or more query vectors
+
+        exact: force brute-force (True) or ivf (False) search, defaults to ivf when it's been built
+        returns (for each query) a list of dicts with 'id', 'score' and 'payload', best first
+        """
+
+        queries = self._prepare(vectors)
+        single = np.asarray(vectors).ndim == 1
+
+        with self._lock:
+            if self._n == 0:
+                # nothing added yet (the vector array may not even exist, its dim comes from the first add)
+                return [] if single else [[] for _ in queries]
+
+            use_ivf = self.centroids is not None if exact is None else not exact
+            if use_ivf:
+                rows = self._candidates(queries, nprobe or self.nprobe)
+                rows = rows[self._alive[rows]]
+            else:
+                rows = None
+
+            vecs = self._vecs[rows] if rows is not None else self._vecs[:self._n]
+            scores = queries @ vecs.T
+            if rows is None:
+                scores[:, ~self._alive[:self._n]] = -np.inf
+
+            k = min(k, scores.shape[1])
+            results = []
+            for q_scores in scores:
+                if k == 0:
+                    results.append([])
+                    continue
+                top = np.argpartition(-q_scores, k - 1)[:k]
+                top = top[np.argsort(-q_scores[top])]
+                hits = []
+                for j in top:
+                    if q_scores[j] == -np.inf:
+                        break
+                    row = rows[j] if rows is not None else j
+                    hits.append({'id': self.ids[row], 'score': float(q_scores[j]), 'payload': self.payloads[row]})
+                results.append(hits)
+
+        return results[0] if single else results
+
+    def search_text(self, query: str, k: int = 5, **kwargs) -> list:
+
+        vectors = embed_texts([query], model=self.embedding_model)
+        assert vectors is not None, "embedding request failed"
+
+        return self.search(vectors[0], k=k, **kwargs)
+
+    # persistence
+
+    def save(self, path: str):
+
+        """writes the index to the directory `path` (vectors as .npy so they can be memory-mapped back in)"""
+
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            np.save(os.path.join(path, 'vectors.npy'), self._vecs[:self._n])
+            np.save(os.path.join(path, 'alive.npy'), self._alive[:self._n])
+            if self.centroids is not None:
+                np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+                np.save(os.path.join(path, 'assign.npy'), self._assign[:self._n])
+
+            meta = {
+                'dim': self.dim,
+                'metric': self.metric,
+                'nprobe': self.nprobe,
+                'embedding_model': self.embedding_model,
+                'ids': self.ids,
+                'payloads': self.payloads,
+                'next_id': self._next_id,
+            }
+            with open(os.path.join(path, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+
+        """loads an index saved with `save`, with mmap=True the vectors are memory-mapped instead of read into ram"""
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        index = cls(dim=meta['dim'], metric=meta['metric'], capacity=0)
+        index.embedding_model = meta['embedding_model']
+        index._vecs = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r' if mmap else None)
+        index._alive = np.load(os.path.join(path, 'alive.npy'))
+        index._n = len(index._vecs)
+        index.ids = meta['ids']
+        index.payloads = meta['payloads']
+        index._rows = {i: row for row, i in enumerate(index.ids) if index._alive[row]}
+        index._next_id = meta['next_id']
+
+        if os.path.exists(os.path.join(path, 'centroids.npy')):
+            index.centroids = np.load(os.path.join(path, 'centroids.npy'))
+            index.nprobe = meta['nprobe']
+            index._assign = np.load(os.path.join(path, 'assign.npy'))
+            index._rebuild_lists()
+
+        return index
+
+    # toolkit integration
+
+    def register(self, toolkit, name: str = 'default'):
+
+        """makes this index searchable by agents through the `vector_search` tool"""
+
+        _indexes[name] = self
+        if 'vector_search' not in toolkit.tool_dict:
+            toolkit.add_tool(
+                func=vector_search,
+                tool_desc="Semantic search over a document index. Returns a list of the k most relevant documents (dicts with 'id', 'score' and 'text'), best first. Use like vector_search(query='...', k=5, index='default')",
+                input_dict={
+                    'query': {'type': 'string', 'description': 'natural language search query'},
+                    'k': {'type': 'integer', 'description': 'number of results to return'},
+                    'index': {'type': 'string', 'description': 'name of the index to search'},
+                },
+                required_params=['query']
+            )
+
+
+# registry of indexes reachable from the `vector_search` tool
+_indexes = {}
+
+
+def get_index(name: str = 'default') -> VectorIndex:
+
+    assert name in _indexes, f"no vector index registered under '{name}'"
+    return _indexes[name]
+
+
+def vector_search(query: str, k: int = 5, index: str = 'default') -> list:
+
+    # imported here so the tool still works when its source is exec'd on its own
+    from marshall.tools.vector_search import get_index
+
+    results = []
+    for hit in get_index(index).search_text(query, k=k):
+        payload = hit['payload']
+        text = payload.get('text') if isinstance(payload, dict) else payload
+        results.append({'id': hit['id'], 'score': hit['score'], 'text': text})
+
+    return results
@@ -0,0 +1,39 @@
+import json
+
+from marshall.core.llm import LLM
+
+
+class FakeModel(LLM):
+
+    """
+    offline stand-in for a provider model, it records the prompts (and contexts) it gets
+
+    reply: the answer to every prompt, a list of answers handed out in order, or a callable(prompt) -> answer (which may raise).
+    dict answers are returned as JSON. forks share the reply queue and the recorded prompts
+    """
+
+    def __init__(self, reply=None, name: str = 'fake', **kwargs) -> None:
+
+        super().__init__(name, transport=object(), **kwargs)
+        self.name = name
+        self.reply = reply
+        self.prompts = []
+        self.contexts = []
+
+    def add_sys_instructions(self, instructions: str):
+
+        self.conversation = self.conversation.append({'role': 'system', 'content': instructions})
+
+    def generate(self, prompt: str, context: list = None):
+
+        self.prompts.append(prompt)
+        self.contexts.append(context)
+
+        if callable(self.reply):
+            answer = self.reply(prompt)
+        elif isinstance(self.reply, list):
+            answer = self.reply.pop(0)
+        else:
+            answer = self.reply
+
+        return json.dumps(answer) if isinstance(answer, dict) else answer
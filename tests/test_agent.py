@@ -0,0 +1,16 @@
+from conftest import FakeModel
+from marshall.core.agent import NO_DISPATCH, Agent
+
+
+def test_build_log_answers_directly_at_max_depth():
+
+    model = FakeModel([{'decision': 'dispatch', 'content': ['look it up', 'sum it up']}])
+    agent = Agent(model, model, model, max_depth=0, parallel=False)
+
+    agent.build_log('what is 2 + 2?')
+
+    # the model was told not to dispatch, and its dispatch was kept as the answer rather than logged as work that never ran
+    assert NO_DISPATCH in model.contexts[0]
+    assert len(model.prompts) == 1
+    assert 'dispatched' not in agent.result_log
+    assert 'look it up' in agent.result_log
@@ -0,0 +1,69 @@
+import pytest
+
+from conftest import FakeModel
+from marshall.core.agent import Agent
+from marshall.core.sandbox import Sandbox
+
+
+def code(content: str) -> dict:
+
+    return {'decision': 'code_execute', 'content': content}
+
+
+def make_agent(replies: list, sandbox=None):
+
+    model = FakeModel(replies)
+    agent = Agent(model, model, model, sandbox=sandbox, parallel=False)
+    # the agent works on forks, they share the reply queue and prompt log with `model`
+    return agent, model
+
+
+def test_exception_marks_failure_and_retries():
+
+    agent, model = make_agent([code("result = 1 / 0"), code("result = 2")])
+
+    out = agent.make_decision1("divide")
+
+    assert out['success'] is False
+    assert 'ZeroDivisionError' in out['message']
+    assert len(model.prompts) == 2
+    assert 'ZeroDivisionError' in model.prompts[1]
+
+
+def test_make_decision_reports_failure():
+
+    agent, _ = make_agent([code("raise ValueError('boom')")])
+
+    out = agent.make_decision("task")
+
+    assert out['success'] is False
+    assert 'ValueError: boom' in out['message']
+
+
+@pytest.fixture
+def sandbox():
+
+    with Sandbox(num_workers=1, timeout=0.5) as sb:
+        yield sb
+
+
+def test_sandbox_timeout_marks_failure_and_retries(sandbox):
+
+    agent, model = make_agent([code("while True: pass"), code("result = 2")], sandbox=sandbox)
+
+    out = agent.make_decision1("spin")
+
+    assert out['success'] is False
+    assert 'TimeoutError' in out['message']
+    assert len(model.prompts) == 2
+    assert 'TimeoutError' in model.prompts[1]
+
+
+def test_sandbox_success(sandbox):
+
+    agent, _ = make_agent([code("result = 6 * 7")], sandbox=sandbox)
+
+    out = agent.make_decision1("multiply")
+
+    assert out['success'] is True
+    assert 'The result was: 42' in out['message']
@@ -0,0 +1,39 @@
+import json
+
+from marshall.pipelines.batch import BatchRunner, completed_ids, read_results
+
+
+def lines(path):
+
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume_after_a_cut_short_line(tmp_path):
+
+    output = tmp_path / 'results.jsonl'
+    output.write_text(json.dumps({'id': '0', 'query': 'a', 'result': 'A', 'error': None}) + '\n' + '{"id": "1", "que')
+
+    BatchRunner(str.upper, batch_embeddings=False).run(['a', 'b', 'c'], output=str(output))
+
+    # every line parses, the interrupted query was rerun once and the finished one wasn't
+    assert sorted(r['id'] for r in lines(output)) == ['0', '1', '2']
+    assert completed_ids(str(output)) == {'0', '1', '2'}
+
+
+def test_retried_failures_keep_the_last_record(tmp_path):
+
+    output = str(tmp_path / 'results.jsonl')
+    attempts = []
+
+    def flaky(query):
+        attempts.append(query)
+        if len(attempts) == 1:
+            raise RuntimeError('provider down')
+        return query.upper()
+
+    BatchRunner(flaky, max_queries=1, batch_embeddings=False).run(['a'], output=output)
+    BatchRunner(flaky, max_queries=1, batch_embeddings=False).run(['a'], output=output)
+
+    assert [r['error'] is None for r in lines(output)] == [False, True]
+    assert read_results(output)['0']['result'] == 'A'
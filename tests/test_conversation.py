@@ -0,0 +1,61 @@
+from conftest import FakeModel
+from marshall.core.conversation import Conversation
+
+
+def test_appends_share_the_prefix():
+
+    base = Conversation().append({'role': 'system', 'content': 'be brief'})
+    left = base.append({'role': 'user', 'content': 'left'})
+    right = base.append({'role': 'user', 'content': 'right'})
+
+    assert left.parent is base and right.parent is base
+    assert left[0] is right[0]
+    assert len(base) == 1 and len(left) == len(right) == 2
+    assert left == [{'role': 'system', 'content': 'be brief'}, {'role': 'user', 'content': 'left'}]
+    assert right[-1] == {'role': 'user', 'content': 'right'}
+
+
+def test_messages_are_memoized():
+
+    base = Conversation.from_messages([{'role': 'system', 'content': str(i)} for i in range(3)])
+    messages = base.messages()
+    longer = base.append({'role': 'user', 'content': 'hi'})
+
+    assert base.messages() is messages
+    # built on top of the parent's tuple rather than walking the whole history again
+    assert longer.messages()[:3] == messages
+    assert longer.messages() is longer.messages()
+    assert base.messages() == messages and len(messages) == 3
+    assert longer + [{'role': 'user', 'content': 'more'}] == list(messages) + [{'role': 'user', 'content': 'hi'}, {'role': 'user', 'content': 'more'}]
+
+
+def test_forks_share_instructions_but_not_additions():
+
+    model = FakeModel()
+    model.add_sys_instructions('be brief')
+    first, second = model.fork(), model.fork()
+    first.add_sys_instructions('answer in french')
+    second.add_sys_instructions('answer in german')
+
+    assert first.conversation.parent is model.conversation
+    assert second.conversation.parent is model.conversation
+    assert [m['content'] for m in model.system_instructions] == ['be brief']
+    assert [m['content'] for m in first.system_instructions] == ['be brief', 'answer in french']
+    assert [m['content'] for m in second.system_instructions] == ['be brief', 'answer in german']
+
+
+def test_fork_config_diverges():
+
+    config = {'temperature': 0.}
+    model = FakeModel(config=config)
+    hot = model.fork(config={'temperature': 1.})
+    hot.config['max_tokens'] = 10
+    plain = model.fork()
+    plain.config['temperature'] = .5
+
+    assert hot.config == {'temperature': 1., 'max_tokens': 10}
+    assert plain.config == {'temperature': .5}
+    assert model.config == {'temperature': 0.}
+    assert config == {'temperature': 0.}
+    # the rest is shared
+    assert hot.transport is model.transport and hot.cache_stats is model.cache_stats
@@ -0,0 +1,62 @@
+import threading
+
+import numpy as np
+
+from conftest import FakeModel
+from marshall.pipelines import debate
+from marshall.pipelines.debate import Debate
+
+
+def unavailable(prompt):
+
+    raise RuntimeError('unavailable')
+
+
+def fake_embed(texts, **kwargs):
+
+    # distinct answers are orthogonal, so they never converge
+    return np.array([[float(t == 'four'), float(t == '4'), 0.] for t in texts])
+
+
+def test_failed_openers_are_dropped(monkeypatch):
+
+    monkeypatch.setattr(debate, 'embed_texts', fake_embed)
+    failed = FakeModel(unavailable)
+    d = Debate([FakeModel('four'), FakeModel('4'), failed], max_rounds=2)
+
+    d.run('2 + 2?')
+
+    assert len(failed.prompts) == 1
+    assert all(len(answers) == 2 for answers in d.transcript)
+    # the failed debater's missing answer didn't count as agreement
+    assert d.agreement[0] == 0.
+
+
+def test_a_single_opener_answers_alone(monkeypatch):
+
+    monkeypatch.setattr(debate, 'embed_texts', fake_embed)
+
+    assert Debate([FakeModel('four'), FakeModel(unavailable), FakeModel(unavailable)]).run('2 + 2?') == 'four'
+
+
+def test_concurrent_runs_keep_their_own_transcript(monkeypatch):
+
+    # identical embeddings, so every debate converges on its opening round
+    monkeypatch.setattr(debate, 'embed_texts', lambda texts, **kwargs: np.ones((len(texts), 3)))
+    d = Debate([FakeModel(lambda prompt: prompt), FakeModel(lambda prompt: prompt)])
+    other_done = threading.Event()
+    seen = {}
+
+    def first():
+        d.run('2 + 2?')
+        other_done.wait(5)
+        seen['first'] = d.transcript
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    d.run('3 + 3?')
+    other_done.set()
+    thread.join()
+
+    assert seen['first'] == [['2 + 2?', '2 + 2?']]
+    assert d.transcript == [['3 + 3?', '3 + 3?']]
@@ -0,0 +1,19 @@
+from conftest import FakeModel
+from marshall.core.agent import Agent
+from marshall.core.llm import LLM
+from marshall.pipelines.delegation import DAG_INSTRUCTIONS, DelegationPipeline
+
+
+def dag_instructions(model: LLM) -> int:
+
+    return sum(m['content'] == DAG_INSTRUCTIONS for m in model.system_instructions)
+
+
+def test_pipelines_do_not_stack_instructions_on_the_agent():
+
+    agent = Agent(FakeModel(), FakeModel(), None)
+    pipelines = [DelegationPipeline(agent) for _ in range(3)]
+
+    assert dag_instructions(agent.base_model) == 0 and dag_instructions(agent.subagent_model) == 0
+    for pipeline in pipelines:
+        assert dag_instructions(pipeline.agent.base_model) == 1 and dag_instructions(pipeline.agent.subagent_model) == 1
@@ -0,0 +1,33 @@
+import numpy as np
+
+from marshall.tools.embed import embed_texts
+from marshall.tools.embed_cache import EmbeddingCache
+
+
+MODEL = 'text-embedding-3-small'
+
+
+def test_embeddings_are_cached_per_base_url(tmp_path):
+
+    cache = EmbeddingCache(path=str(tmp_path / 'embeddings.sqlite'))
+    cache.set(MODEL, 'hello', np.ones(4), base_url='http://127.0.0.1:8080/v1')
+
+    assert cache.get(MODEL, 'hello') is None
+    assert cache.get(MODEL, 'hello', base_url='https://api.openai.com/v1') is None
+    assert cache.get(MODEL, 'hello', base_url='http://127.0.0.1:8080/v1/') is not None
+
+    # the sqlite tier keeps them apart too
+    cache.memory.clear()
+    assert cache.get(MODEL, 'hello') is None
+    assert cache.get(MODEL, 'hello', base_url='http://127.0.0.1:8080/v1') is not None
+
+
+def test_embedding_no_texts_needs_no_request():
+
+    class NoTransport:
+
+        def post(self, *args, **kwargs):
+            raise AssertionError("no request expected")
+
+    vectors = embed_texts([], transport=NoTransport())
+    assert vectors.shape == (0, 1536) and vectors.dtype == np.float32
@@ -0,0 +1,37 @@
+import threading
+
+from conftest import FakeModel
+from marshall.pipelines.ensemble import HomogeneousEnsemble
+
+
+def echo(barrier: threading.Barrier = None):
+
+    # answers with the prompt, after waiting at `barrier` so concurrent runs overlap
+    def reply(prompt):
+        if barrier is not None:
+            barrier.wait(timeout=5)
+        return f"answer to {prompt}"
+
+    return reply
+
+
+def test_concurrent_runs_keep_their_own_diagnostics():
+
+    ensemble = HomogeneousEnsemble(FakeModel(echo(threading.Barrier(4))), 2, refinement_strategy='agent', refinement_agent=FakeModel(echo()))
+    seen = {}
+
+    def run(query):
+        ensemble.run(query)
+        seen[query] = (ensemble.responses, ensemble.errors)
+
+    threads = [threading.Thread(target=run, args=(q,)) for q in ('first', 'second')]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for query, (responses, errors) in seen.items():
+        assert responses.count(f"answer to {query}") == 2 and not errors
+
+    # nothing ran on this thread
+    assert ensemble.responses is None and ensemble.agreement_history == []
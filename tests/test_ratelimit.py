@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from marshall.core import ratelimit
+from marshall.core.ratelimit import AIMDLimiter, RetryPolicy
+
+
+class FlakyTransport:
+
+    """fails the first `failures` posts with a transport error, then answers with `usage`"""
+
+    def __init__(self, failures: int, usage: dict = None) -> None:
+
+        self.failures = failures
+        self.usage = usage
+        self.posts = 0
+
+    def _respond(self, url):
+
+        self.posts += 1
+        if self.posts <= self.failures:
+            raise httpx.ConnectError('connection refused')
+        return httpx.Response(200, content=json.dumps({'usage': self.usage}), request=httpx.Request('POST', url))
+
+    def post(self, url, headers=None, content=None):
+
+        return self._respond(url)
+
+    async def apost(self, url, headers=None, content=None):
+
+        return self._respond(url)
+
+
+@pytest.fixture
+def limiter():
+
+    limiter = ratelimit.configure('test', 'flaky', tokens_per_minute=10000)
+    yield limiter
+    ratelimit._limiters.pop(('test', 'flaky'), None)
+
+
+def test_transport_errors_are_retried(limiter):
+
+    transport = FlakyTransport(failures=2)
+    response = ratelimit.send(transport, 'http://mock', {}, 'x', 'test', 'flaky', policy=RetryPolicy(base_delay=0.))
+
+    assert response.status_code == 200 and transport.posts == 3
+    assert limiter.retries == 2 and limiter.concurrency.limit < 8
+
+
+def test_transport_errors_raise_after_the_last_retry(limiter):
+
+    transport = FlakyTransport(failures=10)
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(ratelimit.asend(transport, 'http://mock', {}, 'x', 'test', 'flaky', policy=RetryPolicy(max_retries=2, base_delay=0.)))
+
+    assert transport.posts == 3
+
+
+def test_token_bucket_follows_actual_usage(limiter):
+
+    # estimated at 1000 tokens (4000 chars / 4), the response says 3000 were used
+    ratelimit.send(FlakyTransport(failures=0, usage={'total_tokens': 3000}), 'http://mock', {}, 'x' * 4000, 'test', 'flaky')
+
+    assert limiter.tokens.tokens == pytest.approx(7000, abs=5)
+
+
+def test_aacquire_waits_for_a_release():
+
+    concurrency = AIMDLimiter(initial=1)
+
+    async def main():
+        await concurrency.aacquire()
+        waiting = asyncio.ensure_future(concurrency.aacquire())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+
+        concurrency.release()
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(main())
+    assert concurrency.in_flight == 1
@@ -0,0 +1,42 @@
+import itertools
+import json
+
+from conftest import FakeModel
+from marshall.core.cache import ResponseCache
+from marshall.pipelines.ensemble import HomogeneousEnsemble
+
+
+class CountingModel(FakeModel):
+
+    """every uncached request gets a new answer"""
+
+    def __init__(self, response_cache=None) -> None:
+
+        super().__init__(name='counting', response_cache=response_cache)
+        self.counter = itertools.count()
+
+    def generate(self, prompt: str):
+
+        payload = json.dumps({'prompt': prompt, 'temperature': self.config.get('temperature')})
+        return self.cached_call(payload, 'http://mock', lambda: {'answer': next(self.counter)})['answer']
+
+
+def test_identical_requests_share_a_response():
+
+    model = CountingModel(response_cache=ResponseCache())
+
+    assert model.generate('q') == model.generate('q')
+
+
+def test_ensemble_samples_are_cached_separately():
+
+    cache = ResponseCache()
+    ensemble = HomogeneousEnsemble(CountingModel(response_cache=cache), 4)
+
+    samples, errors = ensemble._gather('q')
+    assert not errors
+    assert len(set(samples)) == 4
+
+    # a second run replays each recorded sample once
+    replayed, _ = ensemble._gather('q')
+    assert sorted(replayed) == sorted(samples)
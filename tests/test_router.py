@@ -0,0 +1,25 @@
+import pytest
+
+from conftest import FakeModel
+from marshall.llms.router import CascadeRouter
+
+
+def tier(answer: str, verdict: str = ''):
+
+    # answers every prompt with `answer`, except the self check, which gets `verdict`. tiers are told apart by model name
+    return FakeModel(lambda prompt: verdict if prompt.startswith('A model was given the task') else answer, name=answer)
+
+
+@pytest.mark.parametrize('verdict, escalated', [
+    ('{"confident": true}', False),
+    ('{"confident": false}', True),
+    ('Yes.', False),
+    ('yes, except the date is not correct', True),
+    ('Not true, the sum is wrong', True),
+    ('I cannot tell', True),
+])
+def test_self_check_only_accepts_an_explicit_yes(verdict, escalated):
+
+    router = CascadeRouter([tier('cheap', verdict), tier('expensive')], escalate_on=('self_check',))
+
+    assert router.generate('what is 2 + 2?') == ('expensive' if escalated else 'cheap')
@@ -0,0 +1,40 @@
+import time
+from unittest import mock
+
+from marshall.tools import semantic_cache
+from marshall.tools.semantic_cache import SemanticCache
+
+
+VECTORS = {'q': [1., 0., 0., 0.], 'q?': [0.99, 0.1, 0., 0.]}
+
+
+def fake_embed(text, **kwargs):
+
+    return VECTORS[text]
+
+
+def test_embedding_failure_falls_back_to_compute():
+
+    cache = SemanticCache()
+    with mock.patch.object(semantic_cache, 'embed_text', side_effect=RuntimeError('embeddings down')):
+        assert cache.get_or_compute('q', 'ns', lambda: 'answer') == 'answer'
+
+    with mock.patch.object(semantic_cache, 'embed_text', return_value=None):
+        assert cache.get_or_compute('q', 'ns', lambda: 'answer') == 'answer'
+
+    stats = cache.stats()
+    assert stats['embed_failures'] == 2 and stats['misses'] == 2 and stats['size'] == 0
+
+
+def test_expired_neighbour_does_not_hide_a_live_one():
+
+    cache = SemanticCache(ttl=0.05)
+    with mock.patch.object(semantic_cache, 'embed_text', side_effect=fake_embed):
+        cache.store('q', 'stale', 'ns')
+        time.sleep(0.06)
+        cache.store('q?', 'fresh', 'ns')
+
+        # 'q' is the nearest entry to itself but has expired, the live near-duplicate still answers
+        assert cache.lookup('q', 'ns') == 'fresh'
+
+    assert cache.stats()['expirations'] == 1 and len(cache) == 1
@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+import pytest
+
+from marshall.core.streaming import IncrementalJSONParser, aiter_sse, iter_sse
+
+TEXT = '{"content_type": "code", "content": "print(\\"a\\\\b\\u00e9\\")\\nx = 1", "n": -1.5e3, "ok": true, "tags": ["a", {"b": "}"}], "none": null}'
+
+
+def feed_all(chunks) -> tuple:
+
+    parser = IncrementalJSONParser()
+    order = [key for chunk in chunks for key in parser.feed(chunk)]
+    return parser, order
+
+
+def test_every_two_way_split():
+
+    expected = json.loads(TEXT)
+    for i in range(len(TEXT) + 1):
+        parser, order = feed_all([TEXT[:i], TEXT[i:]])
+        assert parser.fields == expected, i
+        assert order == list(expected)
+        assert parser.done
+
+
+def test_one_character_at_a_time():
+
+    parser, order = feed_all(TEXT)
+
+    assert parser.fields == json.loads(TEXT)
+    assert order == ['content_type', 'content', 'n', 'ok', 'tags', 'none']
+
+
+@pytest.mark.parametrize('chunks', [
+    ['{"content_', 'type": "text", "con', 'tent": "hi"}'], # mid-key
+    ['{"content_type": "te', 'xt", "content": "h', 'i"}'], # mid-string
+    ['{"content_type": "text", "content": "\\', 'u00', '68i"}'], # mid-escape
+])
+def test_chunks_split_inside_tokens(chunks):
+
+    parser, order = feed_all(chunks)
+
+    assert parser.fields == {'content_type': 'text', 'content': 'hi'}
+    assert order == ['content_type', 'content']
+
+
+def test_fields_complete_as_soon_as_their_value_does():
+
+    parser = IncrementalJSONParser()
+
+    assert parser.feed('{"content_type": "code", "content": "x = ') == ['content_type']
+    assert parser.partial() == 'x = '
+    assert parser.feed('\\"a\\') == []
+    # the dangling escape is left out until its next character arrives
+    assert parser.partial() == 'x = "a'
+    assert parser.feed('"\\n') == []
+    assert parser.partial() == 'x = "a"\n'
+    assert parser.feed('"}') == ['content']
+    assert parser.partial() is None
+    assert parser.fields['content'] == 'x = "a"\n'
+
+
+def test_only_the_token_in_progress_is_kept():
+
+    parser = IncrementalJSONParser()
+    parser.feed('{"content_type": "text", ')
+    assert parser._chunks == []
+
+    for _ in range(100):
+        parser.feed('abc' if parser._chunks else '"content": "abc')
+    assert len(parser._chunks) == 100
+
+    parser.feed('", "more": 1')
+    assert parser._chunks == ['", "more": 1']
+    parser.feed('}')
+    assert parser.fields['content'] == 'abc' * 100 and parser.fields['more'] == 1
+
+
+LINES = [
+    ': keep-alive',
+    'data: {"a": 1}',
+    '',
+    'event: content_block_delta',
+    'data: first',
+    'data:second',
+    'id: 7',
+    '',
+    '',
+    'data: [DONE]',
+]
+
+
+def test_iter_sse():
+
+    assert list(iter_sse(LINES)) == [
+        (None, '{"a": 1}'),
+        ('content_block_delta', 'first\nsecond'),
+        (None, '[DONE]'), # the last event is flushed without a trailing blank line
+    ]
+
+
+def test_aiter_sse_matches_iter_sse():
+
+    async def lines():
+        for line in LINES:
+            yield line
+
+    async def collect():
+        return [event async for event in aiter_sse(lines())]
+
+    assert asyncio.run(collect()) == list(iter_sse(LINES))
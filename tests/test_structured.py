@@ -0,0 +1,65 @@
+import pytest
+
+from marshall.core import structured
+from marshall.core.structured import CONTENT, DECISION, ParseError, loads, parse
+
+
+@pytest.fixture(autouse=True)
+def stats():
+
+    structured.STATS.reset()
+    yield structured.STATS
+    structured.STATS.reset()
+
+
+def test_clean_json_needs_no_repair():
+
+    assert loads('  {"decision": "answer", "content": "4"}\n') == ({'decision': 'answer', 'content': '4'}, [])
+
+
+@pytest.mark.parametrize('text, obj, repairs', [
+    ('```json\n{"a": 1}\n```', {'a': 1}, ['code_fence']),
+    ('Sure, here it is: {"a": 1} hope that helps', {'a': 1}, ['leading_text', 'trailing_text']),
+    ('{"a": "line one\nline two"}', {'a': 'line one\nline two'}, ['control_chars']),
+    ('{"a": [1, 2,], "b": 3,}', {'a': [1, 2], 'b': 3}, ['trailing_comma', 'trailing_comma']),
+    ('{"a": {"b": "cut sho', {'a': {'b': 'cut sho'}}, ['truncated']),
+    ("{'a': True, 'b': None}", {'a': True, 'b': None}, ['python_literal']),
+    ('{"a": "{not a brace}", "b": "\\"quoted\\""} tail', {'a': '{not a brace}', 'b': '"quoted"'}, ['trailing_text']),
+])
+def test_repairs(text, obj, repairs):
+
+    assert loads(text) == (obj, repairs)
+
+
+@pytest.mark.parametrize('text', ['no json here', '{"a": nope}', '[1, 2]', '```\n[1]\n```'])
+def test_unrecoverable_output_raises(text):
+
+    with pytest.raises(ParseError):
+        loads(text)
+
+
+def test_decision_is_normalized_and_content_coerced(stats):
+
+    assert parse('{"decision": " Answer ", "content": ["a", "b"]}', DECISION) == {'decision': 'answer', 'content': ['a', 'b']}
+    assert parse('{"content": {"x": 1}}', CONTENT) == {'content': '{"x": 1}', 'content_type': 'text'}
+    assert stats.snapshot()['repairs'] == {'normalized_decision': 1, 'default_content_type': 1, 'coerced_content': 1}
+    assert stats.snapshot()['repaired'] == 2
+
+
+@pytest.mark.parametrize('text', ['{"decision": "answer"}', '{"decision": "guess", "content": "4"}'])
+def test_invalid_decisions_fail(text, stats):
+
+    with pytest.raises(ParseError):
+        parse(text, DECISION)
+    assert stats.snapshot()['failed'] == 1
+
+
+def test_plain_text_fallback(stats):
+
+    assert parse('  just an answer\n', CONTENT, plain_text_fallback=True) == {'content': 'just an answer', 'content_type': 'text'}
+    assert stats.snapshot()['repairs'] == {'plain_text': 1, 'default_content_type': 1}
+    with pytest.raises(ParseError):
+        parse('just an answer', CONTENT)
+    # broken JSON isn't passed off as plain text
+    with pytest.raises(ParseError):
+        parse('{"content": nope}', CONTENT, plain_text_fallback=True)
@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+import pytest
+
+from marshall.bench.mock_server import Latency, MockServer
+from marshall.core.transport import Transport
+from marshall.llms.gpt import GPT
+
+
+@pytest.fixture
+def server(monkeypatch):
+
+    with MockServer(latency=Latency.parse('0')) as server:
+        for key, value in server.environ().items():
+            monkeypatch.setenv(key, value)
+        yield server
+
+
+def test_async_calls_across_event_loops(server):
+
+    model = GPT('gpt-4o', transport=Transport())
+
+    # each asyncio.run has its own loop, the second must not reuse the first loop's (closed) connections
+    first = asyncio.run(model.agenerate('hi'))
+    second = asyncio.run(model.agenerate('hi'))
+
+    assert first is not None and second is not None
+    # the first loop's client was dropped
+    assert len(model.transport._async_clients) == 1
+
+
+def test_mock_server_answers_reused_connections_promptly(server):
+
+    transport = Transport()
+    url = server.openai_base_url + '/embeddings'
+    transport.post(url, content='{"input": ["warm up"], "model": "text-embedding-3-small"}')
+
+    # a reused keep-alive connection, with Nagle on the server each response stalled ~40ms on a delayed ACK
+    start = time.monotonic()
+    for _ in range(5):
+        transport.post(url, content='{"input": ["hi"], "model": "text-embedding-3-small"}')
+
+    assert (time.monotonic() - start) / 5 < 0.03
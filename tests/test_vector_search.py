@@ -0,0 +1,29 @@
+import numpy as np
+
+from marshall.tools.vector_search import VectorIndex
+
+
+def test_search_on_an_empty_index():
+
+    index = VectorIndex()
+
+    assert index.search(np.ones(4), k=3) == []
+    assert index.search(np.ones((2, 4)), k=3) == [[], []]
+
+
+def test_search_after_deleting_everything():
+
+    index = VectorIndex()
+    index.add(np.eye(4), ids=['a', 'b', 'c', 'd'])
+    index.delete(['a', 'b', 'c', 'd'])
+
+    assert index.search(np.ones(4), k=3) == []
+
+
+def test_search_returns_the_nearest_first():
+
+    index = VectorIndex()
+    index.add(np.eye(4), ids=['a', 'b', 'c', 'd'])
+
+    hits = index.search(np.array([0.1, 1., 0., 0.]), k=2)
+    assert [h['id'] for h in hits] == ['b', 'a']